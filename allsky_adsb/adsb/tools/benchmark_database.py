@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+'''
+Compares aircraft lookups in the SQLite database written by build_database.py against the
+older per prefix json files.
+
+A synthetic database is built in a temporary folder so this can be run without downloading
+the adsb exchange data
+
+    ./benchmark_database.py [aircraft] [lookups]
+'''
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from build_database import ALLSKYBUILDADSBDATABASES, DATABASE_FILE
+
+def make_records(count):
+    random.seed(1)
+    icaos = random.sample(range(0x000000, 0xFFFFFF), count)
+    for icao in sorted(icaos):
+        yield (
+            f'{icao:06x}',
+            f'G-{icao % 100000:05d}',
+            random.choice(['A320', 'B738', 'C172', 'E190']),
+            str(random.randint(1970, 2024)),
+            'Manufacturer',
+            'Model',
+            f'Owner {icao % 1000}',
+            random.choice(['L2J', 'L1P']),
+            random.randint(0, 1)
+        )
+
+def write_json_shards(records, folder):
+    shards = {}
+    for icao, reg, icaotype, year, manufacturer, model, ownop, short_type, mil in records:
+        shards.setdefault(icao[:2], {})[icao] = {
+            'i': icao, 'r': reg, 'it': icaotype, 'y': year, 'm': manufacturer,
+            'mo': model, 'o': ownop, 'st': short_type, 'ml': bool(mil)
+        }
+    for key, shard in shards.items():
+        with open(os.path.join(folder, f'{key}.json'), 'w') as file:
+            json.dump(shard, file, indent=2)
+
+def lookup_json(folder, icao):
+    with open(os.path.join(folder, f'{icao[:2]}.json'), 'r', encoding='utf-8') as file:
+        ac_data = json.load(file)
+    return ac_data.get(icao)
+
+def lookup_sqlite(connection, icao):
+    return connection.execute('SELECT * FROM aircraft WHERE icao = ?', (icao,)).fetchone()
+
+def benchmark(name, lookup, icaos):
+    start_time = time.perf_counter()
+    for icao in icaos:
+        lookup(icao)
+    elapsed = time.perf_counter() - start_time
+    print(f'{name:8} {len(icaos)} lookups in {elapsed:.3f}s, {elapsed / len(icaos) * 1000:.3f}ms per lookup')
+
+if __name__ == '__main__':
+    aircraft = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 1500
+
+    with tempfile.TemporaryDirectory() as folder:
+        records = list(make_records(aircraft))
+        write_json_shards(records, folder)
+        database_path = os.path.join(folder, DATABASE_FILE)
+        ALLSKYBUILDADSBDATABASES()._write_database(iter(records), database_path)
+
+        random.seed(2)
+        icaos = [random.choice(records)[0] for _ in range(lookups)]
+
+        benchmark('json', lambda icao: lookup_json(folder, icao), icaos)
+        connection = sqlite3.connect(f'file:{database_path}?mode=ro', uri=True)
+        benchmark('sqlite', lambda icao: lookup_sqlite(connection, icao), icaos)
+        connection.close()
@@ -3,77 +3,146 @@
 import json
 import time
 import os
-import tempfile
+import sys
+import sqlite3
 import requests
 import gzip
-import shutil
+import io
+
+DATABASE_FILE = 'aircraft.db'
 
 class ALLSKYBUILDADSBDATABASES:
-    def __init__(self):
+    def __init__(self, force=False):
         self._adsb_data_url = 'https://downloads.adsbexchange.com/downloads/basic-ac-db.json.gz'
         self._adsb_db_dir = '/opt/allsky/modules/adsb/adsb_data'
-        self._raw_data_file = 'basic-ac-db.json'
-    
-    def _download_adsb_data(self):
-        temp_file_name = None
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file_name = temp_file.name
-
-            response = requests.get(self._adsb_data_url)
-
-            if response.status_code == 200:
-                temp_file.write(response.content)
-                print(f'Downloaded content to {temp_file_name}')
-                
-                with gzip.open(temp_file_name, 'rb') as f_in:
-                    with open(self._raw_data_file, 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                print(f'Decompressed file to {self._raw_data_file}')
-            else:
-                print('Failed to download file.')
-
-        if temp_file_name is not None:
+        self._force = force
+
+    def _read_source_headers(self, database_path):
+        ''' Returns the ETag and Last-Modified headers of the download the existing database was built from
+        '''
+        headers = {}
+        if os.path.exists(database_path):
             try:
-                os.remove(temp_file_name)
-            except OSError as e:
-                print(f'Error removing temporary file: {e}')
-                    
-    def _parse_adsb_data(self):
-        ac_data = {}
-        with open(self._raw_data_file, 'r', encoding='utf-8') as file:
-            for line in file:
-                data = json.loads(line)
-                if data['ownop'] != 'CANCELLED/NOT ASSIGNED':
-                    db_file_key = data['icao'][:2]
-                    if db_file_key not in ac_data:
-                        ac_data[db_file_key] = {}
-                    ac_data[db_file_key][data['icao']] = {
-                        'i': str(data['icao']),
-                        'r':data['reg'],
-                        'it':data['icaotype'],
-                        'y':data['year'],
-                        'm':data['manufacturer'],
-                        'mo':data['model'],
-                        'o':data['ownop'],
-                        'st':data['short_type'],
-                        'ml':data['mil']
-                    }
-
-        for icao_key in ac_data:
-            icao_file = f'{icao_key}.json'
-            file_path = os.path.join(self._adsb_db_dir, icao_file)    
-            with open(file_path, 'w') as file:
-                json.dump(ac_data[icao_key], file, indent=2)
-    
+                connection = sqlite3.connect(f'file:{database_path}?mode=ro', uri=True)
+                try:
+                    headers = dict(connection.execute('SELECT key, value FROM metadata').fetchall())
+                finally:
+                    connection.close()
+            except sqlite3.Error:
+                pass
+
+        return headers
+
+    def _read_records(self, lines):
+        ''' Converts lines of the raw adsb exchange data into database rows
+        '''
+        for line in lines:
+            data = json.loads(line)
+            if data['ownop'] != 'CANCELLED/NOT ASSIGNED':
+                yield (
+                    str(data['icao']).lower(),
+                    data['reg'],
+                    data['icaotype'],
+                    data['year'],
+                    data['manufacturer'],
+                    data['model'],
+                    data['ownop'],
+                    data['short_type'],
+                    1 if data['mil'] else 0
+                )
+
+    def _write_database(self, records, database_path, metadata=None, batch_size=1000):
+        ''' Writes the records to a new SQLite database, keyed on the ICAO hex code, and then replaces
+            the existing database. The aircraft table is a WITHOUT ROWID table so the rows are stored
+            in ICAO order and a lookup is a single b-tree search. Records are written in small batches
+            so the memory used does not depend on the size of the data
+        '''
+        temp_path = f'{database_path}.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        connection = sqlite3.connect(temp_path)
+        try:
+            connection.execute('PRAGMA journal_mode = OFF')
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute('PRAGMA cache_size = -2000')
+            connection.execute('''
+                CREATE TABLE aircraft (
+                    icao TEXT PRIMARY KEY,
+                    registration TEXT,
+                    icao_type TEXT,
+                    year TEXT,
+                    manufacturer TEXT,
+                    model TEXT,
+                    owner TEXT,
+                    short_type TEXT,
+                    military INTEGER
+                ) WITHOUT ROWID
+            ''')
+            connection.execute('CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT)')
+
+            count = 0
+            batch = []
+            for record in records:
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    connection.executemany('INSERT OR REPLACE INTO aircraft VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                connection.executemany('INSERT OR REPLACE INTO aircraft VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+                count += len(batch)
+
+            if metadata:
+                connection.executemany('INSERT INTO metadata VALUES (?, ?)', metadata.items())
+
+            connection.commit()
+        finally:
+            connection.close()
+
+        os.replace(temp_path, database_path)
+        print(f'Wrote {count} aircraft to {database_path}')
+        return count
+
     def run(self):
-        self._download_adsb_data()
-        self._parse_adsb_data()
+        ''' Streams the adsb exchange data straight from the download, decompressing and writing it to the
+            database line by line. If the download has not changed since the database was built then
+            nothing is downloaded, use --force to rebuild anyway
+        '''
+        database_path = os.path.join(self._adsb_db_dir, DATABASE_FILE)
+
+        headers = {}
+        if not self._force:
+            source = self._read_source_headers(database_path)
+            if source.get('etag'):
+                headers['If-None-Match'] = source['etag']
+            if source.get('last_modified'):
+                headers['If-Modified-Since'] = source['last_modified']
+
+        with requests.get(self._adsb_data_url, headers=headers, stream=True, timeout=(10, 60)) as response:
+            if response.status_code == 304:
+                print('The aircraft database is up to date')
+                return
+
+            if response.status_code != 200:
+                print(f'Failed to download file. {response.status_code}')
+                return
+
+            metadata = {
+                'etag': response.headers.get('ETag', ''),
+                'last_modified': response.headers.get('Last-Modified', '')
+            }
+
+            response.raw.decode_content = True
+            with gzip.GzipFile(fileobj=response.raw) as gzip_file:
+                lines = io.TextIOWrapper(gzip_file, encoding='utf-8')
+                self._write_database(self._read_records(lines), database_path, metadata)
         
 if __name__ == "__main__":
     start_time = time.time()
-    builder = ALLSKYBUILDADSBDATABASES();
+    builder = ALLSKYBUILDADSBDATABASES(force='--force' in sys.argv)
     
     builder.run()
     end_time = time.time()
     execution_time = end_time - start_time
-    print(f'Execution time: {execution_time} seconds')
\ No newline at end of file
+    print(f'Execution time: {execution_time} seconds')
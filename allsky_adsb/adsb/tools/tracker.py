@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+'''
+tracker.py
+
+Continuously polls a local dump1090 / readsb receiver and keeps a short track of recent positions for each
+aircraft. After every poll a snapshot of the aircraft, and their tracks, is written to shared memory where the
+adsb module reads it instead of fetching and parsing the receiver data itself.
+
+Usage: tracker.py http://192.168.1.28:8080/data/aircraft.json [--interval 1] [--length 60] [--expiry 60]
+'''
+import argparse
+import json
+import os
+import signal
+import time
+import requests
+
+from collections import deque
+
+SNAPSHOT_FILE = '/dev/shm/allsky_adsb_tracker.json'
+
+class ALLSKYADSBTRACKER:
+    def __init__(self, url, interval=1, track_length=60, expiry=60, snapshot_file=SNAPSHOT_FILE):
+        self._url = url
+        self._interval = interval
+        self._track_length = track_length
+        self._expiry = expiry
+        self._snapshot_file = snapshot_file
+        self._aircraft = {}
+        self._running = True
+
+    def _update(self, aircraft_data):
+        ''' Updates the latest data and position track for each aircraft in the receiver data
+        '''
+        now = aircraft_data.get('now', time.time())
+
+        for aircraft in aircraft_data.get('aircraft', []):
+            icao = aircraft.get('hex', '').strip()
+            if icao == '':
+                continue
+
+            entry = self._aircraft.get(icao)
+            if entry is None:
+                entry = {
+                    'data': {},
+                    'positions': deque(maxlen=self._track_length),
+                    'last_seen': now
+                }
+                self._aircraft[icao] = entry
+
+            entry['data'] = aircraft
+            entry['last_seen'] = now - aircraft.get('seen', 0)
+
+            altitude = aircraft.get('alt_baro', aircraft.get('altitude'))
+            if altitude == 'ground':
+                altitude = 0
+
+            # A position without an altitude cannot be placed in the sky so it is not added to the track
+            if 'lat' in aircraft and 'lon' in aircraft and altitude is not None:
+                position = [
+                    round(now - aircraft.get('seen_pos', 0), 1),
+                    aircraft['lat'],
+                    aircraft['lon'],
+                    altitude
+                ]
+                positions = entry['positions']
+                if not positions or positions[-1][1:3] != position[1:3]:
+                    positions.append(position)
+
+        return now
+
+    def _expire(self, now):
+        ''' Removes aircraft that have not been seen recently and positions older than the expiry time
+        '''
+        for icao in list(self._aircraft):
+            entry = self._aircraft[icao]
+            if now - entry['last_seen'] > self._expiry:
+                del self._aircraft[icao]
+            else:
+                positions = entry['positions']
+                while positions and now - positions[0][0] > self._expiry:
+                    positions.popleft()
+
+    def _write_snapshot(self, now):
+        ''' Writes the snapshot atomically so the module never reads a partially written file
+        '''
+        aircraft_list = []
+        for entry in self._aircraft.values():
+            aircraft = dict(entry['data'])
+            aircraft['positions'] = list(entry['positions'])
+            aircraft_list.append(aircraft)
+
+        snapshot = {
+            'now': now,
+            'source': self._url,
+            'aircraft': aircraft_list
+        }
+
+        temp_file = f'{self._snapshot_file}.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as file:
+            json.dump(snapshot, file, separators=(',', ':'))
+        os.replace(temp_file, self._snapshot_file)
+
+    def _stop(self, signum, frame):
+        self._running = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        print(f'Tracking aircraft from {self._url}, writing to {self._snapshot_file}')
+        session = requests.Session()
+        while self._running:
+            start_time = time.monotonic()
+            try:
+                response = session.get(self._url, timeout=self._interval * 5)
+                if response.status_code == 200:
+                    now = self._update(response.json())
+                    self._expire(now)
+                    self._write_snapshot(now)
+                else:
+                    print(f'Failed to retrieve data from "{self._url}". {response.status_code}')
+            except (requests.RequestException, ValueError) as e:
+                print(f'Failed to retrieve data from "{self._url}". {e}')
+            except OSError as e:
+                print(f'Failed to write the snapshot {self._snapshot_file}. {e}')
+
+            time.sleep(max(0, self._interval - (time.monotonic() - start_time)))
+
+        try:
+            os.remove(self._snapshot_file)
+        except FileNotFoundError:
+            pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Tracks aircraft from a local ADSB receiver for the Allsky adsb module')
+    parser.add_argument('url', help='The url of the receivers aircraft.json')
+    parser.add_argument('--interval', type=float, default=1, help='Seconds between polls of the receiver')
+    parser.add_argument('--length', type=int, default=60, help='The maximum number of positions kept for each aircraft')
+    parser.add_argument('--expiry', type=float, default=60, help='Seconds before an aircraft, or position, is removed')
+    parser.add_argument('--snapshot', default=SNAPSHOT_FILE, help='The file the snapshot is written to')
+    args = parser.parse_args()
+
+    tracker = ALLSKYADSBTRACKER(args.url, args.interval, args.length, args.expiry, args.snapshot)
+    tracker.run()
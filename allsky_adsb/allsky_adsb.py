@@ -7,21 +7,28 @@ https://github.com/thomasjacquin/allsky
 '''
 import allsky_shared as s
 import sys
+import time
 import requests
-import math
 import json
 import os
+import sqlite3
+import numpy as np
+import cv2
 
+from concurrent.futures import ThreadPoolExecutor, wait
 from unidecode import unidecode
+from requests.adapters import HTTPAdapter
 from requests.exceptions import MissingSchema, JSONDecodeError
 
 metaData = {
     "name": "ADSB - Aircraft tracking",
     "description": "Provides aircraft data for display in the captured images",
     "module": "allsky_adsb",    
-    "version": "v1.0.0",
+    "version": "v1.0.5",
     "events": [
-        "periodic"
+        "periodic",
+        "day",
+        "night"
     ],
     "enabled": "false",    
     "experimental": "true",    
@@ -32,7 +39,9 @@ metaData = {
         "aricraft_route": "true",
         "distance_limit": 50,
         "timeout": 10,
+        "lookup_deadline": 15,
         "local_adsb_url": "",
+        "local_tracker": "false",
         "observer_altitude": 0,
         "opensky_username": "",
         "opensky_password": "",
@@ -40,7 +49,17 @@ metaData = {
         "opensky_lon_min": 0,
         "opensky_lat_max": 0,
         "opensky_lon_max": 0,
-        "airplaneslive_radius": 50
+        "airplaneslive_radius": 50,
+        "draw_aircraft": "false",
+        "draw_labels": "true",
+        "draw_trails": "true",
+        "marker_size": 8,
+        "marker_colour": "255,255,0",
+        "center_x": 0,
+        "center_y": 0,
+        "radius": 0,
+        "camera_azimuth": 0,
+        "image_flip": "None"
     },
     "argumentdetails": {
          "data_source" : {
@@ -102,12 +121,33 @@ metaData = {
                 "step": 1
             }
         },
+        "lookup_deadline" : {
+            "required": "true",
+            "description": "Lookup Deadline",
+            "help": "The maximum number of seconds to spend looking up aircraft details and routes each run. Any lookups not completed in this time will be retried on the next run",
+            "tab": "Aircraft Data",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 1,
+                "max": 60,
+                "step": 1
+            }
+        },
         "local_adsb_url": {
             "required": "false",
             "description": "Local ADSB Address",
             "help": "See the help for how to obtain this address",
             "tab": "Local ADSB"
         },
+        "local_tracker" : {
+            "required": "false",
+            "description": "Use Tracker",
+            "help": "Read the aircraft from the tracker (adsb/tools/tracker.py) if it is running. See the module documentation for details",
+            "tab": "Local ADSB",
+            "type": {
+                "fieldtype": "checkbox"
+            }
+        },
         "opensky_username": {
             "required": "false",
             "description": "OpenSky Username",
@@ -163,7 +203,111 @@ metaData = {
             "type": {
                 "fieldtype": "checkbox"
             }          
-        }            
+        },
+        "draw_aircraft" : {
+            "required": "false",
+            "description": "Draw Aircraft",
+            "help": "Mark the aircraft on the image. The module must be in the periodic flow, to fetch the aircraft, and the day and/or night flows",
+            "tab": "Overlay",
+            "type": {
+                "fieldtype": "checkbox"
+            }
+        },
+        "draw_labels" : {
+            "required": "false",
+            "description": "Draw Labels",
+            "help": "Label each aircraft with its callsign",
+            "tab": "Overlay",
+            "type": {
+                "fieldtype": "checkbox"
+            }
+        },
+        "draw_trails" : {
+            "required": "false",
+            "description": "Draw Trails",
+            "help": "Draw the recent track of each aircraft. Requires the tracker, see the module documentation",
+            "tab": "Overlay",
+            "type": {
+                "fieldtype": "checkbox"
+            }
+        },
+        "marker_size" : {
+            "required": "false",
+            "description": "Marker Size",
+            "help": "The radius of the aircraft marker in pixels",
+            "tab": "Overlay",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 2,
+                "max": 50,
+                "step": 1
+            }
+        },
+        "marker_colour" : {
+            "required": "false",
+            "description": "Marker Colour",
+            "help": "The RGB colour of the markers, labels and trails. This should be comma separated values i.e. 255,0,0 for Red",
+            "tab": "Overlay"
+        },
+        "center_x" : {
+            "required": "false",
+            "description": "Center X",
+            "help": "The x position of the zenith in the image in pixels, 0 for the image centre",
+            "tab": "Overlay",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 10000,
+                "step": 1
+            }
+        },
+        "center_y" : {
+            "required": "false",
+            "description": "Center Y",
+            "help": "The y position of the zenith in the image in pixels, 0 for the image centre",
+            "tab": "Overlay",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 10000,
+                "step": 1
+            }
+        },
+        "radius" : {
+            "required": "false",
+            "description": "Horizon Radius",
+            "help": "The distance in pixels from the zenith to the horizon, 0 for half the smallest image dimension",
+            "tab": "Overlay",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 10000,
+                "step": 1
+            }
+        },
+        "camera_azimuth" : {
+            "required": "false",
+            "description": "Camera Azimuth",
+            "help": "The azimuth, in degrees, at the top of the image",
+            "tab": "Overlay",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 359,
+                "step": 1
+            }
+        },
+        "image_flip" : {
+            "required": "false",
+            "description": "Image Flip",
+            "help": "Match the flip applied to the image",
+            "tab": "Overlay",
+            "type": {
+                "fieldtype": "select",
+                "values": "None,Horizontal,Vertical,Both",
+                "default": "None"
+            }
+        }
     },
     "businfo": [
     ],
@@ -174,24 +318,197 @@ metaData = {
                 "authorurl": "https://github.com/allskyteam",
                 "changes": "Initial Release"
             }
+        ],
+        "v1.0.1" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Local aircraft data is stored in an indexed SQLite database"
+            }
+        ],
+        "v1.0.2" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Aircraft positions are now processed as arrays, the look angles for all aircraft are calculated in one pass and aircraft beyond the distance limit are removed before any lookups are done"
+            }
+        ],
+        "v1.0.3" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "hexdb and route lookups are cached on disk and any lookups not cached are made in parallel within a configurable deadline"
+            }
+        ],
+        "v1.0.4" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Added an optional tracker for local receivers that keeps a short track of each aircraft"
+            }
+        ],
+        "v1.0.5" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Aircraft can be marked on the image with optional labels and trails"
+            }
         ]
     }
 }
 
-def local_adsb(local_adsb_url, observer_location, timeout):
-		''' Retreives data from a local ADSB source
+ADSB_DATABASE_DIR = '/opt/allsky/modules/adsb/adsb_data'
+ADSB_DATABASE = os.path.join(ADSB_DATABASE_DIR, 'aircraft.db')
+
+_database = None
+_database_mtime = None
+
+LOOKUP_CACHE = os.path.join(ADSB_DATABASE_DIR, 'lookup_cache.db')
+LOOKUP_CACHE_SIZE = 5000
+LOOKUP_WORKERS = 4
+AIRCRAFT_TTL = 7 * 24 * 3600
+ROUTE_TTL = 24 * 3600
+NEGATIVE_TTL = 6 * 3600
+
+TRACKER_SNAPSHOT = '/dev/shm/allsky_adsb_tracker.json'
+TRACKER_MAX_AGE = 30
+
+ADSB_OVERLAY_FILE = '/dev/shm/allsky_adsb_overlay.json'
+OVERLAY_MAX_AGE_MARGIN = 60
+
+def project_to_image(altitude, azimuth, width, height, center_x, center_y, radius, camera_azimuth, flip):
+    ''' Returns integer arrays of the x and y pixel positions, in an equidistant fisheye image, for arrays of
+        altitude and azimuth in degrees. The zenith is at the centre and the horizon at radius pixels from it
+    '''
+    center_x = center_x if center_x > 0 else width / 2
+    center_y = center_y if center_y > 0 else height / 2
+    radius = radius if radius > 0 else min(width, height) / 2
+
+    x_sign = 1
+    y_sign = 1
+    if flip in ('Horizontal', 'Both'):
+        center_x = width - center_x
+        x_sign = -1
+    if flip in ('Vertical', 'Both'):
+        center_y = height - center_y
+        y_sign = -1
+
+    altitude = np.asarray(altitude, dtype=np.float64)
+    azimuth = np.radians(np.asarray(azimuth, dtype=np.float64) - camera_azimuth)
+    distance = (90.0 - altitude) * (radius / 90.0)
+
+    x = center_x + x_sign * distance * np.sin(azimuth)
+    y = center_y - y_sign * distance * np.cos(azimuth)
+
+    return np.rint(x).astype(np.int32), np.rint(y).astype(np.int32)
+
+_session = None
+
+class LookupCache:
+    ''' On disk cache of the hexdb aircraft and adsbdb route lookups, keyed by the ICAO hex code or callsign.
+
+        Lookups that found nothing are cached as well, with a shorter ttl, so aircraft with no route are not
+        requested every run. When the cache is full the least recently used entries are removed
+    '''
+
+    def __init__(self, path, max_entries=LOOKUP_CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._db = sqlite3.connect(path)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS lookups ('
+                'kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT, expires REAL NOT NULL, last_used REAL NOT NULL, '
+                'PRIMARY KEY (kind, key)) WITHOUT ROWID'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS lookups_last_used ON lookups (last_used)')
+        except sqlite3.Error as e:
+            s.log(0, f'ERROR: Unable to open the lookup cache {path} - {e}')
+            self._db = None
+
+    def get(self, kind, key):
+        ''' Returns (True, value) if the key is cached, value is None for a cached failed lookup.
+            Returns (False, None) if the key is not cached or has expired
+        '''
+        if self._db is not None:
+            now = time.time()
+            row = self._db.execute('SELECT value, expires FROM lookups WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+            if row is not None and row[1] > now:
+                self._db.execute('UPDATE lookups SET last_used = ? WHERE kind = ? AND key = ?', (now, kind, key))
+                self.hits += 1
+                return True, json.loads(row[0]) if row[0] is not None else None
+
+        self.misses += 1
+        return False, None
+
+    def put(self, kind, key, value, ttl):
+        if self._db is not None:
+            now = time.time()
+            self._db.execute(
+                'INSERT OR REPLACE INTO lookups (kind, key, value, expires, last_used) VALUES (?, ?, ?, ?, ?)',
+                (kind, key, json.dumps(value) if value is not None else None, now + ttl, now)
+            )
+
+    def close(self):
+        ''' Removes expired entries, and the least recently used if the cache is full, then saves the cache
+        '''
+        if self._db is not None:
+            try:
+                self._db.execute('DELETE FROM lookups WHERE expires <= ?', (time.time(),))
+                row = self._db.execute(
+                    'SELECT last_used FROM lookups ORDER BY last_used DESC LIMIT 1 OFFSET ?', (self.max_entries,)
+                ).fetchone()
+                if row is not None:
+                    self._db.execute('DELETE FROM lookups WHERE last_used <= ?', (row[0],))
+                self._db.commit()
+            except sqlite3.Error as e:
+                s.log(0, f'ERROR: Unable to save the lookup cache {self.path} - {e}')
+            self._db.close()
+            self._db = None
+
+def _read_tracker_snapshot():
+		''' Reads the latest snapshot written by adsb/tools/tracker.py. Returns None if the tracker is not
+				running or the snapshot is too old to use
+		'''
+		try:
+				with open(TRACKER_SNAPSHOT, 'r', encoding='utf-8') as file:
+						snapshot = json.load(file)
+		except (OSError, ValueError):
+				return None
+
+		age = time.time() - snapshot.get('now', 0)
+		if age > TRACKER_MAX_AGE:
+				s.log(4, f'INFO: The tracker snapshot is {age:.0f} seconds old so ignoring it')
+				return None
+
+		return snapshot
+
+def local_adsb(local_adsb_url, observer_location, timeout, use_tracker=False):
+		''' Retreives data from a local ADSB source, or the tracker if it is running
 		'''
-		found_aircraft = {}
+		found_aircraft = _new_batch()
 		result = ''
-		s.log(4, 'INFO: Getting data from local ADSB receiver')
 		
 		try:
-				response = requests.get(local_adsb_url, timeout=timeout)
+				aircraft_data = _read_tracker_snapshot() if use_tracker else None
+				if aircraft_data is not None:
+						s.log(4, f'INFO: Retrieved {len(aircraft_data["aircraft"])} aircraft from the tracker')
+				else:
+						s.log(4, 'INFO: Getting data from local ADSB receiver')
+						response = requests.get(local_adsb_url, timeout=timeout)
 
-				if response.status_code == 200:
-						aircraft_data = response.json()
+						if response.status_code == 200:
+								aircraft_data = response.json()
+								s.log(4, f'INFO: Retrieved {len(aircraft_data["aircraft"])} aircraft from local ADSB server')
+						else:
+								result = f'ERROR: Failed to retrieve data from "{local_adsb_url}". {response.status_code} - {response.text}'
 
-						s.log(4, f'INFO: Retrieved {len(aircraft_data["aircraft"])} aircraft from local ADSB server')
+				if aircraft_data is not None:
 						for aircraft in aircraft_data['aircraft']:
 
 								if 'flight' not in aircraft or aircraft['flight'].replace(' ', '') == '':
@@ -210,27 +527,17 @@ def local_adsb(local_adsb_url, observer_location, timeout):
             
 								if 'ias' in aircraft:
 										if 'lat' in aircraft:
-												aircraft_pos = (float(aircraft['lat']), float(aircraft['lon']), feet_to_meters(int(aircraft['alt_baro'])))
-												aircraft_azimuth, aircraft_elevation, aircraft_distance, slant_distance = look_angle(aircraft_pos, observer_location)
-
-												found_aircraft[aircraft['hex']] = {
-														'hex': aircraft['hex'].rstrip(),
-														'flight': aircraft['flight'].rstrip(),
-														'distance': aircraft_distance,
-														'distance_miles' : meters_to_miles(aircraft_distance),
-														'altitude': get_flight_level(aircraft['alt_baro']),
-														'ias': aircraft['ias'] if 'ias' in aircraft else '',
-														'tas': aircraft['tas'] if 'tas' in aircraft else '',
-														'mach': aircraft['mach'] if 'mach' in aircraft else '',
-														'azimuth': aircraft_azimuth,
-														'elevation': aircraft_elevation                   
-												}
+												if aircraft.get('alt_baro', 'ground') != 'ground':
+														_add_aircraft(found_aircraft, aircraft['hex'].rstrip(), aircraft['flight'].rstrip(),
+																float(aircraft['lat']), float(aircraft['lon']), feet_to_meters(int(aircraft['alt_baro'])),
+																aircraft['alt_baro'], aircraft['ias'], aircraft.get('tas', ''), aircraft.get('mach', ''),
+																aircraft.get('positions'))
+												else:
+														s.log(4, f'INFO: Ignoring {aircraft["flight"].rstrip()} as it is on the ground')
 										else:
 												s.log(4, f'INFO: Ignoring {aircraft["flight"].rstrip()} as the latitude missing')
 								else:
 										s.log(4, f'INFO: Ignoring {aircraft["flight"].rstrip()} as the airspeed missing')
-				else:
-						result = f'ERROR: Failed to retrieve data from "{local_adsb_url}". {response.status_code} - {response.text}'
 		except MissingSchema:
 				result = f'ERROR: The provided local adsb URL "{local_adsb_url}" is invalid'
 		except JSONDecodeError:
@@ -242,7 +549,7 @@ def airplaneslive_adsb(params, observer_location, timeout):
 		''' Retreives data from Airplanes live
 		'''
 
-		found_aircraft = {}
+		found_aircraft = _new_batch()
 		result = ''
 
 		radius = params['distance_limit']
@@ -273,23 +580,9 @@ def airplaneslive_adsb(params, observer_location, timeout):
 										if 'alt_baro' in aircraft:
 												if aircraft['alt_baro'] != 'ground':
 
-														aircraft_pos = (float(aircraft['lat']), float(aircraft['lon']), int(feet_to_meters(aircraft['alt_baro'])))
-														aircraft_azimuth, aircraft_elevation, aircraft_distance, slant_distance = look_angle(aircraft_pos, observer_location)
-
-														icao = aircraft['hex']
-
-														found_aircraft[icao] = {
-																'hex': icao,
-																'flight': flight,
-																'distance': aircraft_distance,
-																'distance_miles' : meters_to_miles(aircraft_distance),                          
-																'altitude': get_flight_level(aircraft['alt_baro']),
-																'ias': aircraft['ias'] if 'ias' in aircraft else '',
-																'tas': aircraft['tas'] if 'tas' in aircraft else '',
-																'mach': aircraft['mach'] if 'mach' in aircraft else '',
-																'azimuth': aircraft_azimuth,
-																'elevation': aircraft_elevation   
-														}
+														_add_aircraft(found_aircraft, aircraft['hex'], flight,
+																float(aircraft['lat']), float(aircraft['lon']), int(feet_to_meters(aircraft['alt_baro'])),
+																aircraft['alt_baro'], aircraft.get('ias', ''), aircraft.get('tas', ''), aircraft.get('mach', ''))
 												else:
 														s.log(4, f'INFO: {flight} is on the ground so ignoring')
 										else:
@@ -307,7 +600,7 @@ def airplaneslive_adsb(params, observer_location, timeout):
 def opensky_adsb(params, observer_location, timeout):
     ''' Retreives data from Opensky
     '''
-    found_aircraft = {}
+    found_aircraft = _new_batch()
     result = ''
 
     lat_min = params['opensky_lat_min']
@@ -331,23 +624,13 @@ def opensky_adsb(params, observer_location, timeout):
 
             s.log(4, f'INFO: Retrieved {len(aircraft_data["states"])} aircraft from OpenSky Network') 
             for aircraft in aircraft_data['states']:
-                aircraft_pos = (float(aircraft[6]), float(aircraft[5]), int(aircraft[7]))
-                aircraft_azimuth, aircraft_elevation, aircraft_distance, slant_distance = look_angle(aircraft_pos, observer_location)
-
-                icao = aircraft[0]
-                flight = aircraft[1]
-                found_aircraft[icao] = {
-                    'hex': icao,
-                    'flight': flight,
-                    'distance': aircraft_distance,
-                    'distance_miles' : meters_to_miles(aircraft_distance),                
-                    'altitude': get_flight_level(aircraft[7]),
-                    'ias': int(aircraft[9]),
-                    'tas': int(aircraft[9]),
-                    'mach': knots_to_mach(aircraft[9]),
-                    'azimuth': aircraft_azimuth,
-                    'elevation': aircraft_elevation    
-                }
+                if aircraft[5] is None or aircraft[6] is None or aircraft[7] is None or aircraft[9] is None:
+                    s.log(4, f'INFO: {aircraft[1]} has no location so ignoring')
+                    continue
+
+                _add_aircraft(found_aircraft, aircraft[0], aircraft[1],
+                    float(aircraft[6]), float(aircraft[5]), int(aircraft[7]),
+                    aircraft[7], int(aircraft[9]), int(aircraft[9]), knots_to_mach(aircraft[9]))
         else:
             result = f'ERROR: Failed getting data from OpenSky Network "{url}". {response.status_code} - {response.text}'
     except Exception as data_exception:
@@ -360,7 +643,7 @@ def adsbfi_adsb(params, observer_location, timeout):
 		''' Retreives data from Airplanes live
 		'''
 
-		found_aircraft = {}
+		found_aircraft = _new_batch()
 		result = ''
 		radius = params['distance_limit']
 
@@ -390,23 +673,9 @@ def adsbfi_adsb(params, observer_location, timeout):
 										if 'alt_baro' in aircraft:
 												if aircraft['alt_baro'] != 'ground':
 
-														aircraft_pos = (float(aircraft['lat']), float(aircraft['lon']), int(feet_to_meters(aircraft['alt_baro'])))
-														aircraft_azimuth, aircraft_elevation, aircraft_distance, slant_distance = look_angle(aircraft_pos, observer_location)
-
-														icao = aircraft['hex']
-												
-														found_aircraft[icao] = {
-																'hex': icao,
-																'flight': flight,
-																'distance': aircraft_distance,
-																'distance_miles' : meters_to_miles(aircraft_distance),                          
-																'altitude': get_flight_level(aircraft['alt_baro']),
-																'ias': aircraft['ias'] if 'ias' in aircraft else '',
-																'tas': aircraft['tas'] if 'tas' in aircraft else '',
-																'mach': aircraft['mach'] if 'mach' in aircraft else '',
-																'azimuth': aircraft_azimuth,
-																'elevation': aircraft_elevation   
-														}
+														_add_aircraft(found_aircraft, aircraft['hex'], flight,
+																float(aircraft['lat']), float(aircraft['lon']), int(feet_to_meters(aircraft['alt_baro'])),
+																aircraft['alt_baro'], aircraft.get('ias', ''), aircraft.get('tas', ''), aircraft.get('mach', ''))
 												else:
 														s.log(4, f'INFO: {flight} is on the ground so ignoring')
 										else:
@@ -451,7 +720,7 @@ def meters_to_miles(meters):
     return meters / 1609.344
 
 def haversine_distance(lat1, lon1, lat2, lon2):
-    '''Calculate greate circle distance between two points
+    '''Calculate greate circle distance between two points. All arguments can be numpy arrays
 
     Thanks to ChatGPT for the function
     '''
@@ -459,49 +728,112 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     EARTH_RADIUS = 6371000
     
     # Convert degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
 
     # Haversine formula for distance on Earth's surface
     dlat = lat2 - lat1
     dlon = lon2 - lon1
-    a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
     distance = EARTH_RADIUS * c
     return distance
 
-def look_angle(aircraft_pos, observer_location):
-    '''Calculate look angle between observer and aircraft
+def look_angles(lat, lon, alt, observer_location):
+    '''Calculate look angles between observer and an array of aircraft in one pass
 
-    Thanks to ChatGPT for the function
+    Returns arrays of the azimuth, elevation, surface distance and slant distance
     '''
-    lat1 = observer_location[0]
+    lat1 = np.radians(observer_location[0])
     lon1 = observer_location[1]
     alt1 = observer_location[2]
 
-    lat2 = aircraft_pos[0]
-    lon2 = aircraft_pos[1]
-    alt2 = aircraft_pos[2]
+    lat2 = np.radians(lat)
 
     # Surface distance between points
-    surface_distance = haversine_distance(lat1, lon1, lat2, lon2)
+    surface_distance = haversine_distance(observer_location[0], lon1, lat, lon)
 
     # Azimuth calculation
-    dlon = math.radians(lon2 - lon1)
-    x = math.sin(dlon) * math.cos(math.radians(lat2))
-    y = math.cos(math.radians(lat1)) * math.sin(math.radians(lat2)) - math.sin(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.cos(dlon)
-    azimuth = math.degrees(math.atan2(x, y))
-    azimuth = (azimuth + 360) % 360  # Normalize to 0-360 degrees
+    dlon = np.radians(lon - lon1)
+    x = np.sin(dlon) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    azimuth = np.degrees(np.arctan2(x, y)) % 360  # Normalize to 0-360 degrees
 
     # Elevation calculation
-    alt_diff = alt2 - alt1
-    slant_distance = math.sqrt(surface_distance ** 2 + alt_diff ** 2)
-    elevation = math.degrees(math.asin(alt_diff / slant_distance))
+    alt_diff = alt - alt1
+    slant_distance = np.hypot(surface_distance, alt_diff)
+    elevation = np.degrees(np.arcsin(np.divide(alt_diff, slant_distance, out=np.zeros_like(slant_distance), where=slant_distance > 0)))
 
     return azimuth, elevation, surface_distance, slant_distance
 
-def _get_aircraft_info(icao, timeout, aircraft_data):
+def _new_batch():
+    ''' Creates an empty aircraft batch. Each provider adds the aircraft from its feed to the batch, the
+        positions are then processed as arrays by _process_batch
+    '''
+    return {
+        'hex': [],
+        'flight': [],
+        'lat': [],
+        'lon': [],
+        'alt': [],
+        'altitude': [],
+        'ias': [],
+        'tas': [],
+        'mach': [],
+        'positions': []
+    }
 
-    aircraft_info = {
+def _add_aircraft(batch, icao, flight, lat, lon, alt, altitude, ias, tas, mach, positions=None):
+    ''' Adds an aircraft to a batch. alt is the altitude in metres, altitude is the value used for the flight level.
+        positions is the recent track of the aircraft, [time, lat, lon, altitude in feet], if the tracker is used
+    '''
+    batch['hex'].append(icao)
+    batch['flight'].append(flight)
+    batch['lat'].append(lat)
+    batch['lon'].append(lon)
+    batch['alt'].append(alt)
+    batch['altitude'].append(altitude)
+    batch['ias'].append(ias)
+    batch['tas'].append(tas)
+    batch['mach'].append(mach)
+    batch['positions'].append(positions)
+
+def _process_batch(batch, observer_location, distance_limit):
+    ''' Calculates the look angles for every aircraft in the batch in one pass, drops aircraft beyond
+        the distance limit and sorts the rest by distance. Only then are the per aircraft dicts built
+    '''
+    lat = np.asarray(batch['lat'], dtype=np.float64)
+    lon = np.asarray(batch['lon'], dtype=np.float64)
+    alt = np.asarray(batch['alt'], dtype=np.float64)
+
+    azimuth, elevation, distance, slant_distance = look_angles(lat, lon, alt, observer_location)
+    distance_miles = meters_to_miles(distance)
+
+    in_range = np.flatnonzero(distance_miles <= distance_limit)
+    excluded = len(lat) - len(in_range)
+    if excluded > 0:
+        s.log(4, f'INFO: {excluded} aircraft excluded as beyond {distance_limit} miles')
+    order = in_range[np.argsort(distance[in_range], kind='stable')]
+
+    aircraft_list = []
+    for index in order.tolist():
+        aircraft_list.append({
+            'hex': batch['hex'][index],
+            'flight': batch['flight'][index],
+            'distance': float(distance[index]),
+            'distance_miles': float(distance_miles[index]),
+            'altitude': get_flight_level(batch['altitude'][index]),
+            'ias': batch['ias'][index],
+            'tas': batch['tas'][index],
+            'mach': batch['mach'][index],
+            'azimuth': float(azimuth[index]),
+            'elevation': float(elevation[index]),
+            'positions': batch['positions'][index]
+        })
+
+    return aircraft_list
+
+def _empty_aircraft_info():
+    return {
         'ICAOTypeCode': '', 
         'Manufacturer': '', 
         'ModeS': '', 
@@ -511,56 +843,125 @@ def _get_aircraft_info(icao, timeout, aircraft_data):
         'Type': '',
         'Military': ''
     }
-    
-    if aircraft_data == 'Hexdb':
-        url = f'https://hexdb.io/api/v1/aircraft/{icao}'
-        try:
-            response = requests.get(url, timeout=timeout)
 
-            if response.status_code == 200:
-                aircraft_info = response.json()
+def _get_session():
+    ''' Returns the shared http session used for the aircraft and route lookups so connections are reused
+    '''
+    global _session
 
-                aircraft_info['TypeLong'] = aircraft_info['Type']
-                aircraft_info['Type'] = aircraft_info['Type'].split()[0]
-                aircraft_info['Military'] = ''
-            else:
-                s.log(4, f'ERROR: Failed to retrieve data from "{url}". {response.status_code} - {response.text}')
-        except MissingSchema:
-            s.log(4, f'The provided URL "{url}" is invalid')
-        except JSONDecodeError:
-            s.log(4, f'The provided URL "{url}" is not returning JSON data')
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=LOOKUP_WORKERS)
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+
+    return _session
+
+def _fetch_aircraft_info(session, icao, timeout):
+    ''' Gets the aircraft details from hexdb.io. Returns None if hexdb does not know the aircraft, any other
+        failure raises an exception so the result is not cached
+    '''
+    url = f'https://hexdb.io/api/v1/aircraft/{icao}'
+    response = session.get(url, timeout=timeout)
+
+    if response.status_code == 404:
+        return None
+
+    if response.status_code != 200:
+        raise Exception(f'Failed to retrieve data from "{url}". {response.status_code} - {response.text}')
+
+    aircraft_info = response.json()
+    if 'Type' not in aircraft_info:
+        return None
+
+    aircraft_info['TypeLong'] = aircraft_info['Type']
+    aircraft_info['Type'] = aircraft_info['Type'].split()[0] if aircraft_info['Type'] else ''
+    aircraft_info['Military'] = ''
+
+    return aircraft_info
+
+def _get_aircraft_info(icao):
+    ''' Gets the aircraft details from the local aircraft database
+    '''
+    aircraft_info = _empty_aircraft_info()
+
+    database = _get_database()
+    if database is not None:
+        row = database.execute(
+            'SELECT short_type, manufacturer, owner, registration, icao_type, military FROM aircraft WHERE icao = ?',
+            (icao.lower(),)
+        ).fetchone()
+
+        if row is not None:
+            short_type, manufacturer, owner, registration, icao_type, military = row
+            aircraft_info = {
+                'ICAOTypeCode': short_type,
+                'Manufacturer': manufacturer,
+                'ModeS': '',
+                'OperatorFlagCode': '',
+                'RegisteredOwners': owner,
+                'Registration': registration,
+                'Type': icao_type,
+                'TypeLong': icao_type,
+                'Military': 'Mil' if military else ''
+            }
     else:
-        database_dir = '/opt/allsky/modules/adsb/adsb_data'
-        icao_key = icao[:2]
-        icao_file = f'{icao_key}.json'
-        file_path = os.path.join(database_dir, icao_file)
+        aircraft_info = _get_legacy_aircraft_info(icao, aircraft_info)
 
-        try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                ac_data = json.load(file)
-
-            if icao in ac_data:
-                ac_info = ac_data[icao]
-                aircraft_info = {
-                    'ICAOTypeCode': ac_info['st'], 
-                    'Manufacturer': ac_info['m'], 
-                    'ModeS': '', 
-                    'OperatorFlagCode': '', 
-                    'RegisteredOwners': ac_info['o'], 
-                    'Registration': ac_info['r'], 
-                    'Type': ac_info['it'],
-                    'TypeLong': ac_info['it'],
-                    'Military': ''
-                }
-                if ac_info['ml']:
-                    aircraft_info['Military'] = 'Mil'
-        except FileNotFoundError:
-            pass
+    return aircraft_info
+
+def _get_database():
+    ''' Returns a read only connection to the local aircraft database, built by adsb/tools/build_database.py.
+        The connection is kept open between lookups and reopened if the database is rebuilt
+    '''
+    global _database, _database_mtime
+
+    try:
+        mtime = os.stat(ADSB_DATABASE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    if _database is None or mtime != _database_mtime:
+        if _database is not None:
+            _database.close()
+        _database = sqlite3.connect(f'file:{ADSB_DATABASE}?mode=ro', uri=True, check_same_thread=False)
+        _database_mtime = mtime
+
+    return _database
+
+def _get_legacy_aircraft_info(icao, aircraft_info):
+    ''' Reads the aircraft from the per prefix json files created by older versions of build_database.py
+    '''
+    icao_key = icao[:2]
+    icao_file = f'{icao_key}.json'
+    file_path = os.path.join(ADSB_DATABASE_DIR, icao_file)
+
+    try:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            ac_data = json.load(file)
+
+        if icao in ac_data:
+            ac_info = ac_data[icao]
+            aircraft_info = {
+                'ICAOTypeCode': ac_info['st'], 
+                'Manufacturer': ac_info['m'], 
+                'ModeS': '', 
+                'OperatorFlagCode': '', 
+                'RegisteredOwners': ac_info['o'], 
+                'Registration': ac_info['r'], 
+                'Type': ac_info['it'],
+                'TypeLong': ac_info['it'],
+                'Military': ''
+            }
+            if ac_info['ml']:
+                aircraft_info['Military'] = 'Mil'
+    except FileNotFoundError:
+        pass
 
     return aircraft_info
 
-def _get_route(flight, timeout, get_aircraft_route):
-    route_data = {
+def _empty_route():
+    return {
         'origin_icao': '',
         'origin_name': '',
         'origin_municipality': '',
@@ -571,40 +972,247 @@ def _get_route(flight, timeout, get_aircraft_route):
         'medium_route': '',
         'long_route': ''              
     }
+
+def _fetch_route(session, flight, timeout):
+    ''' Gets the route for a callsign from adsbdb.com. Returns None if there is no route, any other
+        failure raises an exception so the result is not cached
+    '''
+    url = f'https://api.adsbdb.com/v0/callsign/{flight}'
+    response = session.get(url, timeout=timeout)
+
+    if response.status_code == 404:
+        return None
+
+    if response.status_code != 200:
+        raise Exception(f'Failed to retrieve data from "{url}". {response.status_code} - {response.text}')
+
+    json_data = response.json()
+    if 'response' not in json_data or not isinstance(json_data['response'], dict) or 'flightroute' not in json_data['response']:
+        return None
+
+    route_data = _empty_route()
+    aircraft_route = json_data['response']['flightroute']
+    route_data['origin_icao'] = aircraft_route['origin']['icao_code']
+    route_data['origin_name'] = aircraft_route['origin']['name']
+    route_data['origin_municipality'] = aircraft_route['origin']['municipality']
+
+    route_data['destination_icao'] = aircraft_route['destination']['icao_code']
+    route_data['destination_name'] = aircraft_route['destination']['name']
+    route_data['destination_municipality'] = aircraft_route['destination']['municipality']
     
-    if get_aircraft_route:
-        try:
-            url = f'https://api.adsbdb.com/v0/callsign/{flight}'
-            response = requests.get(url, timeout=timeout)
-
-            if response.status_code == 200:
-                json_data = response.json()
-
-                if 'response' in json_data:
-                    if 'flightroute' in json_data['response']:
-                        aircraft_route = json_data['response']['flightroute']
-                        route_data['origin_icao'] = aircraft_route['origin']['icao_code']
-                        route_data['origin_name'] = aircraft_route['origin']['name']
-                        route_data['origin_municipality'] = aircraft_route['origin']['municipality']
-
-                        route_data['destination_icao'] = aircraft_route['destination']['icao_code']
-                        route_data['destination_name'] = aircraft_route['destination']['name']
-                        route_data['destination_municipality'] = aircraft_route['destination']['municipality']
-                        
-                        route_data['short_route'] = f'{route_data["origin_icao"]} -> {route_data["destination_icao"]}'
-                        route_data['medium_route'] = f'{route_data["origin_municipality"]} -> {route_data["destination_municipality"]}'
-                        route_data['long_route'] = f'({route_data["origin_icao"]}) {route_data["origin_name"]} -> ({route_data["destination_icao"]}) {route_data["destination_name"]}'
-
-                        route_data['medium_route'] = unidecode(route_data['medium_route'])
-                        route_data['long_route'] = unidecode(route_data['long_route'])
-
-        except Exception as data_exception:
-            exception_type, exception_object, exception_traceback = sys.exc_info()
-            result = f'ERROR: Failed to retrieve data from {url} - {exception_traceback.tb_lineno} - {data_exception}'
-            s.log(4, result)
-        
+    route_data['short_route'] = f'{route_data["origin_icao"]} -> {route_data["destination_icao"]}'
+    route_data['medium_route'] = f'{route_data["origin_municipality"]} -> {route_data["destination_municipality"]}'
+    route_data['long_route'] = f'({route_data["origin_icao"]}) {route_data["origin_name"]} -> ({route_data["destination_icao"]}) {route_data["destination_name"]}'
+
+    route_data['medium_route'] = unidecode(route_data['medium_route'])
+    route_data['long_route'] = unidecode(route_data['long_route'])
+
     return route_data
-    
+
+def _fetch_lookups(lookups, timeout, deadline):
+    ''' Fetches the lookups not in the cache concurrently. lookups is a dict of (kind, key) -> fetch function.
+
+        All of the lookups must complete within deadline seconds, any that do not are abandoned and will be
+        retried on the next run. Returns a dict of (kind, key) -> value for the completed lookups
+    '''
+    results = {}
+    if not lookups:
+        return results
+
+    session = _get_session()
+    end = time.monotonic() + deadline
+
+    def fetch(fetcher, key):
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('lookup deadline reached')
+        return fetcher(session, key, min(timeout, remaining))
+
+    executor = ThreadPoolExecutor(max_workers=min(LOOKUP_WORKERS, len(lookups)))
+    futures = {executor.submit(fetch, fetcher, lookup[1]): lookup for lookup, fetcher in lookups.items()}
+    done, not_done = wait(futures, timeout=deadline)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    for future in done:
+        kind, key = futures[future]
+        try:
+            results[(kind, key)] = future.result()
+        except Exception as e:
+            s.log(4, f'ERROR: {kind} lookup for {key} failed - {e}')
+
+    if not_done:
+        s.log(4, f'INFO: {len(not_done)} lookups did not complete within {deadline} seconds')
+
+    return results
+
+def _lookup_aircraft(aircraft_list, timeout, aircraft_data, get_aircraft_route, deadline):
+    ''' Adds the aircraft details and route to each aircraft. hexdb and adsbdb lookups are read from the
+        lookup cache, anything not cached is fetched concurrently and added to the cache.
+
+        Returns the cache hit and miss counts
+    '''
+    cache = LookupCache(LOOKUP_CACHE)
+    lookups = {}
+    waiting = {}
+
+    for aircraft in aircraft_list:
+        aircraft['info'] = _empty_aircraft_info()
+        aircraft['route'] = _empty_route()
+
+        if aircraft_data == 'Hexdb':
+            icao = aircraft['hex'].lower()
+            found, aircraft_info = cache.get('aircraft', icao)
+            if found:
+                if aircraft_info is not None:
+                    aircraft['info'] = aircraft_info
+            else:
+                lookups[('aircraft', icao)] = _fetch_aircraft_info
+                waiting.setdefault(('aircraft', icao), []).append(aircraft)
+        else:
+            aircraft['info'] = _get_aircraft_info(aircraft['hex'])
+
+        if get_aircraft_route:
+            flight = aircraft['flight'].strip()
+            found, route_data = cache.get('route', flight)
+            if found:
+                if route_data is not None:
+                    aircraft['route'] = route_data
+            else:
+                lookups[('route', flight)] = _fetch_route
+                waiting.setdefault(('route', flight), []).append(aircraft)
+
+    try:
+        results = _fetch_lookups(lookups, timeout, deadline)
+        for (kind, key), value in results.items():
+            if kind == 'aircraft':
+                cache.put(kind, key, value, AIRCRAFT_TTL if value is not None else NEGATIVE_TTL)
+            else:
+                cache.put(kind, key, value, ROUTE_TTL if value is not None else NEGATIVE_TTL)
+
+            if value is not None:
+                for aircraft in waiting[(kind, key)]:
+                    aircraft['info' if kind == 'aircraft' else 'route'] = value
+    finally:
+        cache.close()
+
+    return cache.hits, cache.misses
+
+def _save_overlay_aircraft(aircraft_list, observer_location):
+    ''' Saves the look angles of the aircraft, and their trails, for the day and night flows to draw. All of the
+        trail positions are converted to look angles in one pass
+    '''
+    trail_counts = []
+    trail_lat = []
+    trail_lon = []
+    trail_alt = []
+    for aircraft in aircraft_list:
+        # Positions without an altitude would be placed on the horizon so they are left out of the trail
+        positions = [position for position in aircraft.get('positions') or [] if position[3] is not None]
+        trail_counts.append(len(positions))
+        for position in positions:
+            trail_lat.append(position[1])
+            trail_lon.append(position[2])
+            trail_alt.append(position[3])
+
+    azimuth, elevation, _, _ = look_angles(
+        np.asarray(trail_lat, dtype=np.float64),
+        np.asarray(trail_lon, dtype=np.float64),
+        feet_to_meters(np.asarray(trail_alt, dtype=np.float64)),
+        observer_location
+    )
+
+    overlay = []
+    start = 0
+    for aircraft, count in zip(aircraft_list, trail_counts):
+        overlay.append({
+            'flight': aircraft['flight'].strip(),
+            'azimuth': aircraft['azimuth'],
+            'elevation': aircraft['elevation'],
+            'trail': np.column_stack((azimuth[start:start + count], elevation[start:start + count])).round(3).tolist()
+        })
+        start += count
+
+    try:
+        temp_file = f'{ADSB_OVERLAY_FILE}.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as file:
+            json.dump({'time': time.time(), 'aircraft': overlay}, file)
+        os.replace(temp_file, ADSB_OVERLAY_FILE)
+    except OSError as e:
+        s.log(0, f'ERROR: Unable to save the aircraft overlay data {ADSB_OVERLAY_FILE} - {e}')
+
+def _draw_aircraft(params):
+    ''' Draws the aircraft saved by the last run onto the image. The pixel positions of every marker and trail
+        point are calculated in one call and only the pixels of the markers, labels and trails are drawn.
+
+        Nothing is drawn if the saved aircraft are older than the period plus a margin, i.e. the fetches are
+        failing or the periodic flow has stopped
+    '''
+    try:
+        with open(ADSB_OVERLAY_FILE, 'r', encoding='utf-8') as file:
+            overlay = json.load(file)
+        age = time.time() - overlay['time']
+        overlay = overlay['aircraft']
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+
+    if age > int(params.get('period', 60)) + OVERLAY_MAX_AGE_MARGIN:
+        s.log(4, f'INFO: The saved aircraft are {age:.0f} seconds old, not drawing them')
+        return 0
+
+    colour_array = str(params.get('marker_colour', '255,255,0')).split(',')
+    if len(colour_array) == 3 and all(value.strip().isdigit() for value in colour_array):
+        colour = (int(colour_array[2]), int(colour_array[1]), int(colour_array[0]))
+    else:
+        colour = (0, 255, 255)
+    marker_size = int(params.get('marker_size', 8))
+    draw_labels = params.get('draw_labels', True)
+    draw_trails = params.get('draw_trails', True)
+
+
+    altitude = [aircraft['elevation'] for aircraft in overlay]
+    azimuth = [aircraft['azimuth'] for aircraft in overlay]
+    trail_counts = []
+    for aircraft in overlay:
+        trail = aircraft['trail'] if draw_trails else []
+        trail_counts.append(len(trail))
+        for trail_azimuth, trail_altitude in trail:
+            azimuth.append(trail_azimuth)
+            altitude.append(trail_altitude)
+
+    height, width = s.image.shape[:2]
+    x, y = project_to_image(
+        altitude,
+        azimuth,
+        width,
+        height,
+        int(params.get('center_x', 0)),
+        int(params.get('center_y', 0)),
+        int(params.get('radius', 0)),
+        float(params.get('camera_azimuth', 0)),
+        params.get('image_flip', 'None')
+    )
+    points = np.column_stack((x, y))
+    visible = np.asarray(altitude) >= 0
+
+    total = len(overlay)
+    trails = np.split(points[total:], np.cumsum(trail_counts)[:-1]) if total > 0 else []
+    trail_visible = np.split(visible[total:], np.cumsum(trail_counts)[:-1]) if total > 0 else []
+
+    drawn = 0
+    for index, aircraft in enumerate(overlay):
+        trail = trails[index][trail_visible[index]]
+        if len(trail) > 1:
+            cv2.polylines(s.image, [trail.reshape(-1, 1, 2)], False, colour, 1, cv2.LINE_AA)
+
+        if visible[index]:
+            marker = (int(x[index]), int(y[index]))
+            cv2.circle(s.image, marker, marker_size, colour, 2, cv2.LINE_AA)
+            if draw_labels:
+                cv2.putText(s.image, aircraft['flight'], (marker[0] + marker_size + 4, marker[1] + 4), cv2.FONT_HERSHEY_SIMPLEX, 0.5, colour, 1, cv2.LINE_AA)
+            drawn += 1
+
+    return drawn
+
 def adsb(params, event):
     ''' The entry point for the module called by the module manager
     '''
@@ -612,12 +1220,24 @@ def adsb(params, event):
     module = metaData['module']
     period = int(params['period'])
     timeout = int(params['timeout'])
+    lookup_deadline = int(params.get('lookup_deadline', 15))
     distance_limit = int(params['distance_limit'])
     data_source = params['data_source']
     local_adsb_url = params['local_adsb_url']
+    use_tracker = params.get('local_tracker', False)
     observer_altitude = int(params['observer_altitude'])
     aircraft_data = params['aircraft_data']
     get_aircraft_route = params["aricraft_route"]
+    draw_aircraft = params.get('draw_aircraft', False)
+
+    # In the day and night flows only the aircraft saved by the periodic flow are drawn, fetching them
+    # would hold up the capture
+    if event in ('day', 'night'):
+        if draw_aircraft and s.image is not None:
+            drawn = _draw_aircraft(params)
+            result = f'Drew {drawn} aircraft on the image'
+            s.log(4, f'INFO: {result}')
+        return result
 
     should_run, diff = s.shouldRun(module, period)
     if should_run:
@@ -633,7 +1253,7 @@ def adsb(params, event):
                 extra_data = {}
 
                 if data_source == 'Local':
-                    aircraft_list, result = local_adsb(local_adsb_url, observer_location, timeout)
+                    aircraft_list, result = local_adsb(local_adsb_url, observer_location, timeout, use_tracker)
 
                 if data_source == 'AirplanesLive':
                     aircraft_list, result = airplaneslive_adsb(params, observer_location, timeout)
@@ -645,30 +1265,28 @@ def adsb(params, event):
                     aircraft_list, result = adsbfi_adsb(params, observer_location, timeout)
 
                 if result == '':
-                    aircraft_list = dict(sorted(aircraft_list.items(), key=lambda item: item[1]['distance']))
+                    aircraft_list = _process_batch(aircraft_list, observer_location, distance_limit)
+
+                    cache_hits, cache_misses = _lookup_aircraft(aircraft_list, timeout, aircraft_data, get_aircraft_route, lookup_deadline)
 
                     counter = 1
-                    for aircraft in aircraft_list.values():
-                        if aircraft['distance_miles'] <= distance_limit:
-                            aircraft['info'] = _get_aircraft_info(aircraft['hex'], timeout, aircraft_data)
-                            aircraft['route'] = _get_route(aircraft['flight'].rstrip(), timeout, get_aircraft_route)
-                            
-                            extra_data[f'aircraft_{counter}_hex'] = aircraft['hex']
-                            extra_data[f'aircraft_{counter}_type'] = aircraft['info']['Type']
-                            extra_data[f'aircraft_{counter}_owner'] = aircraft['info']['RegisteredOwners']
-                            extra_data[f'aircraft_{counter}_registration'] = aircraft['info']['Registration']
-                            extra_data[f'aircraft_{counter}_manufacturer'] = aircraft['info']['Manufacturer']
-                            extra_data[f'aircraft_{counter}_military'] = aircraft['info']['Military']
-                            extra_data[f'aircraft_{counter}_text'] = f"{aircraft['flight'].strip()} {aircraft['azimuth']:.0f}°"
-                            extra_data[f'aircraft_{counter}_longtext'] = f"{aircraft['flight'].strip()} {aircraft['info']['Type']} {aircraft['azimuth']:.0f}° {aircraft['distance_miles']:.0f}Miles {aircraft['altitude']}  {aircraft['ias']}kts"
-                            extra_data[f'aircraft_{counter}_short_route'] = aircraft['route']['short_route']
-                            extra_data[f'aircraft_{counter}_medium_route'] = aircraft['route']['medium_route']
-                            extra_data[f'aircraft_{counter}_long_route'] = aircraft['route']['long_route']
-                            counter = counter + 1
-                        else:
-                            s.log(4,f'INFO: Aicraft {aircraft["flight"]} excludes as beyond {distance_limit} miles')
-                    result = f'Wrote {counter} aircraft to extra data file allskyadsb.json'
+                    for aircraft in aircraft_list:
+                        extra_data[f'aircraft_{counter}_hex'] = aircraft['hex']
+                        extra_data[f'aircraft_{counter}_type'] = aircraft['info']['Type']
+                        extra_data[f'aircraft_{counter}_owner'] = aircraft['info']['RegisteredOwners']
+                        extra_data[f'aircraft_{counter}_registration'] = aircraft['info']['Registration']
+                        extra_data[f'aircraft_{counter}_manufacturer'] = aircraft['info']['Manufacturer']
+                        extra_data[f'aircraft_{counter}_military'] = aircraft['info']['Military']
+                        extra_data[f'aircraft_{counter}_text'] = f"{aircraft['flight'].strip()} {aircraft['azimuth']:.0f}°"
+                        extra_data[f'aircraft_{counter}_longtext'] = f"{aircraft['flight'].strip()} {aircraft['info']['Type']} {aircraft['azimuth']:.0f}° {aircraft['distance_miles']:.0f}Miles {aircraft['altitude']}  {aircraft['ias']}kts"
+                        extra_data[f'aircraft_{counter}_short_route'] = aircraft['route']['short_route']
+                        extra_data[f'aircraft_{counter}_medium_route'] = aircraft['route']['medium_route']
+                        extra_data[f'aircraft_{counter}_long_route'] = aircraft['route']['long_route']
+                        counter = counter + 1
+                    result = f'Wrote {counter} aircraft to extra data file allskyadsb.json. Lookup cache {cache_hits} hits, {cache_misses} misses'
                     s.saveExtraData('allskyadsb.json', extra_data)
+                    if draw_aircraft:
+                        _save_overlay_aircraft(aircraft_list, observer_location)
                     s.setLastRun(module)
                     s.log(4,f'INFO: {result}')
                 else:
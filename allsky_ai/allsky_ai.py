@@ -10,11 +10,12 @@ import allsky_shared as s
 import os
 
 from tflite_runtime.interpreter import Interpreter
-from PIL import Image, ImageOps
 import numpy as np
+import cv2
 import datetime
 import json
 import requests
+import threading
 import time
 
 # Disable Numpy warnings
@@ -24,7 +25,7 @@ metaData = {
     "name": "AllSkyAI",
     "description": "Classify the current sky with ML. More info https://www.allskyai.com",
     "module": "allsky_ai",
-    "version": "v1.0.4",
+    "version": "v1.0.9",
     "events": [
         "day",
         "night"
@@ -33,11 +34,15 @@ metaData = {
     "arguments": {
         "camera_type": "None",
         "auto_update": "False",
+        "update_interval": 6,
         "contribute": "False",
         "use_account": "False",
         "account_auto_update": "False",
         "allsky_id": "",
-        "access_token": ""
+        "access_token": "",
+        "smoothing": "False",
+        "smoothing_frames": 5,
+        "change_threshold": 0
     },
     "argumentdetails": {
         "auto_update": {
@@ -49,6 +54,18 @@ metaData = {
                 "fieldtype": "checkbox"
             }
         },
+        "update_interval": {
+            "required": "false",
+            "description": "Update Check Interval",
+            "help": "The number of hours between checks for a new model when auto update is enabled.",
+            "tab": "Setup",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 1,
+                "max": 168,
+                "step": 1
+            }
+        },
         "camera_type": {
             "required": "true",
             "description": "Camera Type",
@@ -98,6 +115,39 @@ metaData = {
             "description": "Access Code",
             "help": "Access code, also found on AllSkyAI website",
             "tab": "AllSkyAI"
+        },
+        "smoothing": {
+            "required": "false",
+            "description": "Smooth Classification",
+            "help": "Report a classification smoothed over the last few images. This stops the classification flickering between labels on borderline skies.",
+            "tab": "Smoothing",
+            "type": {
+                "fieldtype": "checkbox"
+            }
+        },
+        "smoothing_frames": {
+            "required": "false",
+            "description": "Frames",
+            "help": "The number of previous classifications to smooth over. Older classifications carry less weight.",
+            "tab": "Smoothing",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 2,
+                "max": 20,
+                "step": 1
+            }
+        },
+        "change_threshold": {
+            "required": "false",
+            "description": "Change Threshold",
+            "help": "When smoothing is enabled the classification is skipped if the sky has changed less than this since the last classification. The change is the average difference in brightness, 0-255, of a small thumbnail. 0 always classifies the image.",
+            "tab": "Smoothing",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 20,
+                "step": 0.5
+            }
         }
     },
     "enabled": "false",
@@ -115,14 +165,88 @@ metaData = {
                 "authorurl": "https://www.allskyai.com",
                 "changes": "Bug Fixes"
             }
-        ]                               
-    }    
+        ],
+        "v1.0.5" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Cache the model and labels between runs"
+            }
+        ],
+        "v1.0.6" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Single pass crop and resize when preparing the image for the model"
+            }
+        ],
+        "v1.0.7" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Optional smoothing of the classification and skipping unchanged skies"
+            }
+        ],
+        "v1.0.8" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Upload contributed images in the background"
+            }
+        ],
+        "v1.0.9" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Rate limited, conditional model update checks and verified, atomic model downloads"
+            }
+        ]
+    }
 }
 
 MODEL_PATH = "/opt/allsky/modules/models"
 API = "https://www.allskyai.com/api/v1/allsky"
 DEBUG = False
 
+# Model updates
+UPDATE_STATE_PATH = os.path.join(MODEL_PATH, "update.json")
+VERSION_TIMEOUT = 10
+DOWNLOAD_TIMEOUT = (10, 60)
+TFLITE_SIGNATURE = (4, b"TFL3")
+
+# Images waiting to be uploaded are spooled here and uploaded by a background thread
+UPLOAD_SPOOL_PATH = os.path.join(MODEL_PATH, "upload")
+UPLOAD_QUEUE_SIZE = 5
+UPLOAD_TIMEOUT = (5, 30)
+UPLOAD_BACKOFF = 60
+UPLOAD_BACKOFF_MAX = 3600
+_uploader = {
+    "lock": threading.Lock(),
+    "thread": None,
+    "session": None,
+    "failures": 0,
+    "retry_at": 0
+}
+
+# The interpreter and labels are kept between runs and only reloaded when the model changes
+_model_cache = {
+    "key": None,
+    "interpreter": None,
+    "labels": None,
+    "input_shape": None
+}
+
+# Recent scores used to smooth the classification, see smooth_classification
+SMOOTHING_DECAY = 0.6
+THUMBNAIL_SIZE = 64
+_smoothing_state = {
+    "scores": None,
+    "count": 0,
+    "index": 0,
+    "thumbnail": None,
+    "result": None
+}
+
 
 # -------------------------------------------------------------------------------------
 # Inference
@@ -147,48 +271,36 @@ def load_labels(filename):
 
 def load_image(width, height, color_mode):
     """
-    Resize current image, so we end up with a height of 512px, then we crop the rest to get a 512x512px image.
-    For the grayscale image we need to convert it to a grayscale image since overlays can have color
-    For both types we expand the array to have [batch, width, height, channels]
-    PIL image defined as [with, height]
+    Crop the current image to the region the model needs and resize it, in a single pass, to the model input size.
+    For a square model the centre square of the image is used, the same region the previous thumbnail and crop
+    produced, otherwise the whole image is resized. The crop is a view of s.image so no full frame copy is made.
+    For the grayscale image we need to convert it to a grayscale image since overlays can have color.
+    The returned image is uint8 and in BGR order, set_input_tensor handles the conversion to the model input.
     Numpy shape defined as [height, width]
     """
-    rgb = s.image[..., ::-1].copy()
-    img = Image.fromarray(rgb)
+    h, w = s.image.shape[:2]
+
     if width == height:
-        target_size = 2048, 512
-        img.thumbnail(target_size, Image.Resampling.LANCZOS)
+        size = min(w, h)
+        x1 = (w - size) // 2
+        y1 = (h - size) // 2
+        roi = s.image[y1:y1 + size, x1:x1 + size]
     else:
-        img = img.resize((width, height), Image.Resampling.LANCZOS)
+        roi = s.image
 
-    w, h = img.size
     if DEBUG:
-        s.log(0, f"AllSkyAI: Rezied image - w:{w}, h:{h}")
-
-    if color_mode == "mono":
-        img = img.convert("L")
+        s.log(0, f"AllSkyAI: Region of interest - w:{roi.shape[1]}, h:{roi.shape[0]}")
 
-    img = np.asarray(img)
-    if DEBUG:
-        s.log(0, f"AllSkyAI: Numpy image = {img.shape}")
+    img = cv2.resize(roi, (width, height), interpolation=cv2.INTER_AREA)
 
-    if width == height:
-        x1 = int((w / 2) - 256)
-        x2 = int((w / 2) + 256)
-        img = img[:, x1:x2]
+    if color_mode == "mono" and img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    elif color_mode != "mono" and img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
 
     if DEBUG:
-        save_img = Image.fromarray(img.astype('uint8'), 'RGB')
-        save_img.save(os.path.join(MODEL_PATH, "test_out.jpg"))
-
-    img = np.asarray(img, dtype=np.float32)
-
-    # Add batch and grayscale channel. [batch, width, height, channels]
-    if color_mode == "mono":
-        img = np.expand_dims(img, 0)
-        img = np.expand_dims(img, 3)
-    else:
-        img = np.expand_dims(img, 0)
+        s.log(0, f"AllSkyAI: Numpy image = {img.shape}")
+        cv2.imwrite(os.path.join(MODEL_PATH, "test_out.jpg"), img)
 
     return img
 
@@ -199,26 +311,153 @@ def softmax(x):
 
 
 def set_input_tensor(interpreter, image):
+    """
+    Write the image straight into the interpreter's input buffer. The BGR to RGB swap and the conversion to the
+    model's input type happen during the copy. The reference to the buffer must not be held when invoke is called
+    """
     tensor_index = interpreter.get_input_details()[0]['index']
     input_tensor = interpreter.tensor(tensor_index)()[0]
-    input_tensor[:, :] = image
+    if image.ndim == 2:
+        input_tensor[..., 0] = image
+    else:
+        input_tensor[...] = image[..., ::-1]
+    del input_tensor
 
 
-def classify_image(interpreter, image):
+def predict(interpreter, image):
     set_input_tensor(interpreter, image)
 
     interpreter.invoke()
     output_details = interpreter.get_output_details()[0]
     output = np.squeeze(interpreter.get_tensor(output_details['index']))
 
-    label_index = np.argmax(output)
-    score = softmax(output)
+    return softmax(output)
+
+
+def classify_image(interpreter, image):
+    score = predict(interpreter, image)
+
+    label_index = np.argmax(score)
     confidence = 100 * np.max(score)
 
     return label_index, confidence
 
 
-def do_classification(camera_type=None):
+# -------------------------------------------------------------------------------------
+# Smoothing
+# -------------------------------------------------------------------------------------
+
+def reset_smoothing():
+    _smoothing_state["scores"] = None
+    _smoothing_state["count"] = 0
+    _smoothing_state["index"] = 0
+    _smoothing_state["thumbnail"] = None
+    _smoothing_state["result"] = None
+
+
+def get_thumbnail():
+    """
+    A small grayscale copy of the current image used to decide if the sky has changed. Nearest neighbour
+    is used so only the sampled pixels of the full image are read
+    """
+    thumbnail = cv2.resize(s.image, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_NEAREST)
+    if thumbnail.ndim == 3:
+        thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+
+    return thumbnail.astype(np.float32)
+
+
+def sky_unchanged(thumbnail, change_threshold):
+    """
+    Returns True if the sky has changed less than the threshold since the last classification
+    """
+    previous = _smoothing_state["thumbnail"]
+    if change_threshold <= 0 or previous is None or _smoothing_state["result"] is None:
+        return False
+
+    change = float(np.mean(np.abs(thumbnail - previous)))
+    s.log(4, f"AllSkyAI: Sky change since last classification {change:.2f}")
+
+    return change < change_threshold
+
+
+def smooth_classification(score, smoothing_frames):
+    """
+    Add the latest scores to a fixed size ring buffer and return the label index and confidence
+    of the exponentially weighted average of the buffer, the newest scores have the highest weight
+    """
+    scores = _smoothing_state["scores"]
+    if scores is None or scores.shape != (smoothing_frames, score.shape[0]):
+        reset_smoothing()
+        scores = np.zeros((smoothing_frames, score.shape[0]), dtype=np.float32)
+        _smoothing_state["scores"] = scores
+
+    index = _smoothing_state["index"]
+    scores[index] = score
+    _smoothing_state["index"] = (index + 1) % smoothing_frames
+    _smoothing_state["count"] = min(_smoothing_state["count"] + 1, smoothing_frames)
+
+    count = _smoothing_state["count"]
+    positions = (index - np.arange(count)) % smoothing_frames
+    weights = SMOOTHING_DECAY ** np.arange(count)
+    smoothed = np.dot(weights, scores[positions]) / weights.sum()
+
+    return np.argmax(smoothed), 100 * np.max(smoothed)
+
+
+def _model_cache_key(model_path):
+    """
+    The cache is keyed on the model file's modification time and the contents of version.txt so that
+    a model replaced by a download, or by hand, is picked up on the next run
+    """
+    version = ""
+    version_path = os.path.join(MODEL_PATH, "version.txt")
+    if os.path.exists(version_path):
+        with open(version_path, 'r') as f:
+            version = f.read().strip()
+
+    return os.stat(model_path).st_mtime_ns, version
+
+
+def invalidate_model_cache():
+    _model_cache["key"] = None
+    _model_cache["interpreter"] = None
+    _model_cache["labels"] = None
+    _model_cache["input_shape"] = None
+    reset_smoothing()
+
+
+def get_model(model_path, label_path):
+    """
+    Returns the cached interpreter, labels and input shape, loading them if the cache is empty or stale.
+    The time taken to load the model is returned, this will be 0 if the cached model was used
+    """
+    key = _model_cache_key(model_path)
+    load_time = 0.0
+
+    if _model_cache["interpreter"] is None or _model_cache["key"] != key:
+        time1 = time.time()
+        interpreter = Interpreter(model_path)
+        interpreter.allocate_tensors()
+        _, height, width, _ = interpreter.get_input_details()[0]['shape']
+        labels = load_labels(label_path)
+        load_time = np.round(time.time() - time1, 3)
+
+        reset_smoothing()
+        _model_cache["key"] = key
+        _model_cache["interpreter"] = interpreter
+        _model_cache["labels"] = labels
+        _model_cache["input_shape"] = (height, width)
+
+        s.log(1, f"AllSkyAI: Model Loaded in {load_time} seconds")
+        s.log(1, f"AllSkyAI: TF Lite input shape: {height}, {width}")
+    else:
+        s.log(4, "AllSkyAI: Using cached model")
+
+    return _model_cache["interpreter"], _model_cache["labels"], _model_cache["input_shape"], load_time
+
+
+def do_classification(camera_type=None, smoothing=False, smoothing_frames=5, change_threshold=0):
     model_path = os.path.join(MODEL_PATH, "allskyai.tflite")
     label_path = os.path.join(MODEL_PATH, "allskyai.txt")
 
@@ -229,36 +468,60 @@ def do_classification(camera_type=None):
         s.log(1, "Could not run inference, model or label file does not exists")
         return data_json
 
-    interpreter = Interpreter(model_path)
-    s.log(1, "AllSkyAI: Model Loaded")
+    interpreter, labels, (height, width), load_time = get_model(model_path, label_path)
+    if not labels:
+        invalidate_model_cache()
+        return data_json
 
-    interpreter.allocate_tensors()
-    _, height, width, _ = interpreter.get_input_details()[0]['shape']
-    s.log(1, f"AllSkyAI: TF Lite input shape: {height}, {width}")
+    if smoothing:
+        thumbnail = get_thumbnail()
+        if sky_unchanged(thumbnail, change_threshold):
+            s.log(1, "AllSkyAI: Sky unchanged, using previous classification")
+            data_json = dict(_smoothing_state["result"])
+            data_json['AI_UTC'] = get_utc_timestamp()
+            data_json['AI_INFERENCE'] = 0.0
+            data_json['AI_MODEL_LOAD'] = load_time
+            data_json['AI_SKIPPED'] = True
+            return data_json
 
     # Load an image to be classified.
     img_array = load_image(width=width, height=height, color_mode=camera_type)
 
     # Classify the image.
     time1 = time.time()
-    label_id, confidence = classify_image(interpreter, img_array)
+    score = predict(interpreter, img_array)
 
     time2 = time.time()
     classification_time = np.round(time2 - time1, 3)
 
     s.log(1, f"AllSkyAI: Classificaiton Time = {classification_time} seconds.")
 
-    # Read class labels.
-    labels = load_labels(label_path)
+    label_id = np.argmax(score)
+    confidence = 100 * np.max(score)
     classification_label = labels[label_id]
 
     s.log(1, f"AllSkyAI: {classification_label}, Confidence: {confidence}%")
 
     data_json = dict()
-    data_json['AI_CLASSIFICATION'] = classification_label
-    data_json['AI_CONFIDENCE'] = round(confidence, 3)
+    if smoothing:
+        smoothed_id, smoothed_confidence = smooth_classification(score, smoothing_frames)
+        s.log(1, f"AllSkyAI: Smoothed {labels[smoothed_id]}, Confidence: {smoothed_confidence}%")
+
+        data_json['AI_CLASSIFICATION'] = labels[smoothed_id]
+        data_json['AI_CONFIDENCE'] = round(smoothed_confidence, 3)
+        data_json['AI_RAW_CLASSIFICATION'] = classification_label
+        data_json['AI_RAW_CONFIDENCE'] = round(confidence, 3)
+    else:
+        data_json['AI_CLASSIFICATION'] = classification_label
+        data_json['AI_CONFIDENCE'] = round(confidence, 3)
     data_json['AI_UTC'] = get_utc_timestamp()
     data_json['AI_INFERENCE'] = classification_time
+    data_json['AI_MODEL_LOAD'] = load_time
+
+    if smoothing:
+        data_json['AI_SKIPPED'] = False
+        _smoothing_state["thumbnail"] = thumbnail
+        _smoothing_state["result"] = dict(data_json)
 
     return data_json
 
@@ -301,103 +564,333 @@ def check_versions(server_version):
 
 
 def upload_image(allsky_id, access_token):
+    """
+    Queue the current image for upload to AllSkyAI. The image is resized and encoded in memory and written to the
+    upload spool, the oldest queued image is dropped if the spool is full. The upload itself happens in a background
+    thread so a slow server does not hold up the capture
+    """
     target_size = 3096, 1024
-    tmp_path = os.path.join(MODEL_PATH, "tmp.jpg")
 
-    # Convert BRG to RGB
-    rgb = s.image[..., ::-1].copy()
-    img = Image.fromarray(rgb)
-    img.thumbnail(target_size, Image.Resampling.LANCZOS)
-    img.save(os.path.join(MODEL_PATH, "tmp.jpg"))
+    h, w = s.image.shape[:2]
+    scale = min(target_size[0] / w, target_size[1] / h, 1.0)
+    if scale < 1.0:
+        img = cv2.resize(s.image, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    else:
+        img = s.image
+
+    ok, encoded = cv2.imencode(".jpg", img)
+    if not ok:
+        s.log(1, "AllSkyAI: Could not encode image for upload")
+        return
+
+    os.makedirs(UPLOAD_SPOOL_PATH, exist_ok=True)
+    spool_file = os.path.join(UPLOAD_SPOOL_PATH, f"{current_milli_time()}.jpg")
+    with open(spool_file + ".tmp", 'wb') as f:
+        f.write(encoded.tobytes())
+    os.replace(spool_file + ".tmp", spool_file)
+
+    queued = get_queued_uploads()
+    for old_file in queued[:-UPLOAD_QUEUE_SIZE]:
+        s.log(1, f"AllSkyAI: Upload queue full, dropping {os.path.basename(old_file)}")
+        try:
+            os.remove(old_file)
+        except FileNotFoundError:
+            pass
+
+    start_uploader(allsky_id, access_token)
+
+
+def get_queued_uploads():
+    if not os.path.isdir(UPLOAD_SPOOL_PATH):
+        return []
+
+    return sorted(os.path.join(UPLOAD_SPOOL_PATH, f) for f in os.listdir(UPLOAD_SPOOL_PATH) if f.endswith(".jpg"))
+
+
+def start_uploader(allsky_id, access_token):
+    """
+    Start the background upload thread if there are images waiting and it is not already running
+    """
+    with _uploader["lock"]:
+        if _uploader["thread"] is not None and _uploader["thread"].is_alive():
+            return
+
+        if time.time() < _uploader["retry_at"] or not get_queued_uploads():
+            return
+
+        _uploader["thread"] = threading.Thread(target=upload_worker, args=(allsky_id, access_token), daemon=True)
+        _uploader["thread"].start()
+
+
+def upload_worker(allsky_id, access_token):
+    """
+    Upload the queued images, oldest first. On a failure the remaining images are left in the queue and
+    uploading backs off, doubling the delay on each consecutive failure
+    """
+    if _uploader["session"] is None:
+        _uploader["session"] = requests.Session()
 
     url = API + '/upload'
     headers = {"AllSkyAI-Id": allsky_id, "AllSkyAI-Access-Token": access_token}
-    with open(tmp_path, 'rb') as img:
-        name_img = os.path.basename(tmp_path)
-        files = {'image': (name_img, img, 'image/jpg')}
-        with requests.Session() as sess:
-            r = sess.post(url, files=files, headers=headers)
-            if r.status_code == 200:
-                s.log(1, "AllSkyAI: Uploaded image to AllSkyAI")
-            else:
-                s.log(1, "AllSkyAI: Could not upload image to AllSkyAI")
 
+    for spool_file in get_queued_uploads():
+        try:
+            with open(spool_file, 'rb') as img:
+                files = {'image': (os.path.basename(spool_file), img, 'image/jpg')}
+                r = _uploader["session"].post(url, files=files, headers=headers, timeout=UPLOAD_TIMEOUT)
+        except FileNotFoundError:
+            # Dropped from the queue while we were uploading
+            continue
+        except Exception as e:
+            s.log(1, f"AllSkyAI: Could not upload image to AllSkyAI - {e}")
+            upload_backoff()
+            return
+
+        if r.status_code == 200:
+            s.log(1, "AllSkyAI: Uploaded image to AllSkyAI")
+            _uploader["failures"] = 0
+        elif 400 <= r.status_code < 500 and r.status_code != 429:
+            s.log(1, f"AllSkyAI: Upload rejected by AllSkyAI ({r.status_code}), dropping image")
+        else:
+            s.log(1, f"AllSkyAI: Could not upload image to AllSkyAI ({r.status_code})")
+            upload_backoff()
+            return
+
+        try:
+            os.remove(spool_file)
+        except FileNotFoundError:
+            pass
 
-def download_general_model(camera_type):
-    mapping = {
-        API + "/getGeneralLabels?cameraType=" + camera_type: os.path.join(MODEL_PATH, "allskyai.txt"),
-        API + "/getGeneralModel?cameraType=" + camera_type: os.path.join(MODEL_PATH, "allskyai.tflite"),
-        API + "/getGeneralModelVersion?cameraType=" + camera_type: os.path.join(MODEL_PATH, "version.txt")
-    }
 
-    for url, target in mapping.items():
+def upload_backoff():
+    _uploader["failures"] += 1
+    delay = min(UPLOAD_BACKOFF * (2 ** (_uploader["failures"] - 1)), UPLOAD_BACKOFF_MAX)
+    _uploader["retry_at"] = time.time() + delay
+    s.log(1, f"AllSkyAI: Retrying uploads in {delay} seconds")
+
+
+# allsky_ai and allsky_raindetector carry identical copies of ModelArtifacts. The module installer copies each
+# module as a single file, so there is nowhere they can import a shared copy from. Change both copies together.
+class ModelArtifacts:
+    """
+    Keeps the files of a downloaded model up to date. Version checks are rate limited and conditional, they send
+    the ETag and Last-Modified of the previous check so an unchanged version costs a 304. New files are only
+    swapped in once every one of them has downloaded and been verified, and the version file is written last so
+    an interrupted update is retried.
+
+    :param name: Name used in the log messages
+    :param state_path: File holding the url, time and validators of the last version check
+    :param version_path: Local version file
+    :param version_timeout: Timeout in seconds for the version check
+    :param download_timeout: requests timeout for each file download
+    """
+
+    def __init__(self, name, state_path, version_path, version_timeout, download_timeout):
+        self.name = name
+        self.state_path = state_path
+        self.version_path = version_path
+        self.version_timeout = version_timeout
+        self.download_timeout = download_timeout
+
+    def read_state(self):
         try:
-            s.log(1, f"AllSkyAI: Downloading {url}")
-            r = requests.get(url)
-            if r.status_code == 200:
-                with open(target, 'wb') as f:
-                    f.write(r.content)
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_state(self, state):
+        with open(self.state_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def local_version(self):
+        try:
+            with open(self.version_path, "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def check_for_update(self, version_url, interval, is_newer, force=False):
+        """
+        Returns the server's version if is_newer(version) is True, otherwise None. Unless forced the check is
+        only made once every interval seconds for the same version_url.
+        """
+        import requests
+
+        state = self.read_state()
+        now = time.time()
+        same_url = state.get("url") == version_url
+        if not force and same_url and now - state.get("last_check", 0) < interval:
+            return None
+
+        headers = {}
+        if not force and same_url:
+            if state.get("etag"):
+                headers["If-None-Match"] = state["etag"]
+            if state.get("last_modified"):
+                headers["If-Modified-Since"] = state["last_modified"]
+
+        remote_version = None
+        try:
+            r = requests.get(version_url, headers=headers, timeout=self.version_timeout)
+            if r.status_code == 304:
+                s.log(1, f"{self.name}: Model is up to date")
+            elif r.status_code == 200 and 0 < len(r.text.strip()) < 64:
+                version = r.text.strip()
+                if is_newer(version):
+                    remote_version = version
+                else:
+                    s.log(1, f"{self.name}: Model is up to date")
+                # Only remember the validators once we have the current model, so a failed download is retried
+                state["etag"] = "" if remote_version else r.headers.get("ETag", "")
+                state["last_modified"] = "" if remote_version else r.headers.get("Last-Modified", "")
             else:
-                s.log(0, f"AllSkyAI Error: {r.content}")
-        except:
-            s.log(0, f"AllSkyAI download error")
+                s.log(0, f"{self.name} Error: Version check failed ({r.status_code})")
+        except Exception as e:
+            s.log(0, f"{self.name} Error: Version check failed - {e}")
 
+        state["url"] = version_url
+        state["last_check"] = now
+        try:
+            self.write_state(state)
+        except OSError as e:
+            s.log(0, f"{self.name} Error: Could not save the update state - {e}")
 
-def download_user_model(allsky_id, access_token):
-    mapping = {
-        API + "/getUserLabels?allsky_id=" + allsky_id + "&access_token=" + access_token: os.path.join(MODEL_PATH,
-                                                                                                      "allskyai.txt"),
-        API + "/getUserModel?allsky_id=" + allsky_id + "&access_token=" + access_token: os.path.join(MODEL_PATH,
-                                                                                                     "allskyai.tflite"),
-        API + "/getUserVersion?allsky_id=" + allsky_id + "&access_token=" + access_token: os.path.join(MODEL_PATH,
-                                                                                                       "version.txt")
-    }
+        return remote_version
+
+    def download_file(self, url, target, min_size, signature=None):
+        """
+        Stream url to a temporary file next to target. The temporary path is only returned if the download
+        completed, matches the size the server reported, is at least min_size bytes and, if given, has the
+        (offset, magic) signature.
+        """
+        import requests
 
-    for url, target in mapping.items():
+        part_path = target + ".part"
         try:
-            s.log(1, f"AllSkyAI: Downloading {url}")
-            r = requests.get(url)
-            if r.status_code == 200:
-                with open(target, 'wb') as f:
-                    f.write(r.content)
-            else:
-                s.log(0, f"AllSkyAI Error: {r.content.decode()}")
-        except:
-            s.log(0, f"AllSkyAI: Download error")
+            s.log(1, f"{self.name}: Downloading {url}")
+            with requests.get(url, stream=True, timeout=self.download_timeout) as r:
+                if r.status_code != 200:
+                    raise RuntimeError(f"download failed ({r.status_code})")
+                size = 0
+                with open(part_path, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=65536):
+                        f.write(chunk)
+                        size += len(chunk)
+                expected = r.headers.get("Content-Length")
+                if expected is not None and "Content-Encoding" not in r.headers and int(expected) != size:
+                    raise RuntimeError(f"incomplete download, got {size} of {expected} bytes")
+            if size < min_size:
+                raise RuntimeError(f"download is too small ({size} bytes)")
+            if signature is not None:
+                offset, magic = signature
+                with open(part_path, "rb") as f:
+                    if f.read(offset + len(magic))[offset:] != magic:
+                        raise RuntimeError("download is not a valid file")
+        except Exception as e:
+            s.log(0, f"{self.name} Error: {url} - {e}")
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return None
+        return part_path
+
+    def download(self, artifacts, version):
+        """
+        Download the (url, target, min_size, signature) artifacts and only replace the existing files once all
+        of them are verified. The version, if known, is written last. Returns True if the files were replaced.
+        """
+        downloaded = []
+        for url, target, min_size, signature in artifacts:
+            part_path = self.download_file(url, target, min_size, signature)
+            if part_path is None:
+                for part_path, _ in downloaded:
+                    os.remove(part_path)
+                return False
+            downloaded.append((part_path, target))
+
+        for part_path, target in downloaded:
+            os.replace(part_path, target)
+
+        if version is not None:
+            with open(self.version_path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(version)
+            os.replace(self.version_path + ".tmp", self.version_path)
+        return True
+
+
+_model_artifacts = ModelArtifacts("AllSkyAI", UPDATE_STATE_PATH, os.path.join(MODEL_PATH, "version.txt"),
+                                  VERSION_TIMEOUT, DOWNLOAD_TIMEOUT)
+
+
+def download_model(labels_url, model_url, version):
+    if _model_artifacts.download([
+        (labels_url, os.path.join(MODEL_PATH, "allskyai.txt"), 1, None),
+        (model_url, os.path.join(MODEL_PATH, "allskyai.tflite"), 1024, TFLITE_SIGNATURE)
+    ], version):
+        invalidate_model_cache()
 
 
-def general_model_precheck(camera_type, auto_update):
+def download_general_model(camera_type, version):
+    download_model(
+        API + "/getGeneralLabels?cameraType=" + camera_type,
+        API + "/getGeneralModel?cameraType=" + camera_type,
+        version
+    )
+
+
+def download_user_model(allsky_id, access_token, version):
+    download_model(
+        API + "/getUserLabels?allsky_id=" + allsky_id + "&access_token=" + access_token,
+        API + "/getUserModel?allsky_id=" + allsky_id + "&access_token=" + access_token,
+        version
+    )
+
+
+def first_version(version_url):
+    """
+    Get the server's version before the first download, the model is only downloaded once the version is known
+    so a failed check is retried on the next run
+    """
+    return _model_artifacts.check_for_update(version_url, 0, lambda version: True, force=True)
+
+
+def general_model_precheck(camera_type, auto_update, update_interval):
     if not os.path.exists(MODEL_PATH):
         os.makedirs(MODEL_PATH)
 
     # If version file doesn't exist, download all files
     if not os.path.exists(os.path.join(MODEL_PATH, "version.txt")):
         s.log(1, f"AllSkyAI: Downloading general model for {camera_type}")
-        download_general_model(camera_type=camera_type)
+        version = first_version(API + "/getGeneralModelVersion?cameraType=" + camera_type)
+        if version is not None:
+            download_general_model(camera_type=camera_type, version=version)
         return
 
     if auto_update:
-        r = requests.get(API + "/getGeneralModelVersion?cameraType=" + camera_type)
-        update = check_versions(r.content.decode())
-        if update:
-            download_general_model(camera_type=camera_type)
+        version = _model_artifacts.check_for_update(API + "/getGeneralModelVersion?cameraType=" + camera_type,
+                                                    update_interval * 3600, check_versions)
+        if version is not None:
+            download_general_model(camera_type=camera_type, version=version)
 
 
-def user_account_precheck(camera_type, account_auto_update, allsky_id, access_token):
+def user_account_precheck(camera_type, account_auto_update, allsky_id, access_token, update_interval):
     if not os.path.exists(MODEL_PATH):
         os.makedirs(MODEL_PATH)
 
     # If version file doesn't exist, download all files
     if not os.path.exists(os.path.join(MODEL_PATH, "version.txt")):
         s.log(1, f"AllSkyAI: Downloading model for {allsky_id}")
-        download_user_model(allsky_id=allsky_id, access_token=access_token)
+        version = first_version(API + "/getUserVersion?allsky_id=" + allsky_id + "&access_token=" + access_token)
+        if version is not None:
+            download_user_model(allsky_id=allsky_id, access_token=access_token, version=version)
         return
 
     if account_auto_update:
-        r = requests.get(API + "/getUserVersion?allsky_id=" + allsky_id + "&accessToken=" + access_token)
-        update = check_versions(r.content.decode())
-        if update:
-            download_user_model(allsky_id=allsky_id, access_token=access_token)
+        version = _model_artifacts.check_for_update(API + "/getUserVersion?allsky_id=" + allsky_id + "&accessToken=" + access_token,
+                                                    update_interval * 3600, check_versions)
+        if version is not None:
+            download_user_model(allsky_id=allsky_id, access_token=access_token, version=version)
 
 
 # -------------------------------------------------------------------------------------
@@ -408,14 +901,15 @@ def current_milli_time():
 
 def check_time_elapsed(allsky_id, access_token):
     if time.time() - (s.dbGet("allskyai_last_publish") / 1000) > 600:
-        s.log(1, f"Uploading image to AllSkyAI")
+        s.log(1, f"Queueing image for upload to AllSkyAI")
         upload_image(allsky_id, access_token)
         s.dbUpdate("allskyai_last_publish", current_milli_time())
 
 
 # -------------------------------------------------------------------------------------
 
-def run(camera_type, contribute, auto_update, use_account, account_auto_update, allsky_id, access_token):
+def run(camera_type, contribute, auto_update, use_account, account_auto_update, allsky_id, access_token,
+        update_interval, smoothing, smoothing_frames, change_threshold):
     if use_account:
         s.log(1, "Using AllSkyAI account")
         if not allsky_id:
@@ -425,19 +919,23 @@ def run(camera_type, contribute, auto_update, use_account, account_auto_update,
             return "No AllSkyAI Access Token supplied"
 
         user_account_precheck(camera_type=camera_type, account_auto_update=account_auto_update, allsky_id=allsky_id,
-                              access_token=access_token)
+                              access_token=access_token, update_interval=update_interval)
 
     else:
-        general_model_precheck(camera_type=camera_type, auto_update=auto_update)
+        general_model_precheck(camera_type=camera_type, auto_update=auto_update, update_interval=update_interval)
 
     # Run prediction
-    result = do_classification(camera_type=camera_type)
+    result = do_classification(camera_type=camera_type, smoothing=smoothing, smoothing_frames=smoothing_frames,
+                               change_threshold=change_threshold)
 
     if bool(result):
         s.saveExtraData("allskyai.json", result)
         s.log(1, f"AllSkyAI: {json.dumps(result)}")
 
     # Check elapsed time. We will only upload an image every 10 minutes
+    if use_account or contribute:
+        start_uploader(allsky_id=allsky_id, access_token=access_token)
+
     if use_account:
         if not s.dbHasKey("allskyai_last_publish"):
             s.dbAdd("allskyai_last_publish", current_milli_time())
@@ -462,6 +960,10 @@ def ai(params, event):
     account_auto_update = params["account_auto_update"]
     allsky_id = params["allsky_id"]
     access_token = params["access_token"]
+    update_interval = float(params.get("update_interval", 6))
+    smoothing = params.get("smoothing", False)
+    smoothing_frames = max(2, int(params.get("smoothing_frames", 5)))
+    change_threshold = float(params.get("change_threshold", 0))
 
     if camera_type == "none":
         s.log(0, "ERROR: Camera type not set, check AllSkyAI settings...")
@@ -475,7 +977,11 @@ def ai(params, event):
             use_account=use_account,
             account_auto_update=account_auto_update,
             allsky_id=allsky_id,
-            access_token=access_token
+            access_token=access_token,
+            update_interval=update_interval,
+            smoothing=smoothing,
+            smoothing_frames=smoothing_frames,
+            change_threshold=change_threshold
             )
     elif s.TOD == "night":
         run(camera_type=camera_type,
@@ -484,7 +990,11 @@ def ai(params, event):
             use_account=use_account,
             account_auto_update=account_auto_update,
             allsky_id=allsky_id,
-            access_token=access_token
+            access_token=access_token,
+            update_interval=update_interval,
+            smoothing=smoothing,
+            smoothing_frames=smoothing_frames,
+            change_threshold=change_threshold
             )
 
     return "AllSkyAI executed!"
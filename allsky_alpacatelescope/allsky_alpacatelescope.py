@@ -1,18 +1,21 @@
 """
-alpacatelescope.py - v0.1.8
+alpacatelescope.py - v0.2.0
 A 'Allsky' module to mark the telescope positions via Alpaca API.
 Based on the original telescope marker module!
 """
 import allsky_shared as s
 import numpy as np
-import json, cv2, ast
-from urllib.request import urlopen
+import json, cv2, ast, os, hashlib, threading, time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
 
 metaData = {
     "name": "Alpaca Telescope",
     "description": "Visualizes telescope position via ASCOM Alpaca Alt/Az data.",
     "module": "alpacatelescope",
-    "version": "v0.1.8",
+    "version": "v0.2.0",
     "events": ["night", "day"],
     "experimental": "false",
     "arguments":{
@@ -24,12 +27,16 @@ metaData = {
         "center_y": "0",
         "radius_override": "0",
         "image_flip": "None",
+        "lens": "Equidistant",
         "telescope_marker_radius": "30",
         "telescope_marker_width": "5",
         "telescope_marker_color": "(255,0,255)",
         "debug": "false",
         "extradatafilename": "alpacatelescope.json",
-        "telescope_default": "(0.0,0.0)"
+        "telescope_default": "(0.0,0.0)",
+        "poll_interval": "5",
+        "timeout": "1.5",
+        "max_age": "60"
     },
     "argumentdetails": {
         "telescope_server": { "required": "true", "description": "Alpaca Server URL", "help": "e.g. http://192.168.1.50:11111" },
@@ -45,6 +52,11 @@ metaData = {
             "type": { "fieldtype": "select", "values": "None,Horizontal,Vertical,Both", "default": "None" },
             "help": "Matches coordinate math to your image flip settings."
         },
+        "lens": {
+            "description": "Lens Projection",
+            "type": { "fieldtype": "select", "values": "Equidistant,Equisolid,Orthographic", "default": "Equidistant" },
+            "help": "How the lens maps altitude to distance from the zenith."
+        },
         "telescope_marker_radius": { "description": "Marker Radius (px)", "help": "Size of the telescope marker circle." },
         "telescope_marker_width": { "description": "Marker Thickness (px)", "help": "Line thickness of the marker." },
         "telescope_marker_color": { "description": "Marker Color (B,G,R)", "help": "BGR format, e.g. (0,0,255) for Red." },
@@ -54,21 +66,357 @@ metaData = {
             "help": "Draws horizon (yellow), zenith (cyan) and north line (red)." 
         },
         "extradatafilename": { "description": "Extra Data Filename", "help": "Filename for overlay data (JSON)." },
-        "telescope_default": { "description": "Fallback (Alt,Az)", "help": "Default position if server is offline." }
+        "telescope_default": { "description": "Fallback (Alt,Az)", "help": "Default position if server is offline." },
+        "poll_interval": {
+            "description": "Poll Interval (s)",
+            "type": { "fieldtype": "spinner", "min": 1, "max": 60, "step": 1 },
+            "help": "How often the telescope is polled in the background while the module stays loaded."
+        },
+        "timeout": {
+            "description": "Request Timeout (s)",
+            "type": { "fieldtype": "spinner", "min": 0.2, "max": 10, "step": 0.1 },
+            "help": "Timeout for each Alpaca request. All requests are made at the same time."
+        },
+        "max_age": {
+            "description": "Stale After (s)",
+            "type": { "fieldtype": "spinner", "min": 1, "max": 3600, "step": 1 },
+            "help": "The last known position is used if the server does not respond. After this many seconds it is marked as stale."
+        }
     }
 }
 
-def get_alpaca_value(base_url, endpoint):
+FISHEYE_STEPS = 100
+FISHEYE_INVALID = np.iinfo(np.int16).min
+FISHEYE_CACHE_FILES = 8
+
+class FisheyeProjection:
+    """
+    Converts between altitude/azimuth and pixel positions in a fisheye image with the zenith at
+    the centre and the horizon radius pixels from it.
+
+    Lookup tables of the distance from the centre for each 0.01° of altitude, and the direction
+    for each 0.01° of azimuth, are built once per geometry so any number of points can be projected
+    with one indexing operation. The inverse maps, the altitude and azimuth of every pixel, are
+    only built when first needed. They are cached on disk, keyed by the geometry, and memory mapped.
+
+    :param center_x, center_y: Zenith position in pixels, 0 for the image centre
+    :param radius: Distance from the zenith to the horizon in pixels, 0 for half the smallest image dimension
+    :param camera_azimuth: Azimuth at the top of the image in degrees
+    :param flip: None, Horizontal, Vertical or Both
+    :param lens: equidistant, equisolid or orthographic
+    :param cache_dir: Folder for the inverse maps, None to keep them in memory only
+    """
+    LENSES = ("equidistant", "equisolid", "orthographic")
+
+    def __init__(self, width, height, center_x=0, center_y=0, radius=0, camera_azimuth=0, flip="None", lens="equidistant", cache_dir=None):
+        self.lens = lens.lower()
+        if self.lens not in self.LENSES:
+            raise ValueError(f"Unknown lens model {lens}")
+
+        self.width = width
+        self.height = height
+        self.radius = radius if radius > 0 else min(width, height) / 2
+        self.camera_azimuth = camera_azimuth
+        self.flip = flip
+        self.cache_dir = cache_dir
+
+        center_x = center_x if center_x > 0 else width / 2
+        center_y = center_y if center_y > 0 else height / 2
+        self.x_sign = 1
+        self.y_sign = 1
+        if flip in ("Horizontal", "Both"):
+            center_x = width - center_x
+            self.x_sign = -1
+        if flip in ("Vertical", "Both"):
+            center_y = height - center_y
+            self.y_sign = -1
+        self.center_x = center_x
+        self.center_y = center_y
+
+        # Altitudes from -90° to 90° so positions below the horizon are placed outside it
+        altitude = np.arange(-90 * FISHEYE_STEPS, 90 * FISHEYE_STEPS + 1) / FISHEYE_STEPS
+        self._distance = self._zenith_to_distance(90.0 - altitude).astype(np.float32)
+        azimuth = np.radians(np.arange(360 * FISHEYE_STEPS) / FISHEYE_STEPS - camera_azimuth)
+        self._direction_x = (self.x_sign * np.sin(azimuth)).astype(np.float32)
+        self._direction_y = (-self.y_sign * np.cos(azimuth)).astype(np.float32)
+
+        self._altitude_map = None
+        self._azimuth_map = None
+
+    def _zenith_to_distance(self, zenith):
+        zenith = np.radians(zenith)
+        if self.lens == "equidistant":
+            return zenith / (np.pi / 2) * self.radius
+        if self.lens == "equisolid":
+            return np.sin(zenith / 2) / np.sin(np.pi / 4) * self.radius
+        # sin() folds back past the horizon, so below it the distance is mirrored outwards instead
+        return np.where(zenith <= np.pi / 2, np.sin(zenith), 2 - np.sin(zenith)) * self.radius
+
+    def _distance_to_zenith(self, distance):
+        """ Returns nan for distances beyond the edge of the lens """
+        ratio = distance / self.radius
+        with np.errstate(invalid="ignore"):
+            if self.lens == "equidistant":
+                zenith = ratio * (np.pi / 2)
+            elif self.lens == "equisolid":
+                zenith = 2 * np.arcsin(ratio * np.sin(np.pi / 4))
+            else:
+                zenith = np.arcsin(ratio)
+        return np.degrees(zenith)
+
+    def project(self, altitude, azimuth):
+        """
+        Returns integer arrays of the x and y pixel positions for altitudes and azimuths in degrees.
+        Scalars or arrays of any shape can be used.
+        """
+        altitude_index = np.rint((np.asarray(altitude, dtype=np.float64) + 90) * FISHEYE_STEPS)
+        altitude_index = np.clip(altitude_index, 0, len(self._distance) - 1).astype(np.intp)
+        azimuth_index = np.rint(np.asarray(azimuth, dtype=np.float64) * FISHEYE_STEPS).astype(np.intp) % len(self._direction_x)
+
+        distance = self._distance[altitude_index]
+        x = self.center_x + distance * self._direction_x[azimuth_index]
+        y = self.center_y + distance * self._direction_y[azimuth_index]
+
+        return np.rint(x).astype(np.int32), np.rint(y).astype(np.int32)
+
+    def altaz(self, x, y):
+        """
+        Returns float arrays of the altitude and azimuth, in degrees, of pixel positions. Positions
+        outside the image or beyond the edge of the lens are nan.
+        """
+        altitude_map, azimuth_map = self.inverse_maps()
+        x = np.asarray(x, dtype=np.intp)
+        y = np.asarray(y, dtype=np.intp)
+        inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        x = np.where(inside, x, 0)
+        y = np.where(inside, y, 0)
+
+        altitude = altitude_map[y, x]
+        valid = inside & (altitude != FISHEYE_INVALID)
+        altitude = np.where(valid, altitude / FISHEYE_STEPS, np.nan)
+        azimuth = np.where(valid, azimuth_map[y, x] / FISHEYE_STEPS, np.nan)
+        return altitude, azimuth
+
+    def cache_key(self):
+        geometry = (self.width, self.height, self.center_x, self.center_y, self.radius, self.camera_azimuth, self.flip, self.lens, FISHEYE_STEPS)
+        return hashlib.sha1(repr(geometry).encode("utf-8")).hexdigest()[:16]
+
+    def inverse_maps(self):
+        """
+        Returns the altitude (int16) and azimuth (uint16) of every pixel in 0.01° steps, FISHEYE_INVALID
+        marks pixels beyond the edge of the lens. Loaded from the disk cache if possible.
+        """
+        if self._altitude_map is None:
+            altitude_path = azimuth_path = None
+            if self.cache_dir is not None:
+                key = self.cache_key()
+                altitude_path = os.path.join(self.cache_dir, f"fisheye_{key}_altitude.npy")
+                azimuth_path = os.path.join(self.cache_dir, f"fisheye_{key}_azimuth.npy")
+                try:
+                    altitude_map = np.load(altitude_path, mmap_mode="r")
+                    azimuth_map = np.load(azimuth_path, mmap_mode="r")
+                    if altitude_map.shape == azimuth_map.shape == (self.height, self.width):
+                        self._altitude_map, self._azimuth_map = altitude_map, azimuth_map
+                except (OSError, ValueError):
+                    pass
+
+            if self._altitude_map is None:
+                self._altitude_map, self._azimuth_map = self._build_inverse_maps(altitude_path, azimuth_path)
+
+        return self._altitude_map, self._azimuth_map
+
+    def _build_inverse_maps(self, altitude_path, azimuth_path):
+        """ The maps are written straight into the cache files, a block of rows at a time, so a full
+            resolution float image is never needed """
+        shape = (self.height, self.width)
+        maps = None
+        if altitude_path is not None:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                maps = (
+                    np.lib.format.open_memmap(f"{altitude_path}.tmp", mode="w+", dtype=np.int16, shape=shape),
+                    np.lib.format.open_memmap(f"{azimuth_path}.tmp", mode="w+", dtype=np.uint16, shape=shape)
+                )
+            except OSError:
+                maps = None
+        if maps is None:
+            maps = (np.empty(shape, dtype=np.int16), np.empty(shape, dtype=np.uint16))
+        altitude_map, azimuth_map = maps
+
+        east = ((np.arange(self.width, dtype=np.float32) - self.center_x) * self.x_sign)[None, :]
+        for top in range(0, self.height, 256):
+            bottom = min(top + 256, self.height)
+            north = ((self.center_y - np.arange(top, bottom, dtype=np.float32)) * self.y_sign)[:, None]
+
+            altitude = np.rint((90.0 - self._distance_to_zenith(np.hypot(east, north))) * FISHEYE_STEPS)
+            altitude_map[top:bottom] = np.where(np.isnan(altitude), FISHEYE_INVALID, altitude)
+            azimuth = np.degrees(np.arctan2(east, north)) + self.camera_azimuth
+            azimuth_map[top:bottom] = np.rint(azimuth % 360 * FISHEYE_STEPS) % (360 * FISHEYE_STEPS)
+
+        if isinstance(altitude_map, np.memmap):
+            try:
+                altitude_map.flush()
+                azimuth_map.flush()
+                os.replace(f"{altitude_path}.tmp", altitude_path)
+                os.replace(f"{azimuth_path}.tmp", azimuth_path)
+                self._prune_cache()
+            except OSError:
+                pass
+
+        return altitude_map, azimuth_map
+
+    def _prune_cache(self):
+        """ Keeps the maps for the FISHEYE_CACHE_FILES most recently built geometries """
+        files = sorted(
+            (entry for entry in os.scandir(self.cache_dir) if entry.name.startswith("fisheye_") and entry.name.endswith(".npy")),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True
+        )
+        for entry in files[FISHEYE_CACHE_FILES * 2:]:
+            os.remove(entry.path)
+
+@lru_cache(maxsize=4)
+def get_projection(width, height, center_x=0, center_y=0, radius=0, camera_azimuth=0, flip="None", lens="equidistant"):
+    """ Returns a FisheyeProjection for the image geometry, reused while the geometry is unchanged """
+    cache_dir = os.path.join(s.getEnvironmentVariable("ALLSKY_HOME"), "tmp", "fisheye")
+    return FisheyeProjection(width, height, center_x, center_y, radius, camera_azimuth, flip, lens, cache_dir)
+
+ALPACA_STATE_FILE = "/dev/shm/allsky_alpacatelescope.json"
+ALPACA_STATUS_ENDPOINTS = {
+    "tracking": "/api/v1/telescope/0/tracking",
+    "slewing": "/api/v1/telescope/0/slewing",
+    "at_park": "/api/v1/telescope/0/atpark"
+}
+
+def get_alpaca_value(session, base_url, endpoint, timeout):
     url = f"{base_url}/{endpoint.lstrip('/')}"
     try:
-        with urlopen(url, timeout=1.5) as r:
-            data = json.loads(r.read().decode('utf-8'))
-            if data.get('ErrorNumber') == 0:
-                return data.get('Value')
+        data = session.get(url, timeout=timeout).json()
+        if data.get('ErrorNumber') == 0:
+            return data.get('Value')
     except Exception:
         return None
     return None
 
+class AlpacaPoller:
+    """
+    Reads the telescope position and status. All of the endpoints are requested at the same time
+    over a keep-alive session, so an unreachable server costs one timeout rather than one per
+    endpoint.
+
+    The first state() polls straight away, after that a background thread polls every interval
+    so, while the module stays loaded, state() returns instantly. The last known position, and
+    when it was read, is kept in shared memory so it survives between runs.
+
+    There is one poller for the module, configure() switches it to new settings.
+    """
+
+    def __init__(self, server, endpoints, interval, timeout):
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=len(endpoints))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=len(endpoints), thread_name_prefix="alpaca")
+        self._lock = threading.Lock()
+        self._thread = None
+        self._generation = 0
+        self.server = None
+        self.endpoints = None
+        self.configure(server, endpoints, interval, timeout)
+
+    def configure(self, server, endpoints, interval, timeout):
+        """
+        Updates the settings. A different server or endpoints discards the current state, a poll
+        for the old settings that is still running is ignored and the next state() polls straight away
+        """
+        with self._lock:
+            self.interval = interval
+            self.timeout = timeout
+            if server != self.server or endpoints != self.endpoints:
+                self.server = server
+                self.endpoints = endpoints
+                self._generation += 1
+                self._polled = False
+                self._state = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(ALPACA_STATE_FILE, 'r', encoding='utf-8') as file:
+                state = json.load(file)
+            if state.get('server') == self.server:
+                return state
+        except (OSError, ValueError):
+            pass
+        return {'server': self.server}
+
+    def _save_state(self, state):
+        try:
+            temp_file = f'{ALPACA_STATE_FILE}.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as file:
+                json.dump(state, file)
+            os.replace(temp_file, ALPACA_STATE_FILE)
+        except OSError as e:
+            s.log(4, f"INFO: alpacatelescope: Failed to save the telescope state - {e}")
+
+    def poll(self):
+        with self._lock:
+            server, endpoints, timeout, generation = self.server, self.endpoints, self.timeout, self._generation
+
+        start_time = time.perf_counter()
+        futures = {
+            name: self._executor.submit(get_alpaca_value, self._session, server, endpoint, timeout)
+            for name, endpoint in endpoints.items()
+        }
+        values = {name: future.result() for name, future in futures.items()}
+        now = time.time()
+
+        with self._lock:
+            if generation != self._generation:
+                return dict(self._state)
+            state = dict(self._state)
+            state['latency'] = round((time.perf_counter() - start_time) * 1000, 1)
+            state['polled'] = now
+            if values['alt'] is not None and values['az'] is not None:
+                state.update(values)
+                state['time'] = now
+            self._state = state
+            self._polled = True
+
+        self._save_state(state)
+        return state
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception as e:
+                s.log(0, f"ERROR: alpacatelescope: Background poll failed - {e}")
+
+    def state(self):
+        """ Returns a copy of the latest state, the keys are only present once they have been read """
+        if not self._polled:
+            self.poll()
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="alpaca-poller", daemon=True)
+            self._thread.start()
+
+        with self._lock:
+            return dict(self._state)
+
+_poller = None
+
+def get_poller(server, alt_endpoint, az_endpoint, interval, timeout):
+    global _poller
+
+    endpoints = {"alt": alt_endpoint, "az": az_endpoint, **ALPACA_STATUS_ENDPOINTS}
+    if _poller is None:
+        _poller = AlpacaPoller(server, endpoints, interval, timeout)
+    else:
+        _poller.configure(server, endpoints, interval, timeout)
+    return _poller
+
 def alpacatelescope(params, event):
     try:
         if s.image is None: return "No Image"
@@ -82,25 +430,34 @@ def alpacatelescope(params, event):
         cy = int(float(params.get('center_y', 0)) or h/2)
         R = int(float(params.get('radius_override', 0)) or min(w,h)/2)
         flip = params.get('image_flip', 'None')
+        projection = get_projection(w, h, cx, cy, R, cam_az, flip, params.get('lens', 'Equidistant').lower())
         
-        # Alpaca API calls
-        alt = get_alpaca_value(server, params.get('telescope_alt'))
-        az = get_alpaca_value(server, params.get('telescope_az'))
-        tracking = get_alpaca_value(server, "/api/v1/telescope/0/tracking")
-        slewing = get_alpaca_value(server, "/api/v1/telescope/0/slewing")
-        at_park = get_alpaca_value(server, "/api/v1/telescope/0/atpark")
+        # Alpaca API calls, made concurrently and in the background
+        poll_interval = max(1.0, float(params.get('poll_interval', 5)))
+        timeout = max(0.2, float(params.get('timeout', 1.5)))
+        max_age = float(params.get('max_age', 60))
+        poller = get_poller(server, params.get('telescope_alt'), params.get('telescope_az'), poll_interval, timeout)
+        state = poller.state()
+
+        alt, az = state.get('alt'), state.get('az')
+        age = time.time() - state['time'] if 'time' in state else None
+        stale = age is None or age > max_age
 
         # Status determination
         status = "Idle"
-        if tracking: status = "Tracking"
-        if slewing: status = "Slewing"
-        if at_park: status = "Parked"
-        
+        if state.get('tracking'): status = "Tracking"
+        if state.get('slewing'): status = "Slewing"
+        if state.get('at_park'): status = "Parked"
+        if alt is not None and stale: status = "Stale"
+
         # Export for Overlay Manager
         extraData = {
             "AS_TELESCOPEALT": f"{alt:.2f}" if alt is not None else "N/A",
             "AS_TELESCOPEAZ": f"{az:.2f}" if az is not None else "N/A",
-            "AS_TELESCOPESTATUS": status
+            "AS_TELESCOPESTATUS": status,
+            "AS_TELESCOPESTALE": stale,
+            "AS_TELESCOPEAGE": round(age, 1) if age is not None else "N/A",
+            "AS_TELESCOPELATENCY": state.get('latency', "N/A")
         }
         s.saveExtraData(params.get('extradatafilename', 'alpacatelescope.json'), extraData)
 
@@ -112,17 +469,9 @@ def alpacatelescope(params, event):
             except:
                 draw_alt, draw_az = 0.0, 0.0
 
-        # Polar to Cartesian mapping
-        az_rad = np.deg2rad((draw_az - cam_az) % 360)
-        r_px = ((90.0 - draw_alt) / 90.0) * R
-        tx, ty = cx + r_px * np.sin(az_rad), cy - r_px * np.cos(az_rad)
-
-        # Handling image flips for markers and debug graphics
-        final_cx, final_cy = cx, cy
-        if flip in ["Horizontal", "Both"]:
-            tx, final_cx = w - tx, w - cx
-        if flip in ["Vertical", "Both"]:
-            ty, final_cy = h - ty, h - cy
+        # Alt/Az to pixel mapping, the projection allows for the camera rotation and image flips
+        tx, ty = projection.project(draw_alt, draw_az)
+        final_cx, final_cy = projection.center_x, projection.center_y
 
         # Visual Debug Layer
         if debug:
@@ -132,10 +481,7 @@ def alpacatelescope(params, event):
             cv2.line(s.image, (int(final_cx)-30, int(final_cy)), (int(final_cx)+30, int(final_cy)), (255, 255, 0), 2)
             cv2.line(s.image, (int(final_cx), int(final_cy)-30), (int(final_cx), int(final_cy)+30), (255, 255, 0), 2)
             # Red: North Line (Azimuth 0)
-            n_rad = np.deg2rad((0 - cam_az) % 360)
-            nx, ny = final_cx + R * np.sin(n_rad), final_cy - R * np.cos(n_rad)
-            if flip in ["Horizontal", "Both"]: nx = w - (final_cx + R * np.sin(n_rad))
-            if flip in ["Vertical", "Both"]: ny = h - (final_cy - R * np.cos(n_rad))
+            nx, ny = projection.project(0.0, 0.0)
             cv2.line(s.image, (int(final_cx), int(final_cy)), (int(nx), int(ny)), (0, 0, 255), 3)
             cv2.putText(s.image, "N", (int(nx), int(ny)), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 255), 2)
 
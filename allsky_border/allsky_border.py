@@ -5,7 +5,8 @@ Part of allsky flow-runner.py modules.
 https://github.com/thomasjacquin/allsky
 
 This module will allow an image to be enlarged with a coloured border, primarilly to 
-allow the overlay data to be displayed
+allow the overlay data to be displayed. The image can also be cropped, flipped and rotated,
+all of which are written into a single output image
 
 Expected parameters:
 None
@@ -13,12 +14,13 @@ None
 import allsky_shared as s
 import os
 import cv2
+import numpy as np
 
 metaData = {
     "name": "Add Border",
-    "description": "Expands a captured image adding a border",
+    "description": "Crops, flips and rotates a captured image and expands it adding a border",
     "module": "allsky_border",
-    "version": "v1.0.0",      
+    "version": "v1.1.0",      
     "events": [
         "day",
         "night"
@@ -28,7 +30,13 @@ metaData = {
         "right": "0",
         "top": "0",
         "bottom": "0",
-        "colour": "0,0,0"
+        "colour": "0,0,0",
+        "crop_left": "0",
+        "crop_right": "0",
+        "crop_top": "0",
+        "crop_bottom": "0",
+        "flip": "None",
+        "rotation": "0"
     },
     "argumentdetails": {
         "left" : {
@@ -79,7 +87,77 @@ metaData = {
             "required": "false",
             "description": "Border Colour",            
             "help": "The RGB colour of the border, default to black. This shoudl be comma separated values i.e. 255,0,0 for Red"
-        }           
+        },
+        "crop_left" : {
+            "required": "false",
+            "description": "Crop Left",
+            "help": "The number of pixels to remove from the left of the captured image",
+            "tab": "Geometry",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 5000,
+                "step": 1
+            }
+        },
+        "crop_right" : {
+            "required": "false",
+            "description": "Crop Right",
+            "help": "The number of pixels to remove from the right of the captured image",
+            "tab": "Geometry",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 5000,
+                "step": 1
+            }
+        },
+        "crop_top" : {
+            "required": "false",
+            "description": "Crop Top",
+            "help": "The number of pixels to remove from the top of the captured image",
+            "tab": "Geometry",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 5000,
+                "step": 1
+            }
+        },
+        "crop_bottom" : {
+            "required": "false",
+            "description": "Crop Bottom",
+            "help": "The number of pixels to remove from the bottom of the captured image",
+            "tab": "Geometry",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 5000,
+                "step": 1
+            }
+        },
+        "flip" : {
+            "required": "false",
+            "description": "Flip",
+            "help": "Flip the cropped image, this is done before any rotation",
+            "tab": "Geometry",
+            "type": {
+                "fieldtype": "select",
+                "values": "None,Horizontal,Vertical,Both",
+                "default": "None"
+            }
+        },
+        "rotation" : {
+            "required": "false",
+            "description": "Rotation",
+            "help": "Rotate the cropped image clockwise by this many degrees, the border is added after rotating",
+            "tab": "Geometry",
+            "type": {
+                "fieldtype": "select",
+                "values": "0,90,180,270",
+                "default": "0"
+            }
+        }
     },
     "changelog": {
         "v1.0.0" : [
@@ -88,9 +166,100 @@ metaData = {
                 "authorurl": "https://github.com/allskyteam",
                 "changes": "Initial Release"
             }
-        ]                              
-    }           
+        ],
+        "v1.1.0" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Added crop, flip and rotation, all written with the border into a reused output image"
+            }
+        ]
+    }
+}
+
+# The OpenCV operations that flip, and then rotate clockwise, an image. Only two of the combinations
+# need a second pass, which is done in place on the output
+ORIENTATIONS = {
+    ("None", 0): [],
+    ("Horizontal", 0): ["flip_horizontal"],
+    ("Vertical", 0): ["flip_vertical"],
+    ("Both", 0): ["flip_both"],
+    ("None", 90): ["rotate_clockwise"],
+    ("Horizontal", 90): ["transpose", "flip_both"],
+    ("Vertical", 90): ["transpose"],
+    ("Both", 90): ["rotate_anticlockwise"],
+    ("None", 180): ["flip_both"],
+    ("Horizontal", 180): ["flip_vertical"],
+    ("Vertical", 180): ["flip_horizontal"],
+    ("Both", 180): [],
+    ("None", 270): ["rotate_anticlockwise"],
+    ("Horizontal", 270): ["transpose"],
+    ("Vertical", 270): ["transpose", "flip_both"],
+    ("Both", 270): ["rotate_clockwise"]
 }
+FLIP_CODES = {"flip_horizontal": 1, "flip_vertical": 0, "flip_both": -1}
+ROTATE_CODES = {"rotate_clockwise": cv2.ROTATE_90_CLOCKWISE, "rotate_anticlockwise": cv2.ROTATE_90_COUNTERCLOCKWISE}
+POOL_SIZE = 2
+
+_buffer_pool = {"key": None, "buffers": [], "next": 0}
+
+def get_buffer(shape, dtype, source):
+    '''
+    Returns an output buffer from the pool. The pool is emptied
+    when the output size changes. Buffers are used in turn so the previous image is left intact
+    and a buffer that may share memory with the source image is never returned.
+    '''
+    key = (shape, np.dtype(dtype))
+    if _buffer_pool["key"] != key:
+        _buffer_pool.update(key=key, buffers=[], next=0)
+
+    buffers = _buffer_pool["buffers"]
+    for _ in range(POOL_SIZE):
+        index = _buffer_pool["next"]
+        _buffer_pool["next"] = (index + 1) % POOL_SIZE
+        if index == len(buffers):
+            buffers.append(np.empty(shape, dtype=dtype))
+        buffer = buffers[index]
+        if not np.may_share_memory(buffer, source):
+            return buffer
+
+    return np.empty(shape, dtype=dtype)
+
+def fill_border(buffer, top, bottom, left, right, colour):
+    '''
+    Fills only the border strips, the rest of the buffer is overwritten by the image. This has to be
+    done for every image as later modules draw into the pooled buffer, overlay text included
+    '''
+    height, width = buffer.shape[:2]
+    if top:
+        buffer[:top] = colour
+    if bottom:
+        buffer[height - bottom:] = colour
+    if left:
+        buffer[top:height - bottom, :left] = colour
+    if right:
+        buffer[top:height - bottom, width - right:] = colour
+
+def orient(source, destination, operations):
+    '''
+    Writes source into destination applying the flip/rotate operations from ORIENTATIONS
+    '''
+    if not operations:
+        np.copyto(destination, source)
+        return
+
+    for operation in operations:
+        if operation == "transpose":
+            result = cv2.transpose(source, dst=destination)
+        elif operation in FLIP_CODES:
+            result = cv2.flip(source, FLIP_CODES[operation], dst=destination)
+        else:
+            result = cv2.rotate(source, ROTATE_CODES[operation], dst=destination)
+
+        # OpenCV writes into destination unless it cannot use it, then the result has to be copied
+        if result is not destination:
+            np.copyto(destination, result)
+        source = destination
 
 def border(params, event):
     result = ""
@@ -109,7 +278,44 @@ def border(params, event):
     else:
         colour = [0,0,0]
 
-    s.image = cv2.copyMakeBorder(s.image, top, bottom, left, right, cv2.BORDER_CONSTANT, None, colour)
+    crop_left = int(params.get("crop_left", 0))
+    crop_right = int(params.get("crop_right", 0))
+    crop_top = int(params.get("crop_top", 0))
+    crop_bottom = int(params.get("crop_bottom", 0))
+    flip = params.get("flip", "None")
+    rotation = int(params.get("rotation", 0)) % 360
+    operations = ORIENTATIONS.get((flip, rotation))
+    if operations is None:
+        s.log(0, f"ERROR: Invalid flip {flip} or rotation {rotation}")
+        return "Invalid flip or rotation"
+
+    image = s.image
+    height, width = image.shape[:2]
+    if crop_left + crop_right >= width or crop_top + crop_bottom >= height:
+        s.log(0, f"ERROR: The crop is larger than the {width}x{height} image")
+        return "Invalid crop"
+
+    if not any((crop_left, crop_right, crop_top, crop_bottom, top, bottom, left, right, operations)):
+        return result
+
+    # Crop, flip and rotate are all applied while copying the image into the pooled output
+    source = image[crop_top:height - crop_bottom, crop_left:width - crop_right]
+    source_height, source_width = source.shape[:2]
+    if rotation in (90, 270):
+        source_height, source_width = source_width, source_height
+
+    channels = image.shape[2] if image.ndim == 3 else 1
+    if channels == 1:
+        colour = colour[0]
+    else:
+        colour = (colour + [0] * channels)[:channels]
+
+    shape = (source_height + top + bottom, source_width + left + right) + image.shape[2:]
+    buffer = get_buffer(shape, image.dtype, image)
+    fill_border(buffer, top, bottom, left, right, colour)
+
+    orient(source, buffer[top:top + source_height, left:left + source_width], operations)
+    s.image = buffer
      
     return result
 
@@ -25,6 +25,7 @@ import urllib.request
 import requests
 import json
 import subprocess
+import math
 from meteocalc import heat_index
 from meteocalc import dew_point, Temp
 import board
@@ -37,12 +38,17 @@ from adafruit_htu21d import HTU21D
 from meteocalc import heat_index
 from meteocalc import dew_point
 from digitalio import DigitalInOut, Direction, Pull
+
+try:
+    import ephem
+except ImportError:
+    ephem = None
     
 metaData = {
     "name": "Sky Dew Heater Control",
     "description": "Controls a dew heater via a temperature and humidity sensor",
     "module": "allsky_dewheater",
-    "version": "v1.0.6",
+    "version": "v1.0.7",
     "events": [
         "periodic"
     ],
@@ -363,6 +369,13 @@ metaData = {
                 "authorurl": "https://github.com/allskyteam",
                 "changes": "Added option to disable heater during the day"
             }
+        ],
+        "v1.0.7" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Day and night are calculated in the module and cached until the next sunrise or sunset rather than running sunwait every time"
+            }
         ]                                      
     }
 }
@@ -376,10 +389,7 @@ def runcommand (cmd):
     std_out, std_err = proc.communicate()
     return proc.returncode, std_out, std_err
 
-def getToD():
-    angle = s.getSetting('angle')
-    lat = s.getSetting('latitude')
-    lon = s.getSetting('longitude')
+def sunwaitToD(angle, lat, lon):
     tod = 'Unknown'
     
     try:
@@ -394,6 +404,73 @@ def getToD():
         s.log(0, f"ERROR running {cmd}")
     return tod 
 
+def calculateToD(angle, lat, lon):
+    """ Works out if it is day or night, using the same angle as sunwait, and the time of the next change
+        as a unix timestamp. The time is None if the sun does not cross the angle, i.e. polar day or night
+    """
+    observer = ephem.Observer()
+    observer.lat = str(lat)
+    observer.lon = str(lon)
+    observer.horizon = str(angle)
+    observer.pressure = 0
+    observer.date = ephem.now()
+
+    sun = ephem.Sun(observer)
+    tod = 'day' if math.degrees(sun.alt) > angle else 'night'
+
+    try:
+        if tod == 'day':
+            change = observer.next_setting(ephem.Sun(), use_center=True)
+        else:
+            change = observer.next_rising(ephem.Sun(), use_center=True)
+        change = (float(change) - float(ephem.Date('1970/1/1'))) * 86400.0
+    except ephem.CircumpolarError:
+        change = None
+
+    return tod, change
+
+def getToD():
+    """ Returns 'day' or 'night' and the time it next changes. The result is stored in the database and
+        reused until the change so the sun is only calculated twice a day. If the calculation is not
+        possible sunwait is used instead
+    """
+    angle = s.getSetting('angle')
+    lat = s.getSetting('latitude')
+    lon = s.getSetting('longitude')
+    now = time.time()
+    key = f'{angle} {lat} {lon}'
+
+    if s.dbHasKey('dewheatertod'):
+        cached = s.dbGet('dewheatertod')
+        if isinstance(cached, dict) and cached.get('key') == key and now < cached.get('until', 0):
+            return cached['tod'], cached['change']
+
+    if ephem is not None:
+        try:
+            tod, change = calculateToD(float(angle), s.convertLatLon(lat), s.convertLatLon(lon))
+            # recheck hourly if the sun never crosses the angle, and just after the change otherwise
+            until = change + 1 if change is not None else now + 3600
+            cached = {
+                'key': key,
+                'tod': tod,
+                'change': change,
+                'until': until
+            }
+            if s.dbHasKey('dewheatertod'):
+                s.dbUpdate('dewheatertod', cached)
+            else:
+                s.dbAdd('dewheatertod', cached)
+            return tod, change
+        except Exception as e:
+            s.log(0, f"ERROR: Unable to calculate day or night, using sunwait - {e}")
+
+    return sunwaitToD(angle, lat, lon), None
+
+def formatToDChange(change):
+    if change is None:
+        return 'N/A'
+    return time.strftime('%H:%M', time.localtime(change))
+
 def createCardinal(degrees):
     try:
         cardinals = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW','W', 'WNW', 'NW', 'NNW', 'N']
@@ -971,7 +1048,7 @@ def dewheater(params, event):
     except ValueError:
         soloURL = ''
 
-    tod = getToD(); 
+    tod, todChange = getToD()
     daytimeDisable = params["daydisable"]
                     
     temperature = 0
@@ -1054,6 +1131,8 @@ def dewheater(params, event):
                                 extraData["AS_DEWCONTROLRELHUMIDITY"] = relHumidity
                             if altitude is not None:
                                 extraData["AS_DEWCONTROLALTITUDE"] = altitude
+                            extraData["AS_DEWCONTROLTOD"] = tod
+                            extraData["AS_DEWCONTROLTODCHANGE"] = formatToDChange(todChange)
 
                             s.saveExtraData(extradatafilename,extraData)
 
@@ -1106,6 +1185,8 @@ def dewheater(params, event):
         extraData["AS_DEWCONTROLLIMIT"] = 0
         extraData["AS_DEWCONTROLHUMIDITY"] = 0
         extraData["AS_DEWCONTROLHEATER"] = "Disabled"
+        extraData["AS_DEWCONTROLTOD"] = tod
+        extraData["AS_DEWCONTROLTODCHANGE"] = formatToDChange(todChange)
         s.saveExtraData(extradatafilename,extraData)
             
         result += 'Dew control disabled during the day'
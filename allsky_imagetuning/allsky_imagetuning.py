@@ -14,13 +14,24 @@ Advanced image enhancement module providing control over:
 
 import allsky_shared as s
 import cv2
+import os
+import time
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+THREADS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+DENOISE_DIAMETER = 5
+SHARPEN_KERNEL = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
+
+_pool = None
+
 metaData = {
     "name": "Image Tuning",
     "description": "Advanced control: Saturation, Contrast, Gamma, Sharpening, and Denoise",
     "module": "allsky_imagetuning",
-    "version": "v2.1.0",
+    "version": "v2.3.0",
     "events": [
         "night",
         "day"
@@ -32,7 +43,12 @@ metaData = {
         "gamma": "1.0",
         "sharpness": "0",
         "denoise": "0",
-        "auto_anchor": "false"
+        "auto_anchor": "false",
+        "tiled": "true",
+        "sharpen_sky_only": "false",
+        "sky_center_x": "0",
+        "sky_center_y": "0",
+        "sky_radius": "0"
     },
     "argumentdetails": {
         "level" : {
@@ -97,6 +113,55 @@ metaData = {
             "type": {
                 "fieldtype": "checkbox"
             }
+        },
+        "tiled" : {
+            "required": "false",
+            "description": "Tiled Processing",
+            "help": "Splits Noise Reduction and Sharpening into strips that are processed in parallel on all of the cpu cores.",
+            "type": {
+                "fieldtype": "checkbox"
+            }
+        },
+        "sharpen_sky_only" : {
+            "required": "false",
+            "description": "Sharpen Sky Only",
+            "help": "Only sharpens the circular sky area of the image, leaving the corners untouched.",
+            "type": {
+                "fieldtype": "checkbox"
+            }
+        },
+        "sky_center_x" : {
+            "required": "false",
+            "description": "Sky Center X",
+            "help": "The x position of the centre of the sky circle in pixels, 0 for the image centre.",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 10000,
+                "step": 1
+            }
+        },
+        "sky_center_y" : {
+            "required": "false",
+            "description": "Sky Center Y",
+            "help": "The y position of the centre of the sky circle in pixels, 0 for the image centre.",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 10000,
+                "step": 1
+            }
+        },
+        "sky_radius" : {
+            "required": "false",
+            "description": "Sky Radius",
+            "help": "The radius of the sky circle in pixels, 0 for half the smallest image dimension.",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 10000,
+                "step": 1
+            }
         }
     },
     "enabled": "false",
@@ -107,10 +172,194 @@ metaData = {
                 "authorurl": "https://github.com/chvvkumar",
                 "changes": "Added Noise Reduction (Bilateral Filter)"
             }
+        ],
+        "v2.2.0" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Gamma and contrast are applied as one cached lookup table and saturation no longer converts the image to float"
+            }
+        ],
+        "v2.3.0" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Noise Reduction and Sharpening can run in parallel strips, Sharpening can be limited to the sky and the time taken by each step is reported"
+            }
         ]
     }
 }
 
+@lru_cache(maxsize=8)
+def _saturation_lut(sat_multiplier):
+    '''
+    Lookup table for an HSV image that scales the S channel and leaves H and V untouched.
+    '''
+    identity = np.arange(256, dtype=np.uint8)
+    saturation = np.clip(np.arange(256, dtype=np.float32) * sat_multiplier, 0, 255).astype(np.uint8)
+    lut = np.stack([identity, saturation, identity], axis=-1).reshape(256, 1, 3)
+    lut.setflags(write=False)
+    return lut
+
+@lru_cache(maxsize=8)
+def _gamma_table(gamma_level):
+    '''
+    Gamma correction table. Returned as float64 so contrast can be folded into it.
+    '''
+    if gamma_level == 1.0:
+        table = np.arange(256, dtype=np.float64)
+    else:
+        invGamma = 1.0 / gamma_level
+        table = np.floor(((np.arange(256) / 255.0) ** invGamma) * 255)
+    table.setflags(write=False)
+    return table
+
+def _contrast_lut(table, contrast_level, beta):
+    '''
+    Applies contrast to a gamma table, matching the single precision rounding and saturation
+    of cv2.convertScaleAbs.
+    '''
+    if contrast_level != 1.0:
+        table = np.abs(table.astype(np.float32) * np.float32(contrast_level) + np.float32(beta))
+    return np.clip(np.rint(table), 0, 255).astype(np.uint8)
+
+@lru_cache(maxsize=8)
+def _tone_lut(gamma_level, contrast_level):
+    return _contrast_lut(_gamma_table(gamma_level), contrast_level, 0)
+
+def apply_saturation(image, sat_multiplier):
+    '''
+    Scales the saturation of a BGR image.
+
+    The HSV image stays uint8 and the S channel is scaled with a cached lookup table
+    in place, so the only full frame allocation is the HSV image itself.
+    '''
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    cv2.LUT(hsv, _saturation_lut(sat_multiplier), dst=hsv)
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR, dst=image)
+
+def apply_tone(image, gamma_level, contrast_level, auto_anchor):
+    '''
+    Applies gamma and then contrast to an image in one lookup table pass.
+
+    When auto anchoring the contrast depends on the mean brightness after gamma correction.
+    This is calculated from the histogram of the image so the gamma corrected image is never
+    created.
+    '''
+    if auto_anchor and contrast_level != 1.0:
+        table = _gamma_table(gamma_level)
+        hist = cv2.calcHist([image.reshape(-1, 1)], [0], None, [256], [0, 256]).ravel()
+        mean_brightness = np.dot(hist, table) / image.size
+        lut = _contrast_lut(table, contrast_level, mean_brightness * (1.0 - contrast_level))
+    else:
+        lut = _tone_lut(gamma_level, contrast_level)
+
+    return cv2.LUT(image, lut, dst=image)
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=THREADS)
+    return _pool
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() == "true"
+
+def _timed(label, start_time):
+    return f"{label} ({(time.perf_counter() - start_time) * 1000:.0f}ms)"
+
+@lru_cache(maxsize=4)
+def get_sky_mask(height, width, center_x, center_y, radius):
+    '''
+    Returns a mask of the circular sky area and its bounding box (x0, y0, x1, y1) in the image.
+    '''
+    center_x = center_x or width // 2
+    center_y = center_y or height // 2
+    radius = radius or min(width, height) // 2
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.circle(mask, (center_x, center_y), radius, 1, -1)
+    mask = mask.astype(bool)
+    mask.setflags(write=False)
+
+    bounds = (
+        max(0, center_x - radius),
+        max(0, center_y - radius),
+        min(width, center_x + radius + 1),
+        min(height, center_y + radius + 1)
+    )
+    return mask, bounds
+
+def run_tiled(function, image, halo, out, tiled=True, bounds=None, mask=None):
+    '''
+    Runs a filter over an image in horizontal strips, in parallel when tiled.
+
+    Each strip is read with halo extra pixels on every side so the filter sees the same
+    neighbourhood as it would on the whole image. Only the inside of the strip is written to
+    out, so the result is identical to filtering the whole image. At the edges of the image
+    the strips end at the same place as the image so the border handling is the same too.
+
+    bounds (x0, y0, x1, y1) limits the filter to part of the image and mask, if given, limits
+    which pixels in out are written.
+    '''
+    height, width = image.shape[:2]
+    x0, y0, x1, y1 = bounds or (0, 0, width, height)
+    left, right = max(0, x0 - halo), min(width, x1 + halo)
+
+    def process(rows):
+        top, bottom = rows
+        src_top, src_bottom = max(0, top - halo), min(height, bottom + halo)
+        filtered = function(image[src_top:src_bottom, left:right])
+        filtered = filtered[top - src_top:bottom - src_top, x0 - left:x1 - left]
+        if mask is None:
+            out[top:bottom, x0:x1] = filtered
+        else:
+            tile_mask = mask[top:bottom, x0:x1]
+            if out.ndim == 3:
+                tile_mask = tile_mask[..., None]
+            np.copyto(out[top:bottom, x0:x1], filtered, where=tile_mask)
+
+    tiles = THREADS if tiled else 1
+    step = -(-(y1 - y0) // tiles)
+    strips = [(top, min(top + step, y1)) for top in range(y0, y1, step)]
+    if len(strips) > 1:
+        list(_get_pool().map(process, strips))
+    elif strips:
+        process(strips[0])
+
+    return out
+
+def denoise(image, denoise_level, tiled=True):
+    '''
+    Bilateral Filter: Preserves edges (stars) while smoothing flat areas (noise)
+    The diameter of each pixel neighborhood is kept small for speed, the sigma is the
+    filter strength. Higher = more blurring of noise.
+    '''
+    sigma = denoise_level * 15
+    return run_tiled(
+        lambda tile: cv2.bilateralFilter(tile, DENOISE_DIAMETER, sigma, sigma),
+        image, DENOISE_DIAMETER // 2, np.empty_like(image), tiled
+    )
+
+def sharpen(image, sharpness_level, tiled=True, sky_mask=None):
+    '''
+    Blends a sharpened copy of the image with the original. If a sky mask, from get_sky_mask,
+    is given only the pixels inside it are sharpened.
+    '''
+    alpha = sharpness_level * 0.2
+
+    def sharpen_tile(tile):
+        sharpened = cv2.filter2D(tile, -1, SHARPEN_KERNEL)
+        return cv2.addWeighted(sharpened, alpha, tile, 1 - alpha, 0)
+
+    if sky_mask is None:
+        return run_tiled(sharpen_tile, image, 1, np.empty_like(image), tiled)
+
+    mask, bounds = sky_mask
+    return run_tiled(sharpen_tile, image, 1, image.copy(), tiled, bounds, mask)
+
 def imagetuning(params, event):
     '''
     Main entry point for the image tuning module.
@@ -127,7 +376,7 @@ def imagetuning(params, event):
     - event: The event triggering this module (day/night)
     
     Returns:
-    - String describing the enhancements applied
+    - String describing the enhancements applied, with the time taken by each step
     '''
     
     result = []
@@ -145,12 +394,13 @@ def imagetuning(params, event):
         sharpness_level = int(params.get("sharpness", 0))
         denoise_level = int(params.get("denoise", 0))
         
-        # Handle checkbox parameter
-        anchor_param = params.get("auto_anchor", "false")
-        if isinstance(anchor_param, bool):
-            auto_anchor = anchor_param
-        else:
-            auto_anchor = str(anchor_param).lower() == "true"
+        # Handle checkbox parameters
+        auto_anchor = _to_bool(params.get("auto_anchor", "false"))
+        tiled = _to_bool(params.get("tiled", "true"))
+        sharpen_sky_only = _to_bool(params.get("sharpen_sky_only", "false"))
+        sky_center_x = int(float(params.get("sky_center_x", 0)))
+        sky_center_y = int(float(params.get("sky_center_y", 0)))
+        sky_radius = int(float(params.get("sky_radius", 0)))
 
         # Enforce limits
         sat_level = max(-10.0, min(10.0, sat_level))
@@ -164,13 +414,9 @@ def imagetuning(params, event):
     # Step 0: Apply Noise Reduction (First step)
     if denoise_level > 0:
         try:
-            # Bilateral Filter: Preserves edges (stars) while smoothing flat areas (noise)
-            # d: Diameter of each pixel neighborhood (keep small for speed)
-            # sigma: Filter strength. Higher = more blurring of noise.
-            d = 5 
-            sigma = denoise_level * 15 
-            s.image = cv2.bilateralFilter(s.image, d, sigma, sigma)
-            result.append(f"Denoise {denoise_level}")
+            start_time = time.perf_counter()
+            s.image = denoise(s.image, denoise_level, tiled)
+            result.append(_timed(f"Denoise {denoise_level}", start_time))
         except Exception as e:
             s.log(0, f"ERROR: Denoise failed: {e}")
 
@@ -179,47 +425,36 @@ def imagetuning(params, event):
     if sat_multiplier != 1.0:
         if len(s.image.shape) == 3 and s.image.shape[2] == 3:
             try:
-                hsv = cv2.cvtColor(s.image, cv2.COLOR_BGR2HSV).astype(np.float32)
-                h_ch, s_ch, v_ch = cv2.split(hsv)
-                s_ch = np.clip(s_ch * sat_multiplier, 0, 255)
-                hsv = cv2.merge([h_ch, s_ch, v_ch]).astype(np.uint8)
-                s.image = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-                result.append(f"Sat x{sat_multiplier:.1f}")
+                start_time = time.perf_counter()
+                s.image = apply_saturation(s.image, sat_multiplier)
+                result.append(_timed(f"Sat x{sat_multiplier:.1f}", start_time))
             except Exception as e:
                 s.log(0, f"ERROR: Saturation adjustment failed: {e}")
 
-    # Step 2: Apply Gamma Correction
-    if gamma_level != 1.0:
-        try:
-            invGamma = 1.0 / gamma_level
-            table = np.array([((i / 255.0) ** invGamma) * 255
-                for i in np.arange(0, 256)]).astype("uint8")
-            s.image = cv2.LUT(s.image, table)
-            result.append(f"Gamma {gamma_level:.1f}")
-        except Exception as e:
-            s.log(0, f"ERROR: Gamma correction failed: {e}")
-
-    # Step 3: Apply Contrast
-    if contrast_level != 1.0:
+    # Steps 2 and 3: Apply Gamma Correction and Contrast as a single lookup table
+    if gamma_level != 1.0 or contrast_level != 1.0:
         try:
-            beta = 0
-            if auto_anchor:
-                mean_brightness = np.mean(s.image)
-                beta = mean_brightness * (1.0 - contrast_level)
-            
-            s.image = cv2.convertScaleAbs(s.image, alpha=contrast_level, beta=beta)
-            result.append(f"Cont x{contrast_level:.1f}")
+            start_time = time.perf_counter()
+            s.image = apply_tone(s.image, gamma_level, contrast_level, auto_anchor)
+            labels = []
+            if gamma_level != 1.0:
+                labels.append(f"Gamma {gamma_level:.1f}")
+            if contrast_level != 1.0:
+                labels.append(f"Cont x{contrast_level:.1f}")
+            result.append(_timed(", ".join(labels), start_time))
         except Exception as e:
-            s.log(0, f"ERROR: Contrast adjustment failed: {e}")
+            s.log(0, f"ERROR: Gamma/Contrast adjustment failed: {e}")
 
     # Step 4: Apply Sharpening (Last step)
     if sharpness_level > 0:
         try:
-            kernel = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
-            sharpened = cv2.filter2D(s.image, -1, kernel)
-            alpha = sharpness_level * 0.2
-            s.image = cv2.addWeighted(sharpened, alpha, s.image, 1 - alpha, 0)
-            result.append(f"Sharp {sharpness_level}")
+            start_time = time.perf_counter()
+            sky_mask = None
+            if sharpen_sky_only:
+                height, width = s.image.shape[:2]
+                sky_mask = get_sky_mask(height, width, sky_center_x, sky_center_y, sky_radius)
+            s.image = sharpen(s.image, sharpness_level, tiled, sky_mask)
+            result.append(_timed(f"Sharp {sharpness_level}", start_time))
         except Exception as e:
             s.log(0, f"ERROR: Sharpening failed: {e}")
 
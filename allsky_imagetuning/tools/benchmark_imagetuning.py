@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+'''
+Compares the fused saturation, gamma and contrast processing in allsky_imagetuning.py against
+the original separate passes, reporting the time per frame and the peak memory allocated.
+
+Synthetic 12MP and 20MP frames are used so this can be run without a camera. It needs
+allsky_shared so should be run on an Allsky install
+
+    ./benchmark_imagetuning.py [frames]
+'''
+import os
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+sys.path.insert(1, os.path.join(os.environ.get('ALLSKY_HOME', os.path.expanduser('~/allsky')), 'scripts', 'modules'))
+from allsky_imagetuning import apply_saturation, apply_tone
+
+SIZES = {
+    '12MP': (3040, 4056),
+    '20MP': (3648, 5472)
+}
+SATURATION = 1.3
+GAMMA = 1.3
+CONTRAST = 1.2
+
+def original(image, auto_anchor):
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV).astype(np.float32)
+    h_ch, s_ch, v_ch = cv2.split(hsv)
+    s_ch = np.clip(s_ch * SATURATION, 0, 255)
+    hsv = cv2.merge([h_ch, s_ch, v_ch]).astype(np.uint8)
+    image = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+
+    invGamma = 1.0 / GAMMA
+    table = np.array([((i / 255.0) ** invGamma) * 255
+        for i in np.arange(0, 256)]).astype("uint8")
+    image = cv2.LUT(image, table)
+
+    beta = 0
+    if auto_anchor:
+        beta = np.mean(image) * (1.0 - CONTRAST)
+    return cv2.convertScaleAbs(image, alpha=CONTRAST, beta=beta)
+
+def fused(image, auto_anchor):
+    image = apply_saturation(image, SATURATION)
+    return apply_tone(image, GAMMA, CONTRAST, auto_anchor)
+
+def make_frame(shape):
+    rng = np.random.default_rng(1)
+    frame = rng.gamma(2, 20, (shape[0], shape[1], 3))
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+def benchmark(name, process, frame, frames, auto_anchor):
+    ''' Peak memory is measured on a separate run as tracing the allocations slows everything down
+    '''
+    elapsed = 0
+    for _ in range(frames):
+        image = frame.copy()
+        start_time = time.perf_counter()
+        result = process(image, auto_anchor)
+        elapsed += time.perf_counter() - start_time
+
+    image = frame.copy()
+    tracemalloc.start()
+    process(image, auto_anchor)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(f'{name:8} {elapsed / frames * 1000:8.1f}ms per frame, peak {peak / 1024 / 1024:7.1f}MB')
+    return result
+
+if __name__ == '__main__':
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    for size, shape in SIZES.items():
+        frame = make_frame(shape)
+        for auto_anchor in (False, True):
+            print(f'{size} auto anchor {auto_anchor}')
+            expected = benchmark('original', original, frame, frames, auto_anchor)
+            result = benchmark('fused', fused, frame, frames, auto_anchor)
+            difference = np.abs(expected.astype(np.int16) - result).max()
+            print(f'{"":8} max difference {difference}')
@@ -13,10 +13,12 @@ Expected parameters:
 '''
 import allsky_shared as s
 import os
+import json
 import ephem
 import datetime
 import cv2
 import numpy as np
+from bisect import bisect_right
 from math import degrees
 
 metaData = {
@@ -27,7 +29,7 @@ metaData = {
         "day"
     ],
     "experimental": "false",
-    "version": "v0.6",
+    "version": "v0.8",
     "module": "allsky_lightgraph",
     "arguments": {
         "border_color": "30 190 40",
@@ -288,6 +290,250 @@ metaData = {
     }
 }
 
+EPHEMERIS_FILE = "lightgraph_ephemeris.json"
+EPHEMERIS_STEP = 5 # minutes between the cached sun and moon altitudes
+SUN_EVENTS = (("-18:0", "DawnAstro", "DuskAstro"),
+              ("-12:0", "DawnNauti", "DuskNauti"),
+              ("-6:0", "DawnCivil", "DuskCivil"),
+              ("0:0", "Sunrise", "Sunset"))
+
+SPRITE_FILE = "lightgraph_sprite.npz"
+SPRITE_PARAMS = ("border_color", "light_color", "dark_color", "text_color", "hour_ticks", "hour_nums", "hour_txt_size",
+                 "now_point", "draw_elev", "elev_color", "sun_color", "moon_color")
+
+_ephemeris = None
+_sprites = None
+
+class Ephemeris():
+    '''
+    Sun and moon events and altitudes for one UTC day at one location. Everything is calculated once a day
+    and covers enough time either side of the day for any graph drawn during it, so each frame only has to
+    look values up. Dates are stored as ephem dates (float days).
+    '''
+
+    def __init__(self, latitude, longitude, day):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.day = day
+        self.key = "{0}|{1:.5f}|{2:.5f}|{3}".format(day.isoformat(), latitude, longitude, EPHEMERIS_STEP)
+        base = float(ephem.Date(datetime.datetime.combine(day, datetime.time())))
+        self.spanStart = base - 1.0
+        self.spanEnd = base + 3.0
+        self.sampleStart = base - 1.0
+        self.sampleStep = EPHEMERIS_STEP / 1440.0
+        self.events = {}
+        self.sunTimes = []
+        self.sunNames = []
+        self.levels = []
+        self.sunAlt = []
+        self.moonAlt = []
+
+    def _observer(self, horizon="0:0"):
+        location = ephem.Observer()
+        location.lat = str(self.latitude)
+        location.lon = str(self.longitude)
+        location.horizon = horizon
+        return location
+
+    def _findEvents(self, location, finder, body):
+        times = []
+        location.date = self.spanStart
+        while True:
+            try:
+                t = float(finder(body))
+            except ephem.CircumpolarError:
+                break
+            if t > self.spanEnd:
+                break
+            times.append(t)
+            location.date = t + ephem.minute
+        return times
+
+    def _darkLevel(self, alt):
+        if alt < -18.0:
+            return 0 # night
+        elif alt < -12.0:
+            return 1 # astronomical
+        elif alt < -6.0:
+            return 2 # nautical
+        elif alt < 0.0:
+            return 3 # civil
+        return 4 # day
+
+    def calculate(self):
+        sun = ephem.Sun()
+        moon = ephem.Moon()
+
+        for horizon, risingName, settingName in SUN_EVENTS:
+            location = self._observer(horizon)
+            self.events[risingName] = self._findEvents(location, location.next_rising, sun)
+            self.events[settingName] = self._findEvents(location, location.next_setting, sun)
+
+        location = self._observer()
+        self.events["Noon"] = self._findEvents(location, location.next_transit, sun)
+        self.events["Midnight"] = self._findEvents(location, location.next_antitransit, sun)
+        self.events["MoonRise"] = self._findEvents(location, location.next_rising, moon)
+        self.events["MoonSet"] = self._findEvents(location, location.next_setting, moon)
+        self.events["MoonTransit"] = self._findEvents(location, location.next_transit, moon)
+        self.events["MoonAntiTransit"] = self._findEvents(location, location.next_antitransit, moon)
+
+        sunEvents = sorted((t, name) for name, times in self.events.items() if not name.startswith("Moon") for t in times)
+        self.sunTimes = [t for t, name in sunEvents]
+        self.sunNames = [name for t, name in sunEvents]
+
+        # the darkness level between each pair of events, the sun is always on the same side of every
+        # twilight angle between two events so the level at the midpoint is the level for the whole interval
+        bounds = [self.spanStart] + self.sunTimes + [self.spanEnd]
+        self.levels = []
+        for i in range(len(bounds) - 1):
+            location.date = (bounds[i] + bounds[i + 1]) / 2.0
+            sun.compute(location)
+            self.levels.append(self._darkLevel(degrees(sun.alt)))
+
+        self.sunAlt = []
+        self.moonAlt = []
+        samples = int((self.spanEnd - self.sampleStart) / self.sampleStep) + 1
+        for i in range(samples):
+            location.date = self.sampleStart + i * self.sampleStep
+            sun.compute(location)
+            moon.compute(location)
+            self.sunAlt.append(round(degrees(sun.alt), 4))
+            self.moonAlt.append(round(degrees(moon.alt), 4))
+
+    def load(self, path):
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if data.get("key") != self.key:
+            return False
+
+        self.events = data["events"]
+        self.sunTimes = data["sunTimes"]
+        self.sunNames = data["sunNames"]
+        self.levels = data["levels"]
+        self.sunAlt = data["sunAlt"]
+        self.moonAlt = data["moonAlt"]
+        return True
+
+    def save(self, path):
+        data = {
+            "key": self.key,
+            "events": self.events,
+            "sunTimes": self.sunTimes,
+            "sunNames": self.sunNames,
+            "levels": self.levels,
+            "sunAlt": self.sunAlt,
+            "moonAlt": self.moonAlt
+        }
+        try:
+            tmpPath = path + ".tmp"
+            with open(tmpPath, "w") as f:
+                json.dump(data, f)
+            os.replace(tmpPath, path)
+        except OSError as e:
+            s.log(1, "ERROR Unable to save ephemeris cache {0} - {1}".format(path, e))
+
+    def sunEvents(self, start, finish):
+        ''' All sun events between start and finish as (datetime, name) '''
+        return [(ephem.Date(t).datetime(), name) for t, name in zip(self.sunTimes, self.sunNames) if start <= t <= finish]
+
+    def darkness(self, date):
+        return self.levels[bisect_right(self.sunTimes, date)]
+
+    def nextEvent(self, name, date):
+        times = self.events.get(name, [])
+        i = bisect_right(times, date)
+        if i < len(times):
+            return ephem.Date(times[i])
+        return None
+
+    def _interpolate(self, values, dates):
+        samples = self.sampleStart + np.arange(len(values)) * self.sampleStep
+        return np.interp(dates, samples, values)
+
+    def sunAltitude(self, dates):
+        return self._interpolate(self.sunAlt, dates)
+
+    def moonAltitude(self, dates):
+        return self._interpolate(self.moonAlt, dates)
+
+def getEphemeris(latitude, longitude, nowUTC):
+    '''
+    Returns the ephemeris for the current day, from memory or the cache file if possible
+    '''
+    global _ephemeris
+
+    ephemeris = Ephemeris(latitude, longitude, nowUTC.date())
+    if _ephemeris is not None and _ephemeris.key == ephemeris.key:
+        return _ephemeris
+
+    allskyHome = s.getEnvironmentVariable("ALLSKY_HOME")
+    path = os.path.join(allskyHome, "tmp", EPHEMERIS_FILE) if allskyHome else None
+
+    if path is None or not ephemeris.load(path):
+        ephemeris.calculate()
+        if path is not None:
+            ephemeris.save(path)
+
+    _ephemeris = ephemeris
+    return ephemeris
+
+class SpriteCanvas():
+    '''
+    Draws into a BGR image and a coverage mask at the same time. Drawing on a black image gives colors
+    premultiplied by their coverage, which anti aliased drawing on a 4 channel image does not
+    '''
+
+    def __init__(self, width, height):
+        self.image = np.zeros((height, width, 3), np.uint8)
+        self.mask = np.zeros((height, width), np.uint8)
+
+    def draw(self, function, color, **kwargs):
+        function(self.image, color=color, **kwargs)
+        function(self.mask, color=255, **kwargs)
+
+    def sprite(self):
+        return np.dstack((self.image, self.mask))
+
+def prepareBlend(sprite, x, y, alpha, mono):
+    '''
+    Converts a premultiplied BGRA sprite into the color and weights used by cv2.blendLinear, the
+    color is converted to gray for mono images
+    '''
+    coverage = sprite[:, :, 3].astype(np.float32) / 255.0
+    color = sprite[:, :, :3].astype(np.float32) / np.maximum(coverage, 1.0 / 255.0)[:, :, np.newaxis]
+    color = np.clip(color + 0.5, 0, 255).astype(np.uint8)
+    if mono:
+        color = cv2.cvtColor(color, cv2.COLOR_BGR2GRAY)
+    weight = coverage * alpha
+    return (color, weight, 1.0 - weight, x, y)
+
+def loadSprites(path, key):
+    '''
+    Loads the sprites saved by a previous capture if they were rendered with the same key
+    '''
+    try:
+        with np.load(path) as data:
+            if str(data["key"]) != key:
+                return None
+            positions = data["positions"].tolist()
+            return [(data["sprite{0}".format(i)], x, y) for i, (x, y) in enumerate(positions)]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def saveSprites(path, key, sprites):
+    arrays = {"sprite{0}".format(i): sprite for i, (sprite, x, y) in enumerate(sprites)}
+    try:
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "wb") as f:
+            np.savez(f, key=np.array(key), positions=np.array([(x, y) for sprite, x, y in sprites], dtype=np.int64).reshape(-1, 2), **arrays)
+        os.replace(tmpPath, path)
+    except OSError as e:
+        s.log(1, "ERROR Unable to save light graph sprites {0} - {1}".format(path, e))
+
 class lGraph():
 
     border_color = light_color = dark_color = text_color =None
@@ -388,158 +634,18 @@ class lGraph():
             self.startTimeUTC = self.nowTimeUTC
             self.finishTimeUTC = self.nowTimeUTC + datetime.timedelta(hours=24)
 
-    def _convertLatLon(self, input):
-        # convert latitude or longitude to ephem format
-        v = input
-        g = int(v)
-        v = v - g
-        m = int(v * 60)
-        v = v * 60 - m
-        se = v * 60
-        res = str(g) + ':' + str(m) + ':' + str(se)
-
-        return res
-
     def calculations(self, debug, params):
         self.location = ephem.Observer()
-        self.location.lat = self._convertLatLon(self.latitude)
-        self.location.lon = self._convertLatLon(self.longitude)
+        self.location.lat = str(self.latitude)
+        self.location.lon = str(self.longitude)
         self.location.date = ephem.Date(self.nowTimeUTC)
 
-        ss = ephem.Sun()
-
-        # store in an array all next risings and settings, and transits
-        self.location.horizon ='-18:0'
-        try:
-            raise_astro1 = self.location.next_rising(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(raise_astro1, "DawnAstro")]
-        except:
-            pass
-        try:
-            set_astro1 = self.location.next_setting(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(set_astro1, "DuskAstro")]
-        except:
-            pass
-        self.location.horizon ='-12:0'
-        try:
-            raise_nauti1 = self.location.next_rising(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(raise_nauti1, "DawnNauti")]
-        except:
-            pass
-        try:
-            set_nauti1 = self.location.next_setting(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(set_nauti1, "DuskNauti")]
-        except:
-            pass
-        self.location.horizon ='-6:0'
-        try:
-            raise_civil1 = self.location.next_rising(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(raise_civil1, "DawnCivil")]
-        except:
-            pass
-        try:
-            set_civil1 = self.location.next_setting(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(set_civil1, "DuskCivil")]
-        except:
-            pass
-        self.location.horizon ='0:0'
-        try:
-            raise1 = self.location.next_rising(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(raise1, "Sunrise")]
-        except:
-            pass
-        try:
-            set1 = self.location.next_setting(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(set1, "Sunset")]
-        except:
-            pass
-
-        try:
-            transit1 = self.location.next_transit(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(transit1, "Noon")]
-        except:
-            pass
-        try:
-            anti_transit1 = self.location.next_antitransit(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(anti_transit1, "Midnight")]
-        except:
-            pass
-        
-        # of centered, add all previous risings and settings and transits
-        if params["now_point"] == "Center":
-            self.location.horizon ='-18:0'
-            try:
-                raise_astro2 = self.location.previous_rising(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(raise_astro2, "DawnAstro")]
-            except:
-                pass
-            try:
-                set_astro2 = self.location.previous_setting(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(set_astro2, "DuskAstro")]
-            except:
-                pass
-            self.location.horizon ='-12:0'
-            try:
-                raise_nauti2 = self.location.previous_rising(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(raise_nauti2, "DawnNauti")]
-            except:
-                pass
-            try:
-                set_nauti2 = self.location.previous_setting(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(set_nauti2, "DuskNauti")]
-            except:
-                pass
-            self.location.horizon ='-6:0'
-            try:
-                raise_civil2 = self.location.previous_rising(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(raise_civil2, "DawnCivil")]
-            except:
-                pass
-            try:
-                set_civil2 = self.location.previous_setting(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(set_civil2, "DuskCivil")]
-            except:
-                pass
-            self.location.horizon ='0:0'
-            try:
-                raise2 = self.location.previous_rising(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(raise2, "Sunrise")]
-            except:
-                pass
-            try:
-                set2 = self.location.previous_setting(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(set2, "Sunset")]
-            except:
-                pass
-
-            try:
-                transit2 = self.location.previous_transit(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(transit2, "Noon")]
-            except:
-                pass
-            try:
-                anti_transit2 = self.location.previous_antitransit(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(anti_transit2, "Midnight")]
-            except:
-                pass
-
-        # sort all events
-        self.timeArray.sort()
-
-        # filter out events before start time or after end time
-        while (self.timeArray[0])[0] < self.startTimeUTC:
-            self.timeArray = self.timeArray[1:]
-
-        while (self.timeArray[-1])[0] > self.finishTimeUTC:
-            self.timeArray = self.timeArray[:-1]
+        self.ephemeris = getEphemeris(self.latitude, self.longitude, self.nowTimeUTC)
+        self.timeArray = self.ephemeris.sunEvents(float(ephem.Date(self.startTimeUTC)), float(ephem.Date(self.finishTimeUTC)))
 
         # add start and end time events
         self.timeArray = [(self.startTimeUTC, "Start")] + self.timeArray + [(self.finishTimeUTC, "Finish")]
 
-        ss = ephem.Sun()
-        ss.compute(self.location)
-        sun_elev = ss.alt
-
         # add to each element datetime scaled to rectangle X coordinate
         for i in range(len(self.timeArray)):
             self.timeArray[i] = self.timeArray[i] + (int((self.timeArray[i][0] - self.startTimeUTC).total_seconds() / (self.finishTimeUTC - self.startTimeUTC).total_seconds() * self.graph_width),)
@@ -548,67 +654,63 @@ class lGraph():
         for moment in self.timeArray:
             if moment[1] == "Noon":
                 self.noon = moment
-                self.timeArray.remove(moment)
-            if moment[1] == "Midnight":
-                self.midnight = moment
-                self.timeArray.remove(moment)
-        for moment in self.timeArray: # not sure yey if an extra check is really necessary, probably not
-            if moment[1] == "Noon":
-                self.noon = moment
-                self.timeArray.remove(moment)
             if moment[1] == "Midnight":
                 self.midnight = moment
-                self.timeArray.remove(moment)     
+        self.timeArray = [moment for moment in self.timeArray if moment[1] not in ("Noon", "Midnight")]
 
     def calSunMoon(self, params):
         k = 3 # k is the precission for moon-solar plot in pixels
         self.npoints = int(self.elev_width / k) + 1
         self.res = self.elev_width / self.npoints
-        delta_t = 24.0 * 3600.0 / self.npoints
-        sun = ephem.Sun()
-        moon = ephem.Moon()
-        for x in range(self.npoints + 1):
-            xt = self.startTimeUTC + datetime.timedelta(seconds=x * delta_t)
-            self.location.date = ephem.Date(xt)
-            sun.compute(self.location)
-            self.sunPath = self.sunPath + [(x * self.res, int(degrees(sun.alt) / 90.0 * self.elev_height / 2.0))]
-            moon.compute(self.location)
-            self.moonPath = self.moonPath + [(x * self.res, int(degrees(moon.alt) / 90.0 * self.elev_height / 2.0))]
+        delta_t = 1.0 / self.npoints # in days
+        points = np.arange(self.npoints + 1)
+        dates = float(ephem.Date(self.startTimeUTC)) + points * delta_t
+        scale = self.elev_height / 2.0 / 90.0
+        sunY = (self.ephemeris.sunAltitude(dates) * scale).astype(int)
+        moonY = (self.ephemeris.moonAltitude(dates) * scale).astype(int)
+        self.sunPath = list(zip((points * self.res).tolist(), sunY.tolist()))
+        self.moonPath = list(zip((points * self.res).tolist(), moonY.tolist()))
 
     def _azMidDarkness(self, dt1, dt2):
         tdelta = (dt2 - dt1).total_seconds()
         tmid = dt1 + datetime.timedelta(seconds=tdelta/2)
-        loc = self.location
-        loc.date = ephem.Date(tmid.strftime("%Y/%m/%d %H:%M:%S"))
-        sun = ephem.Sun()
-        sun.compute(loc)
-        a = degrees(sun.alt)
-        if a < -18.0:
-            drk = 0 # night
-        elif a < -12.0:
-            drk = 1 # astronomical
-        elif a < -6.0:
-            drk = 2 # nautical
-        elif a < 0.0:
-            drk = 3 # civil
-        else:
-            drk = 4 # day
-
-        return drk
-
-    def draw (self, params):
-        alpha = float(params["alpha"])
+        return self.ephemeris.darkness(float(ephem.Date(tmid)))
+
+    def _eventTime(self, name, date):
+        event = self.ephemeris.nextEvent(name, date)
+        if event is None:
+            return ""
+        return ephem.localtime(event).time().strftime("%H:%M")
+
+    def _cropSprite(self, canvas, originX, originY):
+        '''
+        Crops the sprite to the drawn pixels and the image, returns the sprite and its position in the image
+        '''
+        sprite = canvas.sprite()
+        x, y, w, h = cv2.boundingRect(sprite[:, :, 3])
+        left = max(originX + x, 0)
+        top = max(originY + y, 0)
+        right = min(originX + x + w, self.image_width)
+        bottom = min(originY + y + h, self.image_height)
+        if right <= left or bottom <= top:
+            return None
+        return (sprite[top - originY:bottom - originY, left - originX:right - originX].copy(), left, top)
+
+    def _renderGraph(self, params):
+        '''
+        Renders the light graph into a BGRA sprite
+        '''
         textSize = float(params["hour_txt_size"])
-        
-        canvas = s.image
-        if alpha < 1.0:
-            canvas = s.image.copy() # if transparency, work on a copy
-        else:
-            canvas = s.image
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        tickSize = int(self.graph_height / 5)
+        (textWidth, textHeight), baseline = cv2.getTextSize("00", font, textSize, 1)
+        margin = max(tickSize + textHeight + baseline, textWidth) + 4
+        gX = gY = margin
+
+        canvas = SpriteCanvas(self.graph_width + 2 * margin, self.graph_height + 2 * margin)
 
         # dark areas
         for i in range(len(self.timeArray)-1):
-            # print (self._timeArray[i][0].strftime("%Y-%m-%d %H:%M:%S"), " to ",self._timeArray[i+1][0].strftime("%Y-%m-%d %H:%M:%S"), "(", self._timeArray[i][1], " to ",self._timeArray[i+1][1])
             drk = self._azMidDarkness(self.timeArray[i][0], self.timeArray[i + 1][0])
             if drk == 0:
                 col = self.dark_color
@@ -621,123 +723,156 @@ class lGraph():
             else:
                 col = self.light_color
 
-            cv2.rectangle(img=canvas, \
-                pt1=(self.graph_X + self.timeArray[i][2], self.graph_Y), \
-                pt2=(self.graph_X + self.timeArray[i + 1][2], self.graph_Y + self.graph_height), \
+            canvas.draw(cv2.rectangle, \
+                pt1=(gX + self.timeArray[i][2], gY), \
+                pt2=(gX + self.timeArray[i + 1][2], gY + self.graph_height), \
                 color=col, thickness=cv2.FILLED)
 
         # transits
         if self.noon:
-            cv2.line(img=canvas, pt1=(self.graph_X + self.noon[2], self.graph_Y), \
-                pt2=(self.graph_X + self.noon[2], self.graph_Y + self.graph_height), color=self.dark_color)
+            canvas.draw(cv2.line, pt1=(gX + self.noon[2], gY), \
+                pt2=(gX + self.noon[2], gY + self.graph_height), color=self.dark_color)
 
         if self.midnight:
-            cv2.line(img=canvas, pt1=(self.graph_X + self.midnight[2], self.graph_Y), \
-                pt2=(self.graph_X + self.midnight[2], self.graph_Y + self.graph_height), color=self.light_color)
+            canvas.draw(cv2.line, pt1=(gX + self.midnight[2], gY), \
+                pt2=(gX + self.midnight[2], gY + self.graph_height), color=self.light_color)
 
         # box
-        cv2.rectangle(img=canvas, pt1=(self.graph_X, self.graph_Y), \
-            pt2=(self.graph_X + self.graph_width, self.graph_Y + self.graph_height), \
-            thickness=2, color=self.border_color)    
+        canvas.draw(cv2.rectangle, pt1=(gX, gY), \
+            pt2=(gX + self.graph_width, gY + self.graph_height), \
+            thickness=2, color=self.border_color)
 
         # hour ticks
         if params["hour_ticks"] == True:
-            tickSize = int(self.graph_height / 5)
             firstIntHourTime = self.startTime.replace(second=0, minute=0, microsecond=0) # everything is calculated in UTC, but this is local
-            startingX = -(self.startTime - firstIntHourTime).total_seconds() / 3600.0 / 24.0 * self.graph_width + self.graph_X
+            startingX = -(self.startTime - firstIntHourTime).total_seconds() / 3600.0 / 24.0 * self.graph_width + gX
             hourdeltaPx = self.graph_width / 24.0
 
-            yy = self.graph_Y
-            font = cv2.FONT_HERSHEY_SIMPLEX
             onlyHour = firstIntHourTime.hour
-            skipHour = False               
+            skipHour = False
             for i in range(26):
                 xPos = int(startingX + i * hourdeltaPx)
-                if xPos > self.graph_X and xPos < self.graph_X + self.graph_width:
-                    cv2.line(img=canvas, pt1=(xPos, self.graph_Y), pt2=(xPos, self.graph_Y - tickSize), thickness=2, color=self.border_color)
+                if xPos > gX and xPos < gX + self.graph_width:
+                    canvas.draw(cv2.line, pt1=(xPos, gY), pt2=(xPos, gY - tickSize), thickness=2, color=self.border_color)
                     if params["hour_nums"] == True:
-                        textSz = cv2.getTextSize(str(onlyHour).zfill(2), font, textSize, 1)[0]
-                        textX = xPos - int(textSz[0] / 2.0)
+                        textX = xPos - int(textWidth / 2.0)
                         if skipHour:
                             skipHour = False
-                        elif textSz[0] > hourdeltaPx:
+                        elif textWidth > hourdeltaPx:
                             skipHour = True
                         if not skipHour:
-                            cv2.putText(canvas, str(onlyHour).zfill(2), (textX, self.graph_Y - tickSize - 1), font, textSize, self.text_color, 1, cv2.LINE_AA)
+                            canvas.draw(cv2.putText, text=str(onlyHour).zfill(2), org=(textX, gY - tickSize - 1), fontFace=font, fontScale=textSize, color=self.text_color, thickness=1, lineType=cv2.LINE_AA)
                 onlyHour = onlyHour + 1
                 if onlyHour == 24:
                     onlyHour = 0
 
-        # now mark
+        # now mark, always at the same place on the graph
         if params["now_point"] == "Center":
-            startingX = int(self.graph_X + self.graph_width / 2.0)
+            startingX = int(gX + self.graph_width / 2.0)
         else:
-            startingX = self.graph_X
+            startingX = gX
         
-        tri = np.array([[startingX, self.graph_Y + 8], [startingX - 5, self.graph_Y], [startingX + 5, self.graph_Y]])
-        cv2.fillPoly(img=canvas, pts=[tri], color=self.border_color)
-        tri = np.array([[startingX, self.graph_Y + self.graph_height - 8], [startingX - 5, self.graph_Y + self.graph_height], [startingX + 5, self.graph_Y + self.graph_height]])
-        cv2.fillPoly(img=canvas, pts=[tri], color=self.border_color)
+        tri = np.array([[startingX, gY + 8], [startingX - 5, gY], [startingX + 5, gY]])
+        canvas.draw(cv2.fillPoly, pts=[tri], color=self.border_color)
+        tri = np.array([[startingX, gY + self.graph_height - 8], [startingX - 5, gY + self.graph_height], [startingX + 5, gY + self.graph_height]])
+        canvas.draw(cv2.fillPoly, pts=[tri], color=self.border_color)
+
+        return self._cropSprite(canvas, self.graph_X - margin, self.graph_Y - margin)
+
+    def _renderElevation(self, params):
+        '''
+        Renders the sun and moon elevation chart into a BGRA sprite
+        '''
+        margin = 2
+        eX = eY = margin
+        canvas = SpriteCanvas(self.elev_width + 2 * margin, self.elev_height + 2 * margin)
+        elevColor = self.elev_color
 
-        #elev chart
+        # box
+        canvas.draw(cv2.rectangle, pt1=(eX, eY), \
+            pt2=(eX + self.elev_width, eY + self.elev_height), \
+            thickness=1, color=elevColor)
+        canvas.draw(cv2.line, pt1=(eX, eY + int(self.elev_height / 2)), \
+                            pt2=(eX + self.elev_width, eY + int(self.elev_height / 2)), thickness=2, color=elevColor)
+        TROPIC = 23.5
+        POLAR = 66.5
+        for latitude in (POLAR, TROPIC, -POLAR, -TROPIC):
+            yPos = eY + int(self.elev_height / 2 - latitude * self.elev_height / 180.0)
+            canvas.draw(cv2.line, pt1=(eX, yPos), pt2=(eX + self.elev_width, yPos), thickness=1, color=elevColor)
+        
+        # hours
+        firstIntHourTime = self.startTime.replace(second=0, minute=0, microsecond=0)
+        startingX = (firstIntHourTime - self.startTime).total_seconds() / 3600.0 / 24.0 * self.elev_width + eX
+        hourdeltaPx = self.elev_width / 24.0
+        for i in range(25):
+            xPos = int(startingX + i * hourdeltaPx)
+            if xPos > eX and xPos < eX + self.elev_width:
+                canvas.draw(cv2.line, pt1=(xPos, eY), pt2=(xPos, eY + self.elev_height), thickness=1, color=elevColor)
+
+        # mark
+        if params["now_point"] == "Center":
+            startingX = eX + int(self.elev_width / 2)
+        else:
+            startingX = eX
+        canvas.draw(cv2.line, pt1=(startingX, eY), pt2=(startingX, eY + self.elev_height), thickness=2, color=elevColor)
+
+        # paths
+        middle = eY + int(self.elev_height / 2.0)
+        xs = eX + (np.arange(len(self.sunPath)) * self.res).astype(np.int32)
+        sunPts = np.column_stack((xs, middle - np.array([p[1] for p in self.sunPath], np.int32)))
+        moonPts = np.column_stack((xs, middle - np.array([p[1] for p in self.moonPath], np.int32)))
+        canvas.draw(cv2.polylines, pts=[sunPts.reshape(-1, 1, 2)], isClosed=False, color=self.sun_color, thickness=1)
+        canvas.draw(cv2.polylines, pts=[moonPts.reshape(-1, 1, 2)], isClosed=False, color=self.moon_color, thickness=1)
+
+        return self._cropSprite(canvas, self.elev_X - margin, self.elev_Y - margin)
+
+    def _spriteKey(self, params):
+        '''
+        The sprites only need to be rendered again when the graph moves by a pixel or the settings change
+        '''
+        width = self.graph_width
         if params["draw_elev"] == True:
-            # box
-            cv2.rectangle(img=canvas, pt1=(self.elev_X, self.elev_Y), \
-                pt2=(self.elev_X + self.elev_width, self.elev_Y + self.elev_height), \
-                thickness=1, color=self.elev_color)
-            cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2)), thickness=2, color=self.elev_color)
-            TROPIC = 23.5
-            POLAR = 66.5
-            cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2 - POLAR * self.elev_height / 180.0)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 - POLAR * self.elev_height / 180.0)), thickness=1, color=self.elev_color)
-            cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2 - TROPIC * self.elev_height / 180.0)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 - TROPIC * self.elev_height / 180.0)), thickness=1, color=self.elev_color)
-            cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2 + POLAR * self.elev_height / 180.0)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 + POLAR * self.elev_height / 180.0)), thickness=1, color=self.elev_color)
-            cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2 + TROPIC * self.elev_height / 180.0)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 + TROPIC * self.elev_height / 180.0)), thickness=1, color=self.elev_color)
-            
-            # hours
-            startingX = (firstIntHourTime - self.startTime).total_seconds() / 3600.0 / 24.0 * self.elev_width + self.elev_X
-            hourdeltaPx = self.elev_width / 24.0
-            yy = self.elev_Y
-            onlyHour = firstIntHourTime.hour               
-            for i in range(25):
-                xPos = int(startingX + i * hourdeltaPx)
-                if xPos > self.elev_X and xPos < self.elev_X + self.elev_width:
-                    cv2.line(img=canvas, pt1=(xPos, self.elev_Y), pt2=(xPos, self.elev_Y + self.elev_height), thickness=1, color=self.elev_color)
-                onlyHour = onlyHour + 1
-                if onlyHour == 24:
-                    onlyHour = 0
+            width = max(width, self.elev_width)
+        pixelSeconds = 24.0 * 3600.0 / width
+        step = int((self.startTimeUTC - datetime.datetime(1970, 1, 1)).total_seconds() // pixelSeconds)
+        utcOffset = int(round((self.nowTime - self.nowTimeUTC).total_seconds() / 60.0))
+
+        settings = [params[name] for name in SPRITE_PARAMS]
+        geometry = [self.image_width, self.image_height, self.graph_X, self.graph_Y, self.graph_width, self.graph_height,
+                    self.elev_X, self.elev_Y, self.elev_width, self.elev_height]
+        return json.dumps([self.ephemeris.key, step, utcOffset, geometry, settings])
+
+    def _blend(self, blend):
+        '''
+        Blends a sprite into the image in place, only the sprite's area of the image is touched
+        '''
+        color, weight, inverse, x, y = blend
+        h, w = color.shape[:2]
+        roi = s.image[y:y + h, x:x + w]
+        cv2.blendLinear(color, roi, weight, inverse, dst=roi)
 
-            # mark
-            if params["now_point"] == "Center":
-                startingX = self.elev_X+ int(self.elev_width / 2)
-            else:
-                startingX = self.elev_X 
-            cv2.line(img=canvas, pt1=(startingX, self.elev_Y), pt2=(startingX, self.elev_Y + self.elev_height), thickness=2, color=self.elev_color)
-
-            # paths
-            for i in range(len(self.sunPath) - 1):
-                cv2.line(img=canvas, \
-                    pt1=(self.elev_X + int(i * self.res), \
-                        self.elev_Y + int(self.elev_height / 2.0) - self.sunPath[i][1]), \
-                    pt2=(self.elev_X + int((i + 1) * self.res), \
-                        self.elev_Y + int(self.elev_height / 2.0) - self.sunPath[i + 1][1]), \
-                    thickness=1, color=self.sun_color)
-                cv2.line(img=canvas, \
-                    pt1=(self.elev_X + int(i * self.res), \
-                        self.elev_Y + int(self.elev_height / 2.0) - self.moonPath[i][1]), \
-                    pt2=(self.elev_X + int((i + 1) * self.res), \
-                        self.elev_Y + int(self.elev_height / 2.0) - self.moonPath[i + 1][1]), \
-                    thickness=1, color=self.moon_color)
-
-        if alpha < 1.0:
-            tmpcanv = cv2.addWeighted(canvas, alpha, s.image, 1 - alpha, 0)
-            s.image = tmpcanv
-        else:
-            s.image = canvas
+    def draw (self, params):
+        global _sprites
+        alpha = float(params["alpha"])
+        channels = s.image.shape[2] if s.image.ndim == 3 else 1
+
+        key = self._spriteKey(params)
+        if _sprites is None or _sprites[0] != (key, alpha, channels):
+            allskyHome = s.getEnvironmentVariable("ALLSKY_HOME")
+            path = os.path.join(allskyHome, "tmp", SPRITE_FILE) if allskyHome else None
+
+            sprites = loadSprites(path, key) if path is not None else None
+            if sprites is None:
+                sprites = [self._renderGraph(params)]
+                if params["draw_elev"] == True:
+                    sprites.append(self._renderElevation(params))
+                sprites = [sprite for sprite in sprites if sprite is not None]
+                if path is not None:
+                    saveSprites(path, key, sprites)
+            _sprites = ((key, alpha, channels), [prepareBlend(sprite, x, y, alpha, channels == 1) for sprite, x, y in sprites])
+
+        for blend in _sprites[1]:
+            self._blend(blend)
 
     def exportData(self):
         # this is temporary until allsky exports all relevant datetimes
@@ -752,18 +887,15 @@ class lGraph():
         sun_alt = "{:.3f}".format(degrees(sun.alt))
         sun_az = "{:.3f}".format(degrees(sun.az))
 
-        self.location.date = ephem.Date(self.startTime)
+        start = float(ephem.Date(self.startTime))
 
-        moon = ephem.Moon()
-        moon.compute(self.location)
-        moon_trans = ephem.localtime(self.location.next_transit(ephem.Moon())).time().strftime("%H:%M")
-        moon_atran = ephem.localtime(self.location.next_antitransit(ephem.Moon())).time().strftime("%H:%M")
-        moon_rise = ephem.localtime(self.location.next_rising(ephem.Moon())).time().strftime("%H:%M")
-        moon_set = ephem.localtime(self.location.next_setting(ephem.Moon())).time().strftime("%H:%M")
+        moon_trans = self._eventTime("MoonTransit", start)
+        moon_atran = self._eventTime("MoonAntiTransit", start)
+        moon_rise = self._eventTime("MoonRise", start)
+        moon_set = self._eventTime("MoonSet", start)
         
-        sun.compute(self.location)
-        sun_trans = ephem.localtime(self.location.next_transit(ephem.Sun())).time().strftime("%H:%M")
-        sun_atran = ephem.localtime(self.location.next_antitransit(ephem.Sun())).time().strftime("%H:%M")
+        sun_trans = self._eventTime("Noon", start)
+        sun_atran = self._eventTime("Midnight", start)
         
         #age = moon.age()
 
@@ -1,20 +1,72 @@
 from datetime import datetime, timedelta
-import os, sys, json
+import os, sys, json, time, threading, struct
+from concurrent.futures import ThreadPoolExecutor
 import allsky_shared as s
 
-# --- NCNN backend & image utils ---
-import ncnn
+# --- Image utils, ncnn and requests are only imported once the model is needed ---
 import numpy as np
-from PIL import Image
-import requests  # for first-time download and update
+import cv2
 
 metaData = {
     "name": "YOLO Rain Detector",
     "description": "Detects raindrops using NCNN-converted YOLO model and updates overlay.",
     "module": "raindetector",
-    "version": "v1.0.0",
+    "version": "v1.0.5",
     "events": ["day", "night"],
     "enabled": "false",
+    "arguments": {
+        "tiled": "false",
+        "tile_grid": 2,
+        "tile_overlap": 0.2,
+        "tile_threads": 2
+    },
+    "argumentdetails": {
+        "tiled": {
+            "required": "false",
+            "description": "Tiled Detection",
+            "help": "Run the detector on overlapping tiles of the sky instead of the whole image. This finds smaller raindrops on large sensors at the cost of more CPU",
+            "tab": "Tiling",
+            "type": {
+                "fieldtype": "checkbox"
+            }
+        },
+        "tile_grid": {
+            "required": "false",
+            "description": "Tiles",
+            "help": "The sky is split into this many tiles across and down, so 2 runs the detector 4 times",
+            "tab": "Tiling",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 1,
+                "max": 4,
+                "step": 1
+            }
+        },
+        "tile_overlap": {
+            "required": "false",
+            "description": "Tile Overlap",
+            "help": "The fraction of each tile that overlaps its neighbours so raindrops on the tile edges are not missed",
+            "tab": "Tiling",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 0.5,
+                "step": 0.05
+            }
+        },
+        "tile_threads": {
+            "required": "false",
+            "description": "Threads",
+            "help": "The number of tiles processed at the same time",
+            "tab": "Tiling",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 1,
+                "max": 4,
+                "step": 1
+            }
+        }
+    },
     "changelog": {
         "v1.0.0": [
             {
@@ -22,6 +74,41 @@ metaData = {
                 "authorurl": "https://github.com/MCH0202",
                 "changes": "Switch to NCNN inference with identical state logic (cooldown/window/overlay)."
             }
+        ],
+        "v1.0.1": [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Rate limited, conditional model update checks and verified, atomic model downloads"
+            }
+        ],
+        "v1.0.2": [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Use the in memory frame, reuse the letterbox buffer, native OpenCV NMS and per stage timings"
+            }
+        ],
+        "v1.0.3": [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Added optional tiled detection"
+            }
+        ],
+        "v1.0.4": [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Detection state kept in a small binary state file that is only written when it changes"
+            }
+        ],
+        "v1.0.5" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "The model is loaded on the first detection instead of at import and update checks run in the background"
+            }
         ]
     }
 }
@@ -46,294 +133,644 @@ NCNN_IOU_THRES  = 0.50
 NCNN_THREADS    = 4
 USE_VULKAN      = False
 
-# ---------------- Ensure model exists & update if a new version is available ----------------
-try:
+MODEL_UPDATE_STATE_PATH = f"{MODEL_DIR}/update.json"
+MODEL_UPDATE_INTERVAL   = 24 * 3600
+VERSION_TIMEOUT         = 8
+DOWNLOAD_TIMEOUT        = (10, 60)
+NCNN_PARAM_SIGNATURE    = (0, b"7767517")
+
+# ---------------- Model artifacts: rate limited, conditional update checks & atomic downloads ----------------
+# allsky_ai and allsky_raindetector carry identical copies of ModelArtifacts. The module installer copies each
+# module as a single file, so there is nowhere they can import a shared copy from. Change both copies together.
+class ModelArtifacts:
+    """
+    Keeps the files of a downloaded model up to date. Version checks are rate limited and conditional, they send
+    the ETag and Last-Modified of the previous check so an unchanged version costs a 304. New files are only
+    swapped in once every one of them has downloaded and been verified, and the version file is written last so
+    an interrupted update is retried.
+
+    :param name: Name used in the log messages
+    :param state_path: File holding the url, time and validators of the last version check
+    :param version_path: Local version file
+    :param version_timeout: Timeout in seconds for the version check
+    :param download_timeout: requests timeout for each file download
+    """
+
+    def __init__(self, name, state_path, version_path, version_timeout, download_timeout):
+        self.name = name
+        self.state_path = state_path
+        self.version_path = version_path
+        self.version_timeout = version_timeout
+        self.download_timeout = download_timeout
+
+    def read_state(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_state(self, state):
+        with open(self.state_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def local_version(self):
+        try:
+            with open(self.version_path, "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def check_for_update(self, version_url, interval, is_newer, force=False):
+        """
+        Returns the server's version if is_newer(version) is True, otherwise None. Unless forced the check is
+        only made once every interval seconds for the same version_url.
+        """
+        import requests
+
+        state = self.read_state()
+        now = time.time()
+        same_url = state.get("url") == version_url
+        if not force and same_url and now - state.get("last_check", 0) < interval:
+            return None
+
+        headers = {}
+        if not force and same_url:
+            if state.get("etag"):
+                headers["If-None-Match"] = state["etag"]
+            if state.get("last_modified"):
+                headers["If-Modified-Since"] = state["last_modified"]
+
+        remote_version = None
+        try:
+            r = requests.get(version_url, headers=headers, timeout=self.version_timeout)
+            if r.status_code == 304:
+                s.log(1, f"{self.name}: Model is up to date")
+            elif r.status_code == 200 and 0 < len(r.text.strip()) < 64:
+                version = r.text.strip()
+                if is_newer(version):
+                    remote_version = version
+                else:
+                    s.log(1, f"{self.name}: Model is up to date")
+                # Only remember the validators once we have the current model, so a failed download is retried
+                state["etag"] = "" if remote_version else r.headers.get("ETag", "")
+                state["last_modified"] = "" if remote_version else r.headers.get("Last-Modified", "")
+            else:
+                s.log(0, f"{self.name} Error: Version check failed ({r.status_code})")
+        except Exception as e:
+            s.log(0, f"{self.name} Error: Version check failed - {e}")
+
+        state["url"] = version_url
+        state["last_check"] = now
+        try:
+            self.write_state(state)
+        except OSError as e:
+            s.log(0, f"{self.name} Error: Could not save the update state - {e}")
+
+        return remote_version
+
+    def download_file(self, url, target, min_size, signature=None):
+        """
+        Stream url to a temporary file next to target. The temporary path is only returned if the download
+        completed, matches the size the server reported, is at least min_size bytes and, if given, has the
+        (offset, magic) signature.
+        """
+        import requests
+
+        part_path = target + ".part"
+        try:
+            s.log(1, f"{self.name}: Downloading {url}")
+            with requests.get(url, stream=True, timeout=self.download_timeout) as r:
+                if r.status_code != 200:
+                    raise RuntimeError(f"download failed ({r.status_code})")
+                size = 0
+                with open(part_path, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=65536):
+                        f.write(chunk)
+                        size += len(chunk)
+                expected = r.headers.get("Content-Length")
+                if expected is not None and "Content-Encoding" not in r.headers and int(expected) != size:
+                    raise RuntimeError(f"incomplete download, got {size} of {expected} bytes")
+            if size < min_size:
+                raise RuntimeError(f"download is too small ({size} bytes)")
+            if signature is not None:
+                offset, magic = signature
+                with open(part_path, "rb") as f:
+                    if f.read(offset + len(magic))[offset:] != magic:
+                        raise RuntimeError("download is not a valid file")
+        except Exception as e:
+            s.log(0, f"{self.name} Error: {url} - {e}")
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return None
+        return part_path
+
+    def download(self, artifacts, version):
+        """
+        Download the (url, target, min_size, signature) artifacts and only replace the existing files once all
+        of them are verified. The version, if known, is written last. Returns True if the files were replaced.
+        """
+        downloaded = []
+        for url, target, min_size, signature in artifacts:
+            part_path = self.download_file(url, target, min_size, signature)
+            if part_path is None:
+                for part_path, _ in downloaded:
+                    os.remove(part_path)
+                return False
+            downloaded.append((part_path, target))
+
+        for part_path, target in downloaded:
+            os.replace(part_path, target)
+
+        if version is not None:
+            with open(self.version_path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(version)
+            os.replace(self.version_path + ".tmp", self.version_path)
+        return True
+
+
+_model_artifacts = ModelArtifacts("Rain detector", MODEL_UPDATE_STATE_PATH, MODEL_VERSION_PATH,
+                                  VERSION_TIMEOUT, DOWNLOAD_TIMEOUT)
+MODEL_ARTIFACTS = [
+    (MODEL_PARAM_URL, MODEL_PARAM_PATH, 100, NCNN_PARAM_SIGNATURE),
+    (MODEL_BIN_URL, MODEL_BIN_PATH, 1000, None),
+]
+
+
+def model_files_exist():
+    return os.path.isfile(MODEL_PARAM_PATH) and os.path.isfile(MODEL_BIN_PATH)
+
+
+def ensure_model():
+    """
+    Ensure the model exists and update it if a new version is available.
+    Returns True if new model files were downloaded.
+    """
     if not os.path.isdir(MODEL_DIR):
         os.makedirs(MODEL_DIR, exist_ok=True)
 
-    # Read local version (best-effort)
-    local_ver = None
-    if os.path.isfile(MODEL_VERSION_PATH):
-        try:
-            with open(MODEL_VERSION_PATH, "r", encoding="utf-8") as f:
-                local_ver = f.read().strip()
-        except Exception:
-            local_ver = None
+    local_ver = _model_artifacts.local_version()
+    missing_files = not model_files_exist()
+    remote_ver = _model_artifacts.check_for_update(VERSION_URL, MODEL_UPDATE_INTERVAL,
+                                                   lambda version: version != local_ver, force=missing_files)
 
-    # Fetch remote version (if fail still run with local files)
-    remote_ver = None
-    try:
-        vr = requests.get(VERSION_URL, timeout=8)
-        if vr.status_code == 200 and 0 < len(vr.text) < 64:
-            remote_ver = vr.text.strip()
-    except Exception:
-        remote_ver = None
-
-    # Decide if need to (re)download
-    missing_files = (not os.path.isfile(MODEL_PARAM_PATH)) or (not os.path.isfile(MODEL_BIN_PATH))
-    version_changed = (remote_ver is not None) and (remote_ver != local_ver)
-    need_download = missing_files or version_changed
-
-    if need_download:
+    if missing_files or remote_ver is not None:
         print("[NCNN] Fetching model artifacts...")
+        return _model_artifacts.download(MODEL_ARTIFACTS, remote_ver)
+    return False
+
+
+def load_net():
+    """Load the NCNN model from disk, returns None if it could not be loaded."""
+    import ncnn
+
+    try:
+        net = ncnn.Net()
+        net.opt.use_vulkan_compute = USE_VULKAN
+        net.opt.num_threads = NCNN_THREADS
+        r1 = net.load_param(NCNN_PARAM)
+        r2 = net.load_model(NCNN_BIN)
+        if r1 == 0 and r2 == 0:
+            return net
+        print(f"[NCNN] load failed: param_ret={r1}, model_ret={r2}, param={NCNN_PARAM}, bin={NCNN_BIN}")
+    except Exception as e:
+        print(f"[NCNN] load exception: {e}")
+    return None
+
+
+class ModelHolder:
+    """
+    Holds the NCNN model. Nothing is loaded, or downloaded, at import so the module manager
+    can read metaData without the network or the model files. The model is loaded on the
+    first get() and kept for the life of the process.
+
+    Once the model is in use, update checks run on a background thread every
+    MODEL_UPDATE_INTERVAL (check_for_update is also rate limited between processes), a
+    downloaded model is swapped in on the next get(). The lock is held while model files
+    are downloaded or loaded so a model is never loaded from a half replaced set of files.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._net = None
+        self._stale = False
+        self._updater = None
+
+    def get(self):
+        net = self._net
+        if net is not None and not self._stale:
+            return net
+
+        with self._lock:
+            if self._net is None or self._stale:
+                if self._net is None and not model_files_exist():
+                    # Nothing can be detected without a model so the first download has to be waited for
+                    try:
+                        ensure_model()
+                    except Exception as e:
+                        print(f"[NCNN] model setup failed: {e}")
+                net = load_net()
+                if net is not None:
+                    self._net = net
+                    self._stale = False
+
+            if self._updater is None:
+                self._updater = threading.Thread(target=self._update_loop, name="raindetector-update", daemon=True)
+                self._updater.start()
+
+            return self._net
 
-        # Download .param
-        r = requests.get(MODEL_PARAM_URL, timeout=30)
-        if r.status_code != 200 or len(r.content) < 100:
-            raise RuntimeError(f"param download failed (code={r.status_code}, size={len(r.content)})")
-        with open(MODEL_PARAM_PATH, "wb") as f:
-            f.write(r.content)
-
-        # Download .bin
-        r = requests.get(MODEL_BIN_URL, timeout=60)
-        if r.status_code != 200 or len(r.content) < 1000:
-            raise RuntimeError(f"bin download failed (code={r.status_code}, size={len(r.content)})")
-        with open(MODEL_BIN_PATH, "wb") as f:
-            f.write(r.content)
-
-        # Basic validation
-        if os.path.getsize(MODEL_PARAM_PATH) < 100 or os.path.getsize(MODEL_BIN_PATH) < 1000:
-            raise RuntimeError("downloaded files look invalid (too small).")
-
-        # Persist remote version if available
-        if remote_ver:
-            with open(MODEL_VERSION_PATH, "w", encoding="utf-8") as f:
-                f.write(remote_ver)
-
-except Exception as e:
-    print(f"[NCNN] model setup/update failed: {e}")
-
-# ---------------- Preload NCNN model at import ----------------
-_preloaded_net = None
-try:
-    net = ncnn.Net()
-    net.opt.use_vulkan_compute = USE_VULKAN
-    net.opt.num_threads = NCNN_THREADS
-    r1 = net.load_param(NCNN_PARAM)
-    r2 = net.load_model(NCNN_BIN)
-    if r1 == 0 and r2 == 0:
-        _preloaded_net = net
+    def _update_loop(self):
+        while True:
+            try:
+                with self._lock:
+                    if ensure_model():
+                        self._stale = True
+            except Exception as e:
+                print(f"[NCNN] model update failed: {e}")
+            time.sleep(MODEL_UPDATE_INTERVAL)
+
+
+_model = ModelHolder()
+
+# ---------------- Preprocessing, inference & NMS ----------------
+# Each thread reuses its own letterbox canvas between frames, only the resized image area is rewritten
+_letterbox = threading.local()
+_tile_pool = {"executor": None, "workers": 0}
+
+
+def letterbox(image):
+    """
+    Letterbox a BGR (or gray) frame into the reusable NCNN_IMG_SZ square canvas
+    (keep ratio, pad 114,114,114). The frame is resized straight into the canvas.
+    Returns the canvas, the scale and the x/y padding.
+    """
+    H, W = image.shape[:2]
+    r = min(NCNN_IMG_SZ / H, NCNN_IMG_SZ / W)
+    new_w, new_h = int(round(W * r)), int(round(H * r))
+    pad_x = (NCNN_IMG_SZ - new_w) // 2
+    pad_y = (NCNN_IMG_SZ - new_h) // 2
+
+    if getattr(_letterbox, "buffer", None) is None or _letterbox.shape != (H, W):
+        _letterbox.buffer = np.full((NCNN_IMG_SZ, NCNN_IMG_SZ, 3), 114, dtype=np.uint8)
+        _letterbox.shape = (H, W)
+
+    canvas = _letterbox.buffer
+    roi = canvas[pad_y:pad_y + new_h, pad_x:pad_x + new_w]
+    if image.ndim == 2:
+        roi[...] = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)[..., None]
     else:
-        print(f"[NCNN] preload failed: param_ret={r1}, model_ret={r2}, param={NCNN_PARAM}, bin={NCNN_BIN}")
-        _preloaded_net = None
-except Exception as e:
-    print(f"[NCNN] preload exception: {e}")
-    _preloaded_net = None
+        cv2.resize(image, (new_w, new_h), dst=roi, interpolation=cv2.INTER_LINEAR)
+    return canvas, r, pad_x, pad_y
+
+
+def nms(xyxy, scores, iou_thres):
+    """
+    Greedy NMS with OpenCV's native cv2.dnn.NMSBoxes, the same suppression as the original Python
+    loop without a Python iteration per kept box. Returns the indices of the kept boxes.
+    """
+    boxes = np.column_stack((xyxy[:, :2], xyxy[:, 2:] - xyxy[:, :2])).astype(np.float64)
+    keep = cv2.dnn.NMSBoxes(boxes, scores.astype(np.float32), 0.0, iou_thres)
+    return np.asarray(keep, dtype=int).reshape(-1)
+
+
+def detect_boxes(net, image):
+    """
+    Run the detector on an image and return the candidate boxes, as xyxy in image
+    pixels, their scores and the time, in ms, taken by each stage.
+    Returns None for the boxes on failure.
+    """
+    import ncnn
+
+    timings = {}
+    t0 = time.perf_counter()
+    canvas, r, pad_x, pad_y = letterbox(image)
+
+    # Forward: in0 -> out0 ; BGR -> RGB and normalize to [0,1]
+    mat_in = ncnn.Mat.from_pixels(
+        canvas, ncnn.Mat.PixelType.PIXEL_BGR2RGB, NCNN_IMG_SZ, NCNN_IMG_SZ
+    )
+    mat_in.substract_mean_normalize([0.0, 0.0, 0.0], [1/255., 1/255., 1/255.])
+    t1 = time.perf_counter()
+    timings["preprocess"] = (t1 - t0) * 1000
+
+    ex = net.create_extractor()
+    if ex.input("in0", mat_in) != 0:
+        print("[NCNN] ex.input failed")
+        return None, None, timings
+
+    out = ncnn.Mat()
+    ret = ex.extract("out0", out)
+    if ret != 0:
+        print(f"[NCNN] ex.extract failed ret={ret}")
+        return None, None, timings
+    timings["inference"] = (time.perf_counter() - t1) * 1000
+
+    # Parse output: assume (5, N) or (N, 5) as [x, y, w, h, conf] for a single class
+    arr = np.array(out)
+    xyxy = np.empty((0, 4), dtype=np.float32)
+    scores = np.empty((0,), dtype=np.float32)
+
+    if arr.ndim == 2:
+        if arr.shape[0] == 5:
+            arr = arr.T  # -> (N, 5)
+        if arr.shape[1] >= 5:
+            arr = arr[arr[:, 4] > NCNN_CONF_THRES]
+            if arr.size:
+                # xywh in NCNN_IMG_SZ² -> xyxy in image pixels
+                half_wh = arr[:, 2:4] / 2
+                xyxy = np.concatenate((arr[:, :2] - half_wh, arr[:, :2] + half_wh), axis=1)
+                xyxy = (xyxy - (pad_x, pad_y, pad_x, pad_y)) / r
+                scores = arr[:, 4]
+
+    return xyxy, scores, timings
+
+
+def detect(net, image):
+    """
+    Run the detector on the whole frame and return the number of boxes after NMS
+    and the time, in ms, taken by each stage. Returns None for the count on failure.
+    """
+    xyxy, scores, timings = detect_boxes(net, image)
+    if xyxy is None:
+        return None, timings
+
+    t0 = time.perf_counter()
+    boxes_len = len(nms(xyxy, scores, NCNN_IOU_THRES)) if len(scores) else 0
+    timings["nms"] = (time.perf_counter() - t0) * 1000
+    return boxes_len, {stage: round(value, 1) for stage, value in timings.items()}
+
+
+def get_tiles(image, grid, overlap):
+    """
+    Split the dome, the centred square of the frame, into grid x grid tiles that
+    overlap their neighbours by the overlap fraction. Returns (x0, y0, x1, y1) per tile.
+    """
+    H, W = image.shape[:2]
+    dome = min(H, W)
+    dome_x, dome_y = (W - dome) // 2, (H - dome) // 2
+
+    tile = int(np.ceil(dome / (grid - (grid - 1) * overlap)))
+    starts = np.linspace(0, dome - tile, grid).astype(int).tolist() if grid > 1 else [0]
+
+    return [(dome_x + x, dome_y + y, dome_x + x + tile, dome_y + y + tile) for y in starts for x in starts]
+
+
+def detect_tiled(net, image, grid, overlap, workers):
+    """
+    Run the detector on overlapping tiles of the dome across a thread pool, each
+    thread using its own extractor, and merge the detections with a global NMS.
+    Returns the number of boxes and the per stage timings, summed over the tiles,
+    plus the number of tiles, the wall clock time and the CPU time used.
+    """
+    if _tile_pool["executor"] is None or _tile_pool["workers"] != workers:
+        if _tile_pool["executor"] is not None:
+            _tile_pool["executor"].shutdown(wait=False)
+        _tile_pool["executor"] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="raindetector")
+        _tile_pool["workers"] = workers
+
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    tiles = get_tiles(image, grid, overlap)
+
+    def run_tile(tile):
+        x0, y0, x1, y1 = tile
+        xyxy, scores, timings = detect_boxes(net, image[y0:y1, x0:x1])
+        if xyxy is not None:
+            xyxy = xyxy + (x0, y0, x0, y0)
+        return xyxy, scores, timings
+
+    results = list(_tile_pool["executor"].map(run_tile, tiles))
+
+    timings = {"preprocess": 0.0, "inference": 0.0}
+    all_boxes, all_scores = [], []
+    for xyxy, scores, tile_timings in results:
+        if xyxy is None:
+            return None, timings
+        all_boxes.append(xyxy)
+        all_scores.append(scores)
+        for stage in timings:
+            timings[stage] += tile_timings.get(stage, 0.0)
+
+    t0 = time.perf_counter()
+    xyxy, scores = np.concatenate(all_boxes), np.concatenate(all_scores)
+    boxes_len = len(nms(xyxy, scores, NCNN_IOU_THRES)) if len(scores) else 0
+    timings["nms"] = (time.perf_counter() - t0) * 1000
+
+    timings["total"] = (time.perf_counter() - wall0) * 1000
+    timings["cpu"] = (time.process_time() - cpu0) * 1000
+    timings = {stage: round(value, 1) for stage, value in timings.items()}
+    timings["tiles"] = len(tiles)
+    return boxes_len, timings
+
+
+# ---------------- Detection state ----------------
+STATE_FIELDS       = ("cooldown_until", "first_raindrop_time")
+STATE_HISTORY_SIZE = 16
+
+
+class StateStore:
+    """
+    Small, fixed size, binary state file holding a set of named integer values
+    (e.g. epoch seconds) and a ring buffer of the most recent integer entries.
+
+    Loading is a single struct unpack and save() only rewrites the file, atomically,
+    when the state has changed, so an unchanged state costs no write at all.
+    """
+
+    def __init__(self, path, fields, history_size):
+        self._path = path
+        self._fields = fields
+        self._history_size = history_size
+        # magic, fields..., history count, history index, history...
+        self._struct = struct.Struct(f"<4s{len(fields) + 2 + history_size}q")
+        self._values = [0] * (len(fields) + 2 + history_size)
+        self._saved = None
+
+    def load(self):
+        """Returns False if there was no valid state file."""
+        try:
+            with open(self._path, "rb") as f:
+                data = f.read()
+            magic, *values = self._struct.unpack(data)
+            if magic != b"ASS1":
+                return False
+        except (OSError, struct.error):
+            return False
+        self._values = values
+        self._saved = data
+        return True
+
+    def save(self):
+        data = self._struct.pack(b"ASS1", *self._values)
+        if data == self._saved:
+            return False
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path)
+        self._saved = data
+        return True
+
+    def get(self, field):
+        return self._values[self._fields.index(field)]
+
+    def set(self, field, value):
+        self._values[self._fields.index(field)] = int(value)
+
+    def append(self, value):
+        base = len(self._fields)
+        count, index = self._values[base], self._values[base + 1]
+        self._values[base + 2 + index] = int(value)
+        self._values[base + 1] = (index + 1) % self._history_size
+        self._values[base] = min(count + 1, self._history_size)
+
+    def history(self, since=None):
+        """Ring buffer entries, oldest first, optionally only those >= since."""
+        base = len(self._fields)
+        count, index = self._values[base], self._values[base + 1]
+        ring = self._values[base + 2:]
+        entries = [ring[(index - count + i) % self._history_size] for i in range(count)]
+        if since is not None:
+            entries = [t for t in entries if t >= since]
+        return entries
+
+
+def migrate_status(state, legacy_status_path):
+    """One off import of the old yolo_status.json into the state store."""
+    if not os.path.exists(legacy_status_path):
+        return
+    try:
+        with open(legacy_status_path) as f:
+            status = json.load(f)
+        for field in STATE_FIELDS:
+            if status.get(field):
+                state.set(field, datetime.fromisoformat(status[field]).timestamp())
+        for t in status.get("detection_history", [])[-STATE_HISTORY_SIZE:]:
+            state.append(datetime.fromisoformat(t).timestamp())
+        state.save()
+        os.remove(legacy_status_path)
+    except Exception as e:
+        print(f"Warning: Failed to migrate {legacy_status_path} - {e}")
+
+
+def format_time(timestamp):
+    if not timestamp:
+        return "Unknown"
+    return datetime.fromtimestamp(timestamp).strftime("%d %b %Y, %H:%M")
 
 
 def raindetector(params, event):
     """
     Single entrypoint for Allsky flow.
-    Loads image from s.CURRENTIMAGEPATH, runs NCNN inference,
+    Takes the current frame from s.image, runs NCNN inference,
     and updates overlay with rain detection state.
     """
-    # --- Use preloaded net if available; otherwise try once more ---
-    if _preloaded_net is not None:
-        _net = _preloaded_net
-    else:
-        _net = ncnn.Net()
-        _net.opt.use_vulkan_compute = USE_VULKAN
-        _net.opt.num_threads = NCNN_THREADS
-        r1 = _net.load_param(NCNN_PARAM)
-        r2 = _net.load_model(NCNN_BIN)
-        if r1 != 0 or r2 != 0:
-            print(f"[NCNN] on-demand load failed: param_ret={r1}, model_ret={r2}, param={NCNN_PARAM}, bin={NCNN_BIN}")
-            return
+    # --- The model is loaded, and if needed downloaded, on the first detection ---
+    _net = _model.get()
+    if _net is None:
+        print("[NCNN] no model available")
+        return
+
+    # ---- Settings ----
+    tiled = str(params.get("tiled", False)).lower() == "true"
+    tile_grid = max(1, int(params.get("tile_grid", 2)))
+    tile_overlap = min(0.5, max(0.0, float(params.get("tile_overlap", 0.2))))
+    tile_threads = max(1, int(params.get("tile_threads", 2)))
 
     # ---- Original constants ----
     RAIN_RESET_INTERVAL = timedelta(minutes=180)
     WINDOW_DURATION = timedelta(minutes=3)
 
     # ---- Status persistence path ----
-    status_path = os.path.join(s.getEnvironmentVariable("ALLSKY_CONFIG"), "overlay", "extra", "yolo_status.json")
-
-    # ---- Input image ----
-    image_path = s.CURRENTIMAGEPATH
-    print("CURRENT_IMAGE =", image_path)
-    if not image_path or not os.path.isfile(image_path):
-        print("Error: CURRENT_IMAGE not found.")
+    status_dir = os.path.join(s.getEnvironmentVariable("ALLSKY_CONFIG"), "overlay", "extra")
+    status_path = os.path.join(status_dir, "yolo_status.bin")
+    legacy_status_path = os.path.join(status_dir, "yolo_status.json")
+
+    # ---- Input image, the frame already decoded by Allsky ----
+    image = getattr(s, "image", None)
+    if image is None:
+        print("Error: no image available.")
         return
 
     now = datetime.now()
-    status = {}
-    in_cooldown = False
-
-    if os.path.exists(status_path):
-        try:
-            with open(status_path) as f:
-                status = json.load(f)
-        except Exception as e:
-            print(f"Warning: Failed to read status.json - {e}")
-            status = {}
+    now_ts = int(now.timestamp())
+    timings = {}
 
-    cooldown_until_str = status.get("cooldown_until")
-    first_raindrop_time_str = status.get("first_raindrop_time")
-    detection_history = status.get("detection_history", [])
+    state = StateStore(status_path, STATE_FIELDS, STATE_HISTORY_SIZE)
+    if not state.load():
+        migrate_status(state, legacy_status_path)
 
-    if cooldown_until_str:
-        try:
-            cooldown_until = datetime.fromisoformat(cooldown_until_str)
-            if now < cooldown_until:
-                in_cooldown = True
-        except Exception as e:
-            print(f"Warning: Failed to parse cooldown_until: {e}")
+    cooldown_until = state.get("cooldown_until")
+    first_raindrop_time = state.get("first_raindrop_time")
 
-    if in_cooldown:
+    if now_ts < cooldown_until:
         # Show previously recorded first drop time during cooldown
-        try:
-            dt_obj = datetime.fromisoformat(first_raindrop_time_str)
-            display_time = dt_obj.strftime("%d %b %Y, %H:%M")
-        except Exception:
-            display_time = first_raindrop_time_str or "Unknown"
-
         overlay_data = {
             "YOLO_RAINDROP_DETECTED": True,
-            "YOLO_FIRST_RAINDROP_TIME": display_time
+            "YOLO_FIRST_RAINDROP_TIME": format_time(first_raindrop_time)
         }
 
     else:
         # ===================== NCNN INFERENCE BLOCK =====================
-        # Read image
-        im = Image.open(image_path).convert("RGB")
-        W, H = im.size
-
-        # Letterbox to square NCNN_IMG_SZ (keep ratio, pad 114,114,114)
-        r = min(NCNN_IMG_SZ / H, NCNN_IMG_SZ / W)
-        new_w, new_h = int(round(W * r)), int(round(H * r))
-        resized = im.resize((new_w, new_h), Image.BILINEAR)
-        pad_x = (NCNN_IMG_SZ - new_w) // 2
-        pad_y = (NCNN_IMG_SZ - new_h) // 2
-        canvas = Image.new("RGB", (NCNN_IMG_SZ, NCNN_IMG_SZ), (114, 114, 114))
-        canvas.paste(resized, (pad_x, pad_y))
-        rgb = np.array(canvas)  # HWC, uint8, RGB
-
-        # Forward: in0 -> out0 ; normalize to [0,1]
-        ex = _net.create_extractor()
-        mat_in = ncnn.Mat.from_pixels(
-            rgb, ncnn.Mat.PixelType.PIXEL_RGB, NCNN_IMG_SZ, NCNN_IMG_SZ
-        )
-        mat_in.substract_mean_normalize([0.0, 0.0, 0.0], [1/255., 1/255., 1/255.])
-        if ex.input("in0", mat_in) != 0:
-            print("[NCNN] ex.input failed")
-            return
-
-        out = ncnn.Mat()
-        ret = ex.extract("out0", out)
-        if ret != 0:
-            print(f"[NCNN] ex.extract failed ret={ret}")
+        if tiled:
+            boxes_len, timings = detect_tiled(_net, image, tile_grid, tile_overlap, tile_threads)
+        else:
+            boxes_len, timings = detect(_net, image)
+        if boxes_len is None:
             return
 
-        # Parse output: assume (5, N) or (N, 5) as [x, y, w, h, conf] for a single class
-        arr = np.array(out)
-        boxes_len = 0
-
-        if arr.ndim == 2:
-            if arr.shape[0] == 5:
-                arr = arr.T  # -> (N, 5)
-            if arr.shape[1] >= 5:
-                conf = arr[:, 4]
-                mask = conf > NCNN_CONF_THRES
-                arr = arr[mask]
-                if arr.size:
-                    # xywh -> xyxy in 1440×1440
-                    xywh = arr[:, :4]
-                    xyxy = np.empty_like(xywh)
-                    xyxy[:, 0] = xywh[:, 0] - xywh[:, 2] / 2
-                    xyxy[:, 1] = xywh[:, 1] - xywh[:, 3] / 2
-                    xyxy[:, 2] = xywh[:, 0] + xywh[:, 2] / 2
-                    xyxy[:, 3] = xywh[:, 1] + xywh[:, 3] / 2
-
-                    # simple NMS
-                    scores = conf[mask]
-                    idxs = np.argsort(scores)[::-1]
-                    keep = []
-                    while idxs.size > 0:
-                        i = idxs[0]; keep.append(i)
-                        if idxs.size == 1:
-                            break
-                        xx1 = np.maximum(xyxy[i, 0], xyxy[idxs[1:], 0])
-                        yy1 = np.maximum(xyxy[i, 1], xyxy[idxs[1:], 1])
-                        xx2 = np.minimum(xyxy[i, 2], xyxy[idxs[1:], 2])
-                        yy2 = np.minimum(xyxy[i, 3], xyxy[idxs[1:], 3])
-                        inter = np.maximum(0, xx2-xx1) * np.maximum(0, yy2-yy1)
-                        area_i = (xyxy[i, 2]-xyxy[i, 0]) * (xyxy[i, 3]-xyxy[i, 1])
-                        area   = (xyxy[idxs[1:], 2]-xyxy[idxs[1:], 0]) * (xyxy[idxs[1:], 3]-xyxy[idxs[1:], 1])
-                        iou = inter / (area_i + area - inter + 1e-9)
-                        idxs = idxs[1:][iou < NCNN_IOU_THRES]
-                    boxes_len = len(keep)
-
         # ===============================================================
 
-        cutoff = now - timedelta(minutes=3)
-        detection_history = [t for t in detection_history if datetime.fromisoformat(t) >= cutoff]
+        cutoff = now_ts - int(WINDOW_DURATION.total_seconds())
+        detection_history = state.history(since=cutoff)
 
         if boxes_len > 0:
-            detection_history.append(now.isoformat())
+            state.append(now_ts)
+            detection_history.append(now_ts)
 
             if len(detection_history) >= 3:
                 is_new_rain = True
-                if first_raindrop_time_str:
-                    try:
-                        prev_time = datetime.fromisoformat(first_raindrop_time_str)
-                        if (now - prev_time) < timedelta(minutes=180):
-                            is_new_rain = False
-                    except Exception as e:
-                        print(f"Warning: Failed to parse first_raindrop_time: {e}")
+                if first_raindrop_time and (now_ts - first_raindrop_time) < RAIN_RESET_INTERVAL.total_seconds():
+                    is_new_rain = False
 
                 if is_new_rain:
-                    first_raindrop_time_str = detection_history[0]
+                    first_raindrop_time = detection_history[0]
 
-                cooldown_until = (now + timedelta(hours=1)).isoformat()
-                display_time = datetime.fromisoformat(first_raindrop_time_str).strftime("%d %b %Y, %H:%M")
+                state.set("cooldown_until", now_ts + 3600)
+                state.set("first_raindrop_time", first_raindrop_time)
 
                 overlay_data = {
                     "YOLO_RAINDROP_DETECTED": True,
-                    "YOLO_FIRST_RAINDROP_TIME": display_time
-                }
-
-                status = {
-                    "cooldown_until": cooldown_until,
-                    "first_raindrop_time": first_raindrop_time_str,
-                    "detection_history": detection_history
+                    "YOLO_FIRST_RAINDROP_TIME": format_time(first_raindrop_time)
                 }
-
-                with open(status_path, "w") as f:
-                    json.dump(status, f, indent=2)
             else:
                 overlay_data = {
                     "YOLO_RAINDROP_DETECTED": "pending",
                     "YOLO_FIRST_RAINDROP_TIME": ""
                 }
-                status["detection_history"] = detection_history
-                with open(status_path, "w") as f:
-                    json.dump(status, f, indent=2)
         else:
             if len(detection_history) == 1:
-                first_time = datetime.fromisoformat(detection_history[0])
-                if now - first_time > timedelta(minutes=3):
-                    detection_history = []
-                    overlay_data = {
-                        "YOLO_RAINDROP_DETECTED": False,
-                        "YOLO_FIRST_RAINDROP_TIME": "N/A"
-                    }
-                else:
-                    overlay_data = {
-                        "YOLO_RAINDROP_DETECTED": "pending",
-                        "YOLO_FIRST_RAINDROP_TIME": ""
-                    }
-                    status["detection_history"] = detection_history
-                    with open(status_path, "w") as f:
-                        json.dump(status, f, indent=2)
+                overlay_data = {
+                    "YOLO_RAINDROP_DETECTED": "pending",
+                    "YOLO_FIRST_RAINDROP_TIME": ""
+                }
             else:
                 overlay_data = {
                     "YOLO_RAINDROP_DETECTED": False,
                     "YOLO_FIRST_RAINDROP_TIME": "N/A"
                 }
 
+        # Only written if a detection changed the state
+        state.save()
+
     # ---- Overlay output ----
     extraData = {
         "AS_YOLORAINDETECTED": {"value": overlay_data["YOLO_RAINDROP_DETECTED"], "expires": 7200},
         "AS_YOLOFIRSTDROP": {"value": overlay_data["YOLO_FIRST_RAINDROP_TIME"], "expires": 7200}
     }
+    for stage, value in timings.items():
+        key = "AS_YOLOTILES" if stage == "tiles" else f"AS_YOLO{stage.upper()}MS"
+        extraData[key] = {"value": value, "expires": 7200}
     s.saveExtraData("yolo_rain.json", extraData)
     print("NCNN inference complete.")
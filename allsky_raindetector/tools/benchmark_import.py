@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+'''
+Measures how long allsky_raindetector.py takes to import, which is what the module manager
+pays just to read metaData, and checks that importing it does not load ncnn or requests.
+
+Each import is timed in a fresh interpreter. allsky_shared, cv2 and numpy are imported first
+as they are already loaded by Allsky before any module. It needs allsky_shared so should be
+run on an Allsky install
+
+    ./benchmark_import.py [runs]
+'''
+import json
+import os
+import subprocess
+import sys
+
+MODULE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+ALLSKY_MODULES = os.path.join(os.environ.get('ALLSKY_HOME', os.path.expanduser('~/allsky')), 'scripts', 'modules')
+
+IMPORT_CODE = '''
+import json, sys, time
+import allsky_shared, cv2, numpy
+start_time = time.perf_counter()
+import allsky_raindetector
+elapsed = time.perf_counter() - start_time
+print(json.dumps({
+    "ms": elapsed * 1000,
+    "ncnn": "ncnn" in sys.modules,
+    "requests": "requests" in sys.modules
+}))
+'''
+
+def time_import():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [MODULE_DIR, ALLSKY_MODULES, env.get('PYTHONPATH')]))
+    output = subprocess.run(
+        [sys.executable, '-c', IMPORT_CODE], env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    results = [time_import() for _ in range(runs)]
+    times = sorted(result['ms'] for result in results)
+    print(f'import {runs} runs, min {times[0]:.1f}ms, median {times[len(times) // 2]:.1f}ms, max {times[-1]:.1f}ms')
+    print(f'ncnn loaded at import: {any(result["ncnn"] for result in results)}')
+    print(f'requests loaded at import: {any(result["requests"] for result in results)}')
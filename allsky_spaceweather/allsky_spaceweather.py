@@ -12,14 +12,12 @@ import requests
 import json
 from bs4 import BeautifulSoup
 import ephem
-import pytz
-import datetime
 
 metaData = {
     "name": "Space Weather",
     "description": "Retrieves and processes space weather data from NOAA SWPC for use in AllSky overlays",
     "module": "allsky_spaceweather",
-    "version": "v1.0.1",
+    "version": "v1.0.2",
     "events": [
         "periodic"
     ],
@@ -71,6 +69,13 @@ metaData = {
                 "authorurl": "https://github.com/jcauthen78/",
                 "changes": "Fixed NOAA API format handling (list-of-lists vs list-of-dicts), added per-endpoint error handling and HTTP status checks"
             }
+        ],
+        "v1.0.2": [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "The sun angle observer is reused between runs, removed the pytz dependency"
+            }
         ]
     }
 }
@@ -183,6 +188,22 @@ def process_solar_wind_data(data):
         "temp": {"value": temp_fmt, "color": temp_color}
     }
 
+_observer = None
+_sun = ephem.Sun()
+
+def get_sun_angle(latitude, longitude):
+    """Returns the current altitude of the sun in degrees. The observer is only created when the location changes"""
+    global _observer
+
+    if _observer is None or _observer.lat != ephem.degrees(latitude) or _observer.long != ephem.degrees(longitude):
+        _observer = ephem.Observer()
+        _observer.lat = latitude
+        _observer.long = longitude
+
+    _observer.date = ephem.now()
+    _sun.compute(_observer)
+    return round(float(_sun.alt) * 57.2957795, 1)
+
 def spaceweather(params, event):
     """Main entry point for the module"""
     result = ""
@@ -206,17 +227,10 @@ def spaceweather(params, event):
             return result
 
         # Calculate sun angle
-        utcnow = datetime.datetime.now(tz=pytz.UTC)
-        dtUtc = utcnow.replace(microsecond=0, tzinfo=None)
-        
-        obs = ephem.Observer()
-        obs.lat = str(s.convertLatLon(params["latitude"].strip()))
-        obs.long = str(s.convertLatLon(params["longitude"].strip()))
-        obs.date = dtUtc.strftime("%Y-%m-%d %H:%M:%S")
-
-        sun = ephem.Sun(obs)
-        sun.compute(obs)
-        sun_angle = round(float(sun.alt) * 57.2957795, 1)
+        sun_angle = get_sun_angle(
+            str(s.convertLatLon(params["latitude"].strip())),
+            str(s.convertLatLon(params["longitude"].strip()))
+        )
 
         # Initialize data dictionary
         space_weather_data = {
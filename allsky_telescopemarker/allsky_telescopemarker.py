@@ -9,9 +9,8 @@ This module will retrieve the current telescope position from ASCOM Remote Serve
 '''
 import allsky_shared as s
 import numpy as np
-from astropy.coordinates import EarthLocation
-from astropy import units as u
-import json, cv2, ast
+import json, cv2, ast, os, time
+from functools import lru_cache
 from urllib.request import urlopen
 from urllib.error import HTTPError, URLError
 from socket import timeout
@@ -20,7 +19,7 @@ metaData = {
     "name": "Telescope postion marker",
     "description": "Mark the current telescope postion retreived from ASCOM Remote Server in the image",
     "module": "allsky_telescopemarker",
-    "version": "v0.1",   
+    "version": "v0.4",   
     "events": [
         "night",
         "day"
@@ -36,13 +35,18 @@ metaData = {
         "image_flip": "None",
         "camera_azimuth": "160.0",
         "margin": "60",
+        "lens": "Orthographic",
         "telescope_marker_radius": "30",
         "telescope_marker_width": "5",
         "telescope_marker_color": "(0,0,255)",
         "telescope_server": "http://192.168.178.109:11111",
         "telescope_alt": "/api/v1/telescope/0/altitude",
         "telescope_az": "/api/v1/telescope/0/azimuth",
-        "telescope_default": "(0.0,0.0)"
+        "telescope_default": "(0.0,0.0)",
+        "coordinates": "Alt/Az",
+        "telescope_ra": "/api/v1/telescope/0/rightascension",
+        "telescope_dec": "/api/v1/telescope/0/declination",
+        "cache_ttl": "5"
     },
     "argumentdetails": {
         "observer_lat": {
@@ -95,6 +99,16 @@ metaData = {
             "description": "Allsky's image border [px]",
             "help": "Margin from squared image to horizon fisheye lense, use 0 px if left empty"
         },
+        "lens": {
+            "required": "false",
+            "description": "Lens projection",
+            "help": "How the lens maps altitude to distance from the image centre. Orthographic matches earlier versions of this module",
+            "type": {
+                "fieldtype": "select",
+                "values": "Orthographic,Equidistant,Equisolid",
+                "default": "Orthographic"
+            }
+        },
         "telescope_marker_radius": {
             "required": "false",
             "description": "Telescope marker radius [px]",
@@ -129,6 +143,37 @@ metaData = {
             "required": "false",
             "description": "Telescope fallback position [(0.0,0.0)]",
             "help": "Default telescope position if ASCOM Remote Server query fails"
+        },
+        "coordinates": {
+            "required": "false",
+            "description": "Telescope coordinates",
+            "help": "Read the telescope position as Alt/Az, or as RA/Dec and convert it to Alt/Az for the Allsky's location. RA/Dec requires astropy",
+            "type": {
+                "fieldtype": "select",
+                "values": "Alt/Az,RA/Dec",
+                "default": "Alt/Az"
+            }
+        },
+        "telescope_ra": {
+            "required": "false",
+            "description": "Telescope server right ascension API url [path]",
+            "help": "API query URL of the ASCOM Remote Server for the telescope right ascension, only used for RA/Dec coordinates"
+        },
+        "telescope_dec": {
+            "required": "false",
+            "description": "Telescope server declination API url [path]",
+            "help": "API query URL of the ASCOM Remote Server for the telescope declination, only used for RA/Dec coordinates"
+        },
+        "cache_ttl": {
+            "required": "false",
+            "description": "Position cache time [s]",
+            "help": "The telescope position, or a failed query, is reused for this many seconds before the ASCOM Remote Server is queried again, use 0 to query for every image",
+            "type": {
+                "fieldtype": "spinner",
+                "min": 0,
+                "max": 300,
+                "step": 1
+            }
         }             
     },
     "changelog": {
@@ -138,37 +183,116 @@ metaData = {
                 "authorurl": "https://github.com/allskyteam",
                 "changes": "Initial Test"
             }
-        ]                                        
-    }            
+        ],
+        "v0.2" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Removed the unused astropy observer location created for every image"
+            }
+        ],
+        "v0.3" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Added the lens projection option, equidistant, equisolid or orthographic"
+            }
+        ],
+        "v0.4" : [
+            {
+                "author": "AllskyTeam",
+                "authorurl": "https://github.com/allskyteam",
+                "changes": "Added RA/Dec coordinates, using astropy only when selected, and a short cache of the telescope position"
+            }
+        ]
+    }
 }
 
 
-def get_telescope_position(telescope_server, telescope_alt, telescope_az, telescope_default):
+POSITION_CACHE_FILE = "/dev/shm/allsky_telescopemarker.json"
+
+def read_position_cache(key, cache_ttl):
     """
-    Read current postion from ASCOM Remote Server
-    
-    :param telescope_server: Telescope server address
-    :param telescope_alt: Telescope altitude position URL
-    :param telescope_az: Telescope azimuth position URL
+    Returns the cached (position, True) for key if it is younger than cache_ttl seconds, the position
+    is None if the query failed. Returns (None, False) if there is no usable cached position
     """
-    
+    if cache_ttl <= 0:
+        return None, False
     try:
-        # store the response of ra URL 
-        response_alt = json.loads(urlopen(telescope_server + telescope_alt, timeout=1).read().decode('utf-8'))['Value']
-        # store the response of dec URL 
-        response_az = json.loads(urlopen(telescope_server + telescope_az, timeout=1).read().decode('utf-8'))['Value']
-        
-    except URLError as error:
-        # return default position
-        return telescope_default
-        
-    try: 
-        # return current postion (ra, dec)
-        return response_alt, response_az
-    
-    except ValueError as e:
-        # return default position
+        with open(POSITION_CACHE_FILE, "r", encoding="utf-8") as file:
+            cache = json.load(file)
+        if cache["key"] == key and 0 <= time.time() - cache["time"] < cache_ttl:
+            return cache["position"], True
+    except (OSError, ValueError, KeyError):
+        pass
+    return None, False
+
+def write_position_cache(key, position):
+    try:
+        temp_file = f"{POSITION_CACHE_FILE}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as file:
+            json.dump({"key": key, "time": time.time(), "position": position}, file)
+        os.replace(temp_file, POSITION_CACHE_FILE)
+    except OSError:
+        pass
+
+def get_telescope_position(telescope_server, telescope_alt, telescope_az, telescope_default, cache_ttl=0):
+    """
+    Read current postion from ASCOM Remote Server. The position, or the failure to read it, is
+    cached for cache_ttl seconds so an unreachable server does not cost a timeout for every image
+
+    :param telescope_server: Telescope server address
+    :param telescope_alt: Telescope altitude (or right ascension) position URL
+    :param telescope_az: Telescope azimuth (or declination) position URL
+    :param telescope_default: Position returned if the server cannot be read
+    :param cache_ttl: Seconds to reuse the last response for
+    """
+    key = f"{telescope_server}|{telescope_alt}|{telescope_az}"
+    position, cached = read_position_cache(key, cache_ttl)
+
+    if not cached:
+        try:
+            response_alt = json.loads(urlopen(telescope_server + telescope_alt, timeout=1).read().decode('utf-8'))['Value']
+            response_az = json.loads(urlopen(telescope_server + telescope_az, timeout=1).read().decode('utf-8'))['Value']
+            position = [float(response_alt), float(response_az)]
+        except (URLError, timeout, OSError, ValueError, KeyError, TypeError):
+            position = None
+        write_position_cache(key, position)
+
+    if position is None:
         return telescope_default
+    return tuple(position)
+
+@lru_cache(maxsize=2)
+def get_earth_location(lat, lon, height):
+    from astropy import units as u
+    from astropy.coordinates import EarthLocation
+
+    return EarthLocation(lat=lat * u.deg, lon=lon * u.deg, height=height * u.m)
+
+def radec_to_altaz(ra, dec, lat, lon, height):
+    """
+    Convert the telescope's RA/Dec to Alt/Az at the current time. astropy is only imported the first
+    time this is used so it is never loaded in Alt/Az mode
+
+    :param ra: Right ascension in hours
+    :param dec: Declination in degrees
+    :param lat: Latitude of the location
+    :param lon: Longitude of the location
+    :param height: Height of the location in meters
+    :return: (alt, az) in degrees
+    """
+    from astropy import units as u
+    from astropy.coordinates import AltAz, SkyCoord
+    from astropy.time import Time
+    from astropy.utils import iers
+
+    # Never download IERS tables while processing an image, the bundled ones are accurate enough for a marker
+    iers.conf.auto_download = False
+
+    frame = AltAz(obstime=Time.now(), location=get_earth_location(lat, lon, height))
+    position = SkyCoord(ra=ra * u.hourangle, dec=dec * u.deg).transform_to(frame)
+    return float(position.alt.deg), float(position.az.deg)
 
 def rotate_azimuth(az, camera_azimuth):
     """
@@ -180,7 +304,7 @@ def rotate_azimuth(az, camera_azimuth):
     """
     return (az - camera_azimuth) % 360
 
-def alt_az_to_pixel(alt, az, image_width, image_height, margin):
+def alt_az_to_pixel(alt, az, image_width, image_height, margin, lens="orthographic"):
     """
     Convert altitude and azimuth to pixel coordinates on a fisheye image.
 
@@ -189,51 +313,57 @@ def alt_az_to_pixel(alt, az, image_width, image_height, margin):
     :param image_width: Width of the image in pixels
     :param image_height: Height of the image in pixels
     :param margin: Additional margin around the image in pixels
+    :param lens: Lens projection, equidistant, equisolid or orthographic
     :return: (x, y) pixel coordinates
     """
     # Convert degrees to radians
-    alt_rad = np.deg2rad(alt)
+    zenith = np.deg2rad(90.0 - alt)
     az_rad = np.deg2rad(az)
 
     # Compute the radius of the fisheye projection
     radius = (min(image_width, image_height) - 2 * margin) / 2
 
+    # Distance from the centre as a fraction of the radius. sin() folds back past the horizon so
+    # below it the orthographic distance is mirrored outwards instead
+    if lens == "equidistant":
+        distance = zenith / (np.pi / 2)
+    elif lens == "equisolid":
+        distance = np.sin(zenith / 2) / np.sin(np.pi / 4)
+    elif zenith <= np.pi / 2:
+        distance = np.sin(zenith)
+    else:
+        distance = 2 - np.sin(zenith)
+
     # Fisheye projection equations
-    x = image_width / 2 + radius * np.sin(az_rad) * np.cos(alt_rad)
-    y = image_height / 2 - radius * np.cos(az_rad) * np.cos(alt_rad)
+    x = image_width / 2 + radius * np.sin(az_rad) * distance
+    y = image_height / 2 - radius * np.cos(az_rad) * distance
 
     return int(x), int(y)
 
-def mark_telescope_position(s, alt, az, observer_lat, observer_lon, observer_height, image_lat, image_lon, image_height, image_flip, camera_azimuth, margin, telescope_marker_radius, telescope_marker_color, telescope_marker_width):
+def mark_telescope_position(s, alt, az, image_flip, camera_azimuth, margin, telescope_marker_radius, telescope_marker_color, telescope_marker_width, lens="orthographic"):
     """
-    Mark the position of the telescope on the fisheye image based on RA and Dec.
+    Mark the position of the telescope on the fisheye image based on Alt and Az.
 
-    :param ra: Right ascension in degrees
-    :param dec: Declination in degrees
-    :param observer_lat: Latitude of the observer
-    :param observer_lon: Longitude of the observer
-    :param observer_height: Height of the observer in meters
-    :param image_lat: Latitude of the fisheye image location
-    :param image_lon: Longitude of the fisheye image location
-    :param image_height: Height of the fisheye image location in meters
+    :param alt: Altitude of the telescope in degrees
+    :param az: Azimuth of the telescope in degrees
+    :param image_flip: None, Horizontal, Vertical or Both
     :param camera_azimuth: Azimuth orientation of the camera in degrees
     :param margin: Additional margin around the image in pixels
+    :param lens: Lens projection, equidistant, equisolid or orthographic
     """
 
-    # Create observer location and observation time objects
-    observer_location = EarthLocation(lat=observer_lat * u.deg, lon=observer_lon * u.deg, height=observer_height * u.m)
-
     # Adjust the azimuth based on the camera's orientation
     az = rotate_azimuth(az, camera_azimuth)
 
     # Convert Alt/Az to pixel coordinates for the image location
-    x, y = alt_az_to_pixel(alt, az, s.image.shape[1], s.image.shape[0], margin)
+    height, width = s.image.shape[:2]
+    x, y = alt_az_to_pixel(alt, az, width, height, margin, lens)
 
     # Apply image flip option
     if image_flip == "Horizontal" or image_flip == "Both":
-        x = s.image.shape[1] - x
+        x = width - x
     if image_flip == "Vertical" or image_flip == "Both":
-        y = s.image.shape[0] - y
+        y = height - y
 
     # Draw a red circle to mark the position
     s.image = cv2.circle(s.image, (x - int(telescope_marker_radius/2), y - int(telescope_marker_radius/2)), telescope_marker_radius, telescope_marker_color, telescope_marker_width)
@@ -242,15 +372,13 @@ def mark_telescope_position(s, alt, az, observer_lat, observer_lon, observer_hei
     #cv2.imwrite(output_path, s)
 
 def telescopemarker(params, event):
-    observer_lat = float(params['observer_lat'])
-    observer_lon = float(params['observer_lon'])
-    observer_height = float(params['observer_height'])
     image_lat = float(params['image_lat'])
     image_lon = float(params['image_lon'])
     image_height = float(params['image_height'])
     image_flip = params['image_flip']
     camera_azimuth = float(params['camera_azimuth'])
     margin = int(params['margin'])
+    lens = params.get('lens', 'Orthographic').lower()
     telescope_marker_radius = int(params['telescope_marker_radius'])
     telescope_marker_width = int(params['telescope_marker_width'])
     telescope_marker_color = ast.literal_eval(params['telescope_marker_color'])
@@ -258,7 +386,22 @@ def telescopemarker(params, event):
     telescope_alt = params['telescope_alt']
     telescope_az = params['telescope_az']
     telescope_default = ast.literal_eval(params['telescope_default'])
+    coordinates = params.get('coordinates', 'Alt/Az')
+    cache_ttl = float(params.get('cache_ttl', 5))
 
-    alt, az = get_telescope_position(telescope_server, telescope_alt, telescope_az, telescope_default)
-    mark_telescope_position(s, alt, az, observer_lat, observer_lon, observer_height, image_lat, image_lon, image_height, image_flip, camera_azimuth, margin, telescope_marker_radius, telescope_marker_color, telescope_marker_width)
+    if coordinates == 'RA/Dec':
+        position = get_telescope_position(
+            telescope_server,
+            params.get('telescope_ra', '/api/v1/telescope/0/rightascension'),
+            params.get('telescope_dec', '/api/v1/telescope/0/declination'),
+            None,
+            cache_ttl
+        )
+        if position is None:
+            alt, az = telescope_default
+        else:
+            alt, az = radec_to_altaz(position[0], position[1], image_lat, image_lon, image_height)
+    else:
+        alt, az = get_telescope_position(telescope_server, telescope_alt, telescope_az, telescope_default, cache_ttl)
+    mark_telescope_position(s, alt, az, image_flip, camera_azimuth, margin, telescope_marker_radius, telescope_marker_color, telescope_marker_width, lens)
 
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+'''
+Compares the import time and the time per image of allsky_telescopemarker.py against the
+original version, which imported astropy at load and created an astropy EarthLocation and
+converted the position with trig for every image.
+
+Imports are timed in a fresh interpreter with allsky_shared, cv2 and numpy already loaded, as
+they are by Allsky. The telescope default position is used so no ASCOM Remote Server is needed.
+The original version is only measured if astropy is installed. It needs allsky_shared so should
+be run on an Allsky install
+
+    ./benchmark_telescopemarker.py [frames]
+'''
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+MODULE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+ALLSKY_MODULES = os.path.join(os.environ.get('ALLSKY_HOME', os.path.expanduser('~/allsky')), 'scripts', 'modules')
+sys.path.insert(0, MODULE_DIR)
+sys.path.insert(1, ALLSKY_MODULES)
+
+IMPORT_CODE = '''
+import json, sys, time
+import allsky_shared, cv2, numpy
+start_time = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start_time
+print(json.dumps({{"ms": elapsed * 1000, "astropy": "astropy" in sys.modules}}))
+'''
+
+def time_import(module, runs=5):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [MODULE_DIR, ALLSKY_MODULES, env.get('PYTHONPATH')]))
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_CODE.format(module=module)], env=env, capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return min(result['ms'] for result in results), any(result['astropy'] for result in results)
+
+def original_frame(image, alt, az, params):
+    ''' The per image work of the original module '''
+    from astropy import units as u
+    from astropy.coordinates import EarthLocation
+
+    EarthLocation(lat=float(params['image_lat']) * u.deg, lon=float(params['image_lon']) * u.deg, height=float(params['image_height']) * u.m)
+
+    height, width = image.shape[:2]
+    margin = int(params['margin'])
+    az_rad = np.deg2rad((az - float(params['camera_azimuth'])) % 360)
+    alt_rad = np.deg2rad(alt)
+    radius = (min(width, height) - 2 * margin) / 2
+    x = int(width / 2 + radius * np.sin(az_rad) * np.cos(alt_rad))
+    y = int(height / 2 - radius * np.cos(az_rad) * np.cos(alt_rad))
+    return x, y
+
+def time_frames(name, process, frames):
+    start_time = time.perf_counter()
+    for _ in range(frames):
+        process()
+    elapsed = time.perf_counter() - start_time
+    print(f'{name:9} {elapsed / frames * 1000:8.3f}ms per image')
+
+if __name__ == '__main__':
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+    import allsky_shared as s
+    import allsky_telescopemarker as marker
+
+    params = dict(marker.metaData['arguments'])
+    params['telescope_default'] = '(45.0,120.0)'
+    params['telescope_server'] = 'http://127.0.0.1:9'
+    params['cache_ttl'] = '60'
+    image = np.zeros((3040, 4056, 3), dtype=np.uint8)
+
+    try:
+        import astropy
+        has_astropy = True
+    except ImportError:
+        has_astropy = False
+
+    print('Import')
+    if has_astropy:
+        elapsed, _ = time_import('astropy.coordinates, astropy.units')
+        print(f'{"original":9} {elapsed:8.1f}ms (astropy)')
+    elapsed, loads_astropy = time_import('allsky_telescopemarker')
+    print(f'{"current":9} {elapsed:8.1f}ms, astropy loaded: {loads_astropy}')
+
+    print('Per image')
+    if has_astropy:
+        time_frames('original', lambda: original_frame(image, 45.0, 120.0, params), frames)
+
+    def current_frame():
+        s.image = image
+        marker.telescopemarker(params, 'night')
+    current_frame()
+    time_frames('current', current_frame, frames)